@@ -24,6 +24,7 @@
 import threading
 import asyncio
 import itertools
+import bisect
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple
 
@@ -93,6 +94,8 @@ class AddressSynchronizer(Logger):
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
+        self._rebuild_history_index()
+        self._rebuild_utxo_index()
 
     def is_mine(self, address):
         return self.db.is_addr_in_history(address)
@@ -166,11 +169,11 @@ class AddressSynchronizer(Logger):
             self.network.unregister_callback(self.on_blockchain_updated)
             self.storage.put('stored_height', self.get_local_height())
         if write_to_disk:
-            self.storage.write()
+            self.storage.flush()
 
     def add_address(self, address):
         if not self.db.get_addr_history(address):
-            self.db.history[address] = []
+            self.db.set_addr_history(address, [])
             self.set_up_to_date(False)
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -192,7 +195,7 @@ class AddressSynchronizer(Logger):
                 if spending_tx_hash is None:
                     continue
                 # this outpoint has already been spent, by spending_tx
-                assert self.db.get_transaction(spending_tx_hash)
+                assert self.db.has_transaction(spending_tx_hash)
                 conflicting_txns |= {spending_tx_hash}
             if tx_hash in conflicting_txns:
                 # this tx is already in history, so it conflicts with itself
@@ -262,6 +265,7 @@ class AddressSynchronizer(Logger):
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
                                 self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                                self._remove_from_utxo_index(addr, ser)
                             return
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
@@ -284,8 +288,13 @@ class AddressSynchronizer(Logger):
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
                         self._add_tx_to_local_history(next_tx)
+                        self._update_history_index(next_tx)
+                        self._remove_from_utxo_index(addr, ser)
+                    else:
+                        self._add_to_utxo_index(addr, ser, v, is_coinbase)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._update_history_index(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             return True
@@ -308,15 +317,19 @@ class AddressSynchronizer(Logger):
                     if spending_txid == tx_hash:
                         self.db.remove_spent_outpoint(prevout_hash, prevout_n)
 
-        with self.transaction_lock:
+        # we need self.transaction_lock but get_txpos will take self.lock
+        # so we need to take that too here, to enforce order of locks
+        with self.lock, self.transaction_lock:
             self.logger.info(f"removing tx from history {tx_hash}")
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
+            self._remove_tx_from_utxo_index(tx_hash)
             for addr in itertools.chain(self.db.get_txi(tx_hash), self.db.get_txo(tx_hash)):
                 self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
+            self._update_history_index(tx_hash)
 
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
@@ -342,11 +355,17 @@ class AddressSynchronizer(Logger):
                     self.db.remove_verified_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
+                    self._update_history_index(tx_hash)
             self.db.set_addr_history(addr, hist)
 
+        old_hist = set(old_hist)
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
             self.add_unverified_tx(tx_hash, tx_height)
+            # txs we already knew for this addr at this height need no work;
+            # getting them would parse them again if they were evicted from the tx cache
+            if (tx_hash, tx_height) in old_hist:
+                continue
             # if addr is new, we have to recompute txi and txo
             tx = self.db.get_transaction(tx_hash)
             if tx is None:
@@ -360,6 +379,8 @@ class AddressSynchronizer(Logger):
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
+        self._history_index = None  # built once loading is done, see _rebuild_history_index
+        self._utxo_index = {}  # address -> {"txid:n" -> (value, is_coinbase)}; see _rebuild_utxo_index
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
@@ -382,18 +403,20 @@ class AddressSynchronizer(Logger):
                     self.add_transaction(tx_hash, tx, allow_unrelated=True)
                     save = True
         if save:
-            self.storage.write()
+            self.storage.schedule_write()
 
     def remove_local_transactions_we_dont_have(self):
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             tx_height = self.get_tx_height(txid).height
-            if tx_height == TX_HEIGHT_LOCAL and not self.db.get_transaction(txid):
+            if tx_height == TX_HEIGHT_LOCAL and not self.db.has_transaction(txid):
                 self.remove_transaction(txid)
 
     def clear_history(self):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self._rebuild_history_index()
+                self._rebuild_utxo_index()
                 self.storage.write()
 
     def get_txpos(self, tx_hash):
@@ -406,7 +429,7 @@ class AddressSynchronizer(Logger):
                 height = self.unverified_tx[tx_hash]
                 return (height, 0) if height > 0 else ((1e9 - height), 0)
             else:
-                return (1e9+1, 0)
+                return (1e9 - TX_HEIGHT_LOCAL, 0)
 
     def with_local_height_cached(func):
         # get local height only once, as it's relatively expensive.
@@ -422,9 +445,8 @@ class AddressSynchronizer(Logger):
 
     @with_local_height_cached
     def get_history(self, domain=None):
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_history_from_index()
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -462,6 +484,152 @@ class AddressSynchronizer(Logger):
 
         return h2
 
+    def _get_history_from_index(self):
+        """Same as get_history for the whole wallet, but read from the
+        incrementally maintained history index."""
+        with self.lock, self.transaction_lock:
+            h = []
+            balance = 0
+            for key in self._history_index_keys:
+                tx_hash = key[-1]
+                delta = self._history_index[tx_hash][1]
+                balance += delta
+                h.append((tx_hash, self.get_tx_height(tx_hash), delta, balance))
+            # fixme: this may happen if history is incomplete
+            if balance != sum(self.get_balance()):
+                self.logger.info("Error: history not synchronized")
+                return []
+            return h
+
+    def iter_history(self, *, cursor: str = None, batch_size: int = 1000):
+        """Yields the wallet history like get_history(), oldest first, without
+        building the whole list. If cursor is given (see get_history_cursor),
+        starts right after it."""
+        with self.lock, self.transaction_lock:
+            # same check as get_history: running balances of an incomplete history are wrong
+            if sum(entry[1] for entry in self._history_index.values()) != sum(self.get_balance()):
+                self.logger.info("Error: history not synchronized")
+                return
+            keys = self._history_index_keys
+            start = 0 if cursor is None else bisect.bisect_right(keys, self._history_key_from_cursor(cursor))
+            balance = sum(self._history_index[key[-1]][1] for key in itertools.islice(keys, start))
+            batch = keys[start:start+batch_size]
+        while batch:
+            items = []
+            with self.lock, self.transaction_lock:
+                for key in batch:
+                    tx_hash = key[-1]
+                    entry = self._history_index.get(tx_hash)
+                    if entry is None or entry[0] != key:
+                        continue  # changed since the batch was taken
+                    balance += entry[1]
+                    items.append((tx_hash, self.get_tx_height(tx_hash), entry[1], balance))
+                keys = self._history_index_keys
+                start = bisect.bisect_right(keys, batch[-1])
+                batch = keys[start:start+batch_size]
+            # don't hold the locks while the caller processes items
+            yield from items
+
+    @classmethod
+    def get_history_cursor(cls, tx_hash: str, height: int, txpos: Optional[int]) -> str:
+        """Returns a cursor pointing right after tx_hash in the history."""
+        return f"{height}:{txpos or 0}:{tx_hash}"
+
+    @classmethod
+    def _history_key_from_cursor(cls, cursor: str):
+        try:
+            height, txpos, tx_hash = cursor.split(':')
+            height, txpos = int(height), int(txpos)
+        except ValueError:
+            raise Exception(f'invalid history cursor: {cursor}')
+        return cls._history_key(tx_hash, height, txpos)
+
+    @classmethod
+    def _history_key(cls, tx_hash, height, txpos):
+        # same order as get_txpos, then txid, as in the history index
+        return ((height, txpos or 0) if height > 0 else (1e9 - height, 0)) + (tx_hash,)
+
+    def _get_history_index_entry(self, txid):
+        """Returns (sort key, delta) of txid in the wallet history,
+        or None if it does not touch any of our addresses."""
+        delta = 0
+        is_related = False
+        for addr in set(itertools.chain(self.db.get_txi(txid), self.db.get_txo(txid))):
+            if self.is_mine(addr):
+                is_related = True
+                delta += self.get_tx_delta(txid, addr)
+        if not is_related:
+            return None
+        return self.get_txpos(txid) + (txid,), delta
+
+    def _rebuild_history_index(self):
+        with self.lock, self.transaction_lock:
+            self._history_index = {}  # txid -> (sort key, delta)
+            for txid in set(itertools.chain(self.db.list_txi(), self.db.list_txo())):
+                entry = self._get_history_index_entry(txid)
+                if entry is not None:
+                    self._history_index[txid] = entry
+            # sort keys, ordered from oldest to newest
+            self._history_index_keys = sorted(key for key, delta in self._history_index.values())
+
+    def _update_history_index(self, txid):
+        """Moves txid to its current position in the history index.
+        Must be called whenever the txi/txo or the mined status of txid changes."""
+        with self.lock, self.transaction_lock:
+            if self._history_index is None:
+                return
+            new_entry = self._get_history_index_entry(txid)
+            old_entry = self._history_index.pop(txid, None)
+            if old_entry == new_entry:
+                if new_entry is not None:
+                    self._history_index[txid] = new_entry
+                return
+            if old_entry is not None:
+                i = bisect.bisect_left(self._history_index_keys, old_entry[0])
+                del self._history_index_keys[i]
+            if new_entry is not None:
+                self._history_index[txid] = new_entry
+                bisect.insort(self._history_index_keys, new_entry[0])
+
+    def _rebuild_utxo_index(self):
+        with self.lock, self.transaction_lock:
+            self._utxo_index = {}
+            for txid in self.db.list_txo():
+                for addr in self.db.get_txo(txid):
+                    for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                        self._add_to_utxo_index(addr, txid + ':%d' % n, v, is_cb)
+            for txid in self.db.list_txi():
+                for addr in self.db.get_txi(txid):
+                    for ser, v in self.db.get_txi_addr(txid, addr):
+                        self._remove_from_utxo_index(addr, ser)
+
+    def _add_to_utxo_index(self, addr, txo, value, is_coinbase):
+        with self.transaction_lock:
+            self._utxo_index.setdefault(addr, {})[txo] = (value, is_coinbase)
+
+    def _remove_from_utxo_index(self, addr, txo):
+        with self.transaction_lock:
+            coins = self._utxo_index.get(addr)
+            if coins is None:
+                return
+            coins.pop(txo, None)
+            if not coins:
+                self._utxo_index.pop(addr)
+
+    def _remove_tx_from_utxo_index(self, txid):
+        """Drops the outputs of txid from the utxo index, and gives
+        back the coins it was spending. Call before removing its txi/txo."""
+        with self.transaction_lock:
+            for addr in self.db.get_txo(txid):
+                for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                    self._remove_from_utxo_index(addr, txid + ':%d' % n)
+            for addr in self.db.get_txi(txid):
+                for ser, v in self.db.get_txi_addr(txid, addr):
+                    prevout_hash, prevout_n = ser.split(':')
+                    for n, v2, is_cb in self.db.get_txo_addr(prevout_hash, addr):
+                        if n == int(prevout_n):
+                            self._add_to_utxo_index(addr, ser, v2, is_cb)
+
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
             for addr in itertools.chain(self.db.get_txi(txid), self.db.get_txo(txid)):
@@ -501,24 +669,30 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._update_history_index(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+                self._update_history_index(tx_hash)
+            if self.verifier:
+                self.verifier.wakeup()
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._update_history_index(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._update_history_index(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -548,6 +722,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._update_history_index(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -577,7 +752,7 @@ class AddressSynchronizer(Logger):
         if self.network:
             self.network.notify('status')
         if up_to_date:
-            self.storage.write()
+            self.storage.schedule_write()
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -699,24 +874,24 @@ class AddressSynchronizer(Logger):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        with self.lock, self.transaction_lock:
+            for txo, (value, is_cb) in self._utxo_index.get(address, {}).items():
+                out[txo] = self._utxo_dict(address, txo, value, is_cb)
         return out
 
+    def _utxo_dict(self, address, txo, value, is_cb):
+        # a fresh dict every time, as callers add input info to it
+        prevout_hash, prevout_n = txo.split(':')
+        return {
+            'address':address,
+            'value':value,
+            'prevout_n':int(prevout_n),
+            'prevout_hash':prevout_hash,
+            'height':self.get_tx_height(prevout_hash).height,
+            'coinbase':is_cb
+        }
+
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
@@ -760,25 +935,28 @@ class AddressSynchronizer(Logger):
         return result
 
     @with_local_height_cached
-    def get_utxos(self, domain=None, *, excluded_addresses=None,
+    def get_utxos(self, domain=None, *, excluded_addresses=None, excluded_coins: Set[str] = None,
                   mature_only: bool = False, confirmed_only: bool = False, nonlocal_only: bool = False):
         coins = []
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        if excluded_addresses:
-            domain = set(domain) - set(excluded_addresses)
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
-                    continue
-                if mature_only and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
-                continue
+        with self.lock, self.transaction_lock:
+            if domain is None:
+                # only addresses that have coins are in the utxo index
+                domain = self._utxo_index.keys()
+            domain = set(domain)
+            if excluded_addresses:
+                domain -= set(excluded_addresses)
+            for addr in domain:
+                for txo, (value, is_cb) in self._utxo_index.get(addr, {}).items():
+                    if excluded_coins and txo in excluded_coins:
+                        continue
+                    x = self._utxo_dict(addr, txo, value, is_cb)
+                    if confirmed_only and x['height'] <= 0:
+                        continue
+                    if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
+                        continue
+                    if mature_only and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                        continue
+                    coins.append(x)
         return coins
 
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
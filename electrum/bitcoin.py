@@ -207,9 +207,7 @@ def int_to_hex(i: int, length: int=1) -> str:
     if i < 0:
         # two's complement
         i = range_size + i
-    s = hex(i)[2:].rstrip('L')
-    s = "0"*(2*length - len(s)) + s
-    return rev_hex(s)
+    return bh2u(i.to_bytes(length, 'little'))
 
 def script_num_to_hex(i: int) -> str:
     """See CScriptNum in Bitcoin Core.
@@ -235,16 +233,20 @@ def script_num_to_hex(i: int) -> str:
     return bh2u(result)
 
 
-def var_int(i: int) -> str:
+def var_int_bytes(i: int) -> bytes:
     # https://en.bitcoin.it/wiki/Protocol_specification#Variable_length_integer
     if i<0xfd:
-        return int_to_hex(i)
+        return bytes([i])
     elif i<=0xffff:
-        return "fd"+int_to_hex(i,2)
+        return b"\xfd" + i.to_bytes(2, 'little')
     elif i<=0xffffffff:
-        return "fe"+int_to_hex(i,4)
+        return b"\xfe" + i.to_bytes(4, 'little')
     else:
-        return "ff"+int_to_hex(i,8)
+        return b"\xff" + i.to_bytes(8, 'little')
+
+
+def var_int(i: int) -> str:
+    return bh2u(var_int_bytes(i))
 
 
 def witness_push(item: str) -> str:
@@ -21,8 +21,12 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
+import mmap
+import time
+import hashlib
 import threading
-from typing import Optional, Dict, Mapping, Sequence
+from typing import Optional, Dict, Mapping, Sequence, Tuple
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -36,6 +40,10 @@ from .logging import get_logger, Logger
 _logger = get_logger(__name__)
 
 HEADER_SIZE = 80  # bytes
+# Appended headers are fsync'ed in groups: at the latest after this many headers,
+# or with the first append after this many seconds (see Blockchain.write).
+HEADER_FSYNC_MAX_PENDING = 2016
+HEADER_FSYNC_INTERVAL = 5
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
 
@@ -100,6 +108,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_file()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
@@ -136,6 +145,7 @@ def read_blockchains(config: 'SimpleConfig'):
                        prev_hash=prev_hash)
         # consistency checks
         h = b.read_header(b.forkpoint)
+        b.close_file()
         if first_hash != hash_header(h):
             delete_chain(filename, "incorrect first hash for chain")
             return
@@ -148,6 +158,7 @@ def read_blockchains(config: 'SimpleConfig'):
 
     for filename in l:
         instantiate_chain(filename)
+    read_chainwork_cache(config)
 
 
 def get_best_chain() -> 'Blockchain':
@@ -157,6 +168,54 @@ def get_best_chain() -> 'Blockchain':
 _CHAINWORK_CACHE = {
     "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
 }  # type: Dict[str, int]
+# block hash -> height, for the entries of _CHAINWORK_CACHE that are saved to disk
+_CHAINWORK_CACHE_HEIGHTS = {}  # type: Dict[str, int]
+# the two dicts above are shared by all chains, which use their own locks
+_chainwork_cache_lock = threading.Lock()
+# only one thread writes the file at a time
+_chainwork_cache_write_lock = threading.Lock()
+
+
+def _chainwork_cache_path(config: 'SimpleConfig') -> str:
+    return os.path.join(util.get_headers_dir(config), 'chainwork_cache')
+
+
+def read_chainwork_cache(config: 'SimpleConfig') -> None:
+    """Loads the chainwork computed by previous runs, so that comparing
+    chains does not need to walk all retarget periods again.
+    Only entries whose block is at that height in one of our chains are used.
+    """
+    try:
+        with open(_chainwork_cache_path(config), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        entries = [(block_hash, int(height), int(work)) for block_hash, (height, work) in data.items()]
+    except (OSError, ValueError, TypeError) as e:
+        _logger.info(f"[blockchain] not using chainwork cache: {repr(e)}")
+        return
+    with blockchains_lock:
+        chains = list(blockchains.values())
+    entries = [(block_hash, height, work) for block_hash, height, work in entries
+               if any(chain.check_hash(height, block_hash) for chain in chains)]
+    with _chainwork_cache_lock:
+        for block_hash, height, work in entries:
+            _CHAINWORK_CACHE[block_hash] = work
+            _CHAINWORK_CACHE_HEIGHTS[block_hash] = height
+
+
+def write_chainwork_cache(config: 'SimpleConfig') -> None:
+    """Should not be called with a chain lock held, as it writes to disk."""
+    with _chainwork_cache_lock:
+        data = {block_hash: (height, _CHAINWORK_CACHE[block_hash])
+                for block_hash, height in _CHAINWORK_CACHE_HEIGHTS.items()}
+    path = _chainwork_cache_path(config)
+    temp_path = "%s.tmp.%s" % (path, os.getpid())
+    with _chainwork_cache_write_lock:
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            _logger.info(f"[blockchain] failed to save chainwork cache: {repr(e)}")
 
 
 class Blockchain(Logger):
@@ -178,7 +237,16 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._mmap = None  # type: Optional[mmap.mmap]  # of the headers file, opened lazily
+        # header hashes (internal byte order) of our own headers, 32 bytes each, indexed
+        # by height - forkpoint. Zeroes where not computed yet. Created lazily.
+        self._hashes = None  # type: Optional[bytearray]
+        self._group_commit = config.get('headers_group_commit', True)
+        self._unsynced_headers = 0  # appended but not fsync'ed yet
+        self._last_fsync = time.monotonic()
+        self._sync_timer = None  # type: Optional[threading.Timer]  # fsyncs pending appends later
         self.update_size()
+        self._truncate_torn_headers()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -279,6 +347,59 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        # the file might have been changed by someone else
+        self.close_file()
+        self._hashes = None
+
+    @with_lock
+    def close_file(self) -> None:
+        """Unmaps the headers file. It is mapped again when needed."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    @with_lock
+    def _get_mmap(self, end: int) -> mmap.mmap:
+        """Returns the mapping of the headers file, covering at least
+        its first end bytes. Appends do not unmap the file, so it is
+        mapped again only when a read goes past the mapped part."""
+        if self._mmap is not None and len(self._mmap) < end:
+            self.close_file()
+        if self._mmap is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @with_lock
+    def _read_raw_header(self, height: int) -> bytes:
+        """height must be within our own part of the chain"""
+        delta = height - self.forkpoint
+        h = self._get_mmap((delta + 1) * HEADER_SIZE)[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE]
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
+
+    @with_lock
+    def _get_header_hash(self, height: int) -> Optional[bytes]:
+        """Returns the hash of the header at height in internal byte order,
+        or None if we don't have that header."""
+        if height < self.forkpoint:
+            return self.parent._get_header_hash(height)
+        if height > self.height():
+            return None
+        delta = height - self.forkpoint
+        if self._hashes is None:
+            self._hashes = bytearray(self._size * 32)
+        h = bytes(self._hashes[delta * 32:(delta + 1) * 32])
+        if h == bytes(32):
+            raw_header = self._read_raw_header(height)
+            if raw_header == bytes(HEADER_SIZE):
+                return None
+            h = sha256d(raw_header)
+            self._hashes[delta * 32:(delta + 1) * 32] = h
+        return h
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
@@ -297,20 +418,41 @@ class Blockchain(Logger):
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
     def verify_chunk(self, index: int, data: bytes) -> None:
+        """Same checks as verify_header for each header of the chunk, but done
+        on the raw bytes: headers are not deserialized, and hashes are
+        compared in internal byte order instead of hex."""
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
-        prev_hash = self.get_hash(start_height - 1)
+        prev_hash = bfh(self.get_hash(start_height - 1))[::-1]
         target = self.get_target(index-1)
+        bits = None if constants.net.TESTNET else self.target_to_bits(target)
+        # headers of this chunk that we already have; they must not change
+        existing = memoryview(self.read_raw_headers(start_height, num))
+        num_existing = len(existing) // HEADER_SIZE
+        data = memoryview(data)
         for i in range(num):
             height = start_height + i
-            try:
-                expected_header_hash = self.get_hash(height)
-            except MissingHeader:
-                expected_header_hash = None
             raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+            _hash = hashlib.sha256(hashlib.sha256(raw_header).digest()).digest()
+            expected_header_hash = None
+            if height == 0 or self._is_checkpoint_height(height):
+                expected_header_hash = self.get_hash(height)
+            elif i < num_existing:
+                existing_header = existing[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
+                if existing_header != bytes(HEADER_SIZE) and existing_header != raw_header:
+                    expected_header_hash = hash_encode(sha256d(existing_header.tobytes()))
+            if expected_header_hash and expected_header_hash != hash_encode(_hash):
+                raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, hash_encode(_hash)))
+            if prev_hash != raw_header[4:36]:
+                raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(raw_header[4:36])))
+            if bits is not None:
+                header_bits = int.from_bytes(raw_header[72:76], byteorder='little')
+                if bits != header_bits:
+                    raise Exception("bits mismatch: %s vs %s" % (bits, header_bits))
+                block_hash_as_num = int.from_bytes(_hash, byteorder='little')
+                if block_hash_as_num > target:
+                    raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
+            prev_hash = _hash
 
     @with_lock
     def path(self):
@@ -378,6 +520,8 @@ class Blockchain(Logger):
         parent = self.parent  # type: Optional[Blockchain]
         child_old_id = self.get_id()
         parent_old_id = parent.get_id()
+        my_hashes, parent_hashes = self._hashes, parent._hashes
+        self._hashes = parent._hashes = None
         # swap files
         # child takes parent's name
         # parent's new name will be something new (not child's old name)
@@ -402,6 +546,11 @@ class Blockchain(Logger):
         os.replace(child_old_name, parent.path())
         self.update_size()
         parent.update_size()
+        # the hash indexes follow the headers
+        if my_hashes is not None and parent_hashes is not None:
+            delta = (forkpoint - self.forkpoint) * 32
+            self._hashes = parent_hashes[:delta] + my_hashes
+            parent._hashes = parent_hashes[delta:]
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
@@ -422,15 +571,112 @@ class Blockchain(Logger):
 
     @with_lock
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+        """Writes data at offset. Appends are only fsync'ed once enough of them
+        are pending (group commit); anything that changes existing headers
+        is fsync'ed right away, together with the pending appends."""
         filename = self.path()
         self.assert_headers_file_available(filename)
+        is_append = offset == self._size * HEADER_SIZE
+        if not is_append:
+            # on some platforms a mapped file cannot be truncated
+            self.close_file()
         with open(filename, 'rb+') as f:
-            if truncate and offset != self._size * HEADER_SIZE:
+            if truncate and not is_append:
                 f.seek(offset)
                 f.truncate()
             f.seek(offset)
             f.write(data)
             f.flush()
+            self._unsynced_headers += len(data) // HEADER_SIZE
+            if (not self._group_commit or not is_append
+                    or self._unsynced_headers >= HEADER_FSYNC_MAX_PENDING
+                    or time.monotonic() - self._last_fsync >= HEADER_FSYNC_INTERVAL):
+                self._fsync(f)
+        if self._unsynced_headers and self._sync_timer is None:
+            # no more headers might come for a while
+            self._schedule_sync()
+        hashes = self._hashes
+        if is_append:
+            # keep the mapping; reads past its end map the file again
+            self._size += len(data) // HEADER_SIZE
+        else:
+            self.update_size()
+        # keep the hash index, except for what was overwritten
+        if hashes is not None:
+            start = offset // HEADER_SIZE * 32
+            end = start + len(data) // HEADER_SIZE * 32
+            if truncate:
+                del hashes[start:]
+            hashes[start:end] = bytes(end - start)
+            del hashes[self._size * 32:]
+            hashes.extend(bytes(self._size * 32 - len(hashes)))
+            self._hashes = hashes
+
+    def _fsync(self, f) -> None:
+        os.fsync(f.fileno())
+        self._unsynced_headers = 0
+        self._last_fsync = time.monotonic()
+
+    def _schedule_sync(self) -> None:
+        """fsync the pending appends at most HEADER_FSYNC_INTERVAL after the last fsync."""
+        delay = max(0, HEADER_FSYNC_INTERVAL - (time.monotonic() - self._last_fsync))
+        self._sync_timer = threading.Timer(delay, self._on_sync_timer)
+        self._sync_timer.daemon = True
+        self._sync_timer.start()
+
+    def _on_sync_timer(self) -> None:
+        with self.lock:
+            self._sync_timer = None
+            self.sync()
+
+    @with_lock
+    def sync(self) -> None:
+        """fsync headers that were appended but not synced yet. Called on shutdown."""
+        if not self._unsynced_headers:
+            return
+        filename = self.path()
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb+') as f:
+            self._fsync(f)
+
+    @with_lock
+    def _truncate_torn_headers(self) -> None:
+        """Because of group commit, a crash can leave the file ending in a
+        partially written header, or in zeroes or garbage where the OS did not
+        get to write the data. Checks the part that might not have been
+        fsync'ed and truncates the file at the first header that is not there
+        or does not link to the previous one."""
+        filename = self.path()
+        if not os.path.exists(filename):
+            return
+        file_size = os.path.getsize(filename)
+        # the checkpoint region of the main chain is sparse, don't look at it
+        first = max(self._size - HEADER_FSYNC_MAX_PENDING, constants.net.max_checkpoint() + 1 - self.forkpoint, 0)
+        good = first
+        if first < self._size:
+            try:
+                prev_hash = bfh(self.get_hash(self.forkpoint + first - 1))[::-1]
+            except MissingHeader:
+                prev_hash = None
+            data = self.read_raw_headers(self.forkpoint + first, self._size - first)
+            for i in range(len(data) // HEADER_SIZE):
+                raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
+                if raw_header == bytes(HEADER_SIZE):
+                    break
+                if prev_hash is not None and raw_header[4:36] != prev_hash:
+                    break
+                prev_hash = sha256d(raw_header)
+                good += 1
+        else:
+            good = self._size
+        if good * HEADER_SIZE == file_size:
+            return
+        self.logger.info(f"truncating torn headers file {filename} to {good} headers (was {file_size} bytes)")
+        self.close_file()
+        with open(filename, 'rb+') as f:
+            f.truncate(good * HEADER_SIZE)
+            f.flush()
             os.fsync(f.fileno())
         self.update_size()
 
@@ -452,42 +698,55 @@ class Blockchain(Logger):
             return self.parent.read_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        h = self._read_raw_header(height)
         if h == bytes([0])*HEADER_SIZE:
             return None
         return deserialize_header(h, height)
 
+    @with_lock
+    def read_raw_headers(self, height: int, count: int) -> bytes:
+        """Returns the serialized headers from height on, as stored;
+        at most count of them, fewer if the chain is shorter.
+        Missing headers in the checkpoint region are zeroes."""
+        if height < 0 or count <= 0:
+            return b''
+        if height < self.forkpoint:
+            n = min(count, self.forkpoint - height)
+            data = self.parent.read_raw_headers(height, n)
+            if len(data) < n * HEADER_SIZE:
+                return data
+            return data + self.read_raw_headers(self.forkpoint, count - n)
+        count = min(count, self.height() - height + 1)
+        if count <= 0:
+            return b''
+        delta = height - self.forkpoint
+        return self._get_mmap((delta + count) * HEADER_SIZE)[delta * HEADER_SIZE:(delta + count) * HEADER_SIZE]
+
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
         height = self.height()
         return self.read_header(height)
 
-    def get_hash(self, height: int) -> str:
-        def is_height_checkpoint():
-            within_cp_range = height <= constants.net.max_checkpoint()
-            at_chunk_boundary = (height+1) % 2016 == 0
-            return within_cp_range and at_chunk_boundary
+    @classmethod
+    def _is_checkpoint_height(cls, height: int) -> bool:
+        within_cp_range = height <= constants.net.max_checkpoint()
+        at_chunk_boundary = (height+1) % 2016 == 0
+        return within_cp_range and at_chunk_boundary
 
+    def get_hash(self, height: int) -> str:
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
         elif height == 0:
             return constants.net.GENESIS
-        elif is_height_checkpoint():
+        elif self._is_checkpoint_height(height):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            h = self._get_header_hash(height)
+            if h is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return hash_encode(h)
 
     def get_target(self, index: int) -> int:
         # compute target from chunk x, used in chunk x+1
@@ -542,32 +801,46 @@ class Blockchain(Logger):
         work = ((2 ** 256 - target - 1) // (target + 1)) + 1
         return work
 
-    @with_lock
     def get_chainwork(self, height=None) -> int:
+        chainwork, cache_updated = self._get_chainwork(height)
+        if cache_updated:
+            # outside of self.lock, so that disk I/O does not hold up the chain
+            write_chainwork_cache(self.config)
+        return chainwork
+
+    @with_lock
+    def _get_chainwork(self, height) -> Tuple[int, bool]:
+        """Returns the chainwork, and whether new entries were added to the cache."""
         if height is None:
             height = max(0, self.height())
         if constants.net.TESTNET:
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
-            return height
+            return height, False
         last_retarget = height // 2016 * 2016 - 1
         cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
-                break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
+        with _chainwork_cache_lock:
+            while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
+                if cached_height <= -1:
+                    break
+                cached_height -= 2016
+            assert cached_height >= -1, cached_height
+            running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
+        new_entries = []
         while cached_height < last_retarget:
             cached_height += 2016
             work_in_single_header = self.chainwork_of_header_at_height(cached_height)
             work_in_chunk = 2016 * work_in_single_header
             running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
+            new_entries.append((self.get_hash(cached_height), cached_height, running_total))
+        with _chainwork_cache_lock:
+            for block_hash, block_height, work in new_entries:
+                _CHAINWORK_CACHE[block_hash] = work
+                _CHAINWORK_CACHE_HEIGHTS[block_hash] = block_height
         cached_height += 2016
         work_in_single_header = self.chainwork_of_header_at_height(cached_height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
-        return running_total + work_in_last_partial_chunk
+        return running_total + work_in_last_partial_chunk, bool(new_entries)
 
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
@@ -26,6 +26,7 @@
 import sys
 import datetime
 import copy
+import itertools
 import argparse
 import json
 import ast
@@ -35,7 +36,7 @@ from decimal import Decimal
 from typing import Optional, TYPE_CHECKING
 
 from .import util, ecc
-from .util import bfh, bh2u, format_satoshis, json_decode, json_encode, is_hash256_str, is_hex_str, to_bytes
+from .util import bfh, bh2u, format_satoshis, json_decode, json_encode, ndjson_encode, is_hash256_str, is_hex_str, to_bytes
 from . import bitcoin
 from .bitcoin import is_address,  hash_160, COIN, TYPE_ADDRESS
 from .bip32 import BIP32Node
@@ -44,6 +45,7 @@ from .transaction import Transaction, multisig_script, TxOutput
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .synchronizer import Notifier
 from .wallet import Abstract_Wallet, create_new_wallet, restore_wallet_from_text
+from .storage import WalletStorage
 from .address_synchronizer import TX_HEIGHT_LOCAL
 
 if TYPE_CHECKING:
@@ -133,7 +135,7 @@ class Commands:
         return ' '.join(sorted(known_commands.keys()))
 
     @command('')
-    def create(self, passphrase=None, password=None, encrypt_file=True, segwit=False):
+    def create(self, passphrase=None, password=None, encrypt_file=True, segwit=False, db_type='json'):
         """Create a new wallet.
         If you want to be prompted for an argument, type '?' or ':' (concealed)
         """
@@ -141,7 +143,8 @@ class Commands:
                               passphrase=passphrase,
                               password=password,
                               encrypt_file=encrypt_file,
-                              segwit=segwit)
+                              segwit=segwit,
+                              db_type=db_type)
         return {
             'seed': d['seed'],
             'path': d['wallet'].storage.path,
@@ -149,7 +152,7 @@ class Commands:
         }
 
     @command('')
-    def restore(self, text, passphrase=None, password=None, encrypt_file=True):
+    def restore(self, text, passphrase=None, password=None, encrypt_file=True, db_type='json'):
         """Restore a wallet from text. Text can be a seed phrase, a master
         public key, a master private key, a list of bitcoin addresses
         or bitcoin private keys.
@@ -160,12 +163,27 @@ class Commands:
                                      passphrase=passphrase,
                                      password=password,
                                      encrypt_file=encrypt_file,
-                                     network=self.network)
+                                     network=self.network,
+                                     db_type=db_type)
         return {
             'path': d['wallet'].storage.path,
             'msg': d['msg'],
         }
 
+    @command('')
+    def convert_to_sqlite(self):
+        """Convert a json wallet file to the sqlite backend. The wallet must
+        not be loaded, and its file must not be encrypted. The original file
+        is kept, with '.json' appended to its name."""
+        storage = WalletStorage(self.config.get_wallet_path(), manual_upgrades=True)
+        if not storage.file_exists():
+            raise Exception("Wallet file not found.")
+        backup_path = storage.convert_to_sqlite()
+        return {
+            'path': storage.path,
+            'backup': backup_path,
+        }
+
     @command('wp')
     def password(self, password=None, new_password=None):
         """Change wallet password. """
@@ -285,7 +303,9 @@ class Commands:
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
         tx = Transaction(tx)
-        return tx.deserialize(force_full_parse=True)
+        d = tx.deserialize(force_full_parse=True)
+        d['inputs'] = [dict(txin.items()) for txin in d['inputs']]
+        return d
 
     @command('n')
     def broadcast(self, tx):
@@ -493,13 +513,15 @@ class Commands:
 
     @command('w')
     def history(self, year=None, show_addresses=False, show_fiat=False, show_fees=False,
-                from_height=None, to_height=None):
+                from_height=None, to_height=None, limit=None, cursor=None, ndjson=False):
         """Wallet history. Returns the transaction history of your wallet."""
         kwargs = {
             'show_addresses': show_addresses,
             'show_fees': show_fees,
             'from_height': from_height,
             'to_height': to_height,
+            'limit': limit,
+            'cursor': cursor,
         }
         if year:
             import time
@@ -511,6 +533,12 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
+        if ndjson:
+            del kwargs['limit']
+            items = self.wallet.iter_full_history(**kwargs)
+            if limit is not None:
+                items = itertools.islice(items, limit)
+            return ndjson_encode(items)
         return json_encode(self.wallet.get_full_history(**kwargs))
 
     @command('w')
@@ -539,9 +567,15 @@ class Commands:
         return results
 
     @command('w')
-    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False):
+    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False,
+                      ndjson=False):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
-        out = []
+        items = self._iter_addresses(receiving, change, labels, frozen, unused, funded, balance)
+        if ndjson:
+            return ndjson_encode(items)
+        return list(items)
+
+    def _iter_addresses(self, receiving, change, labels, frozen, unused, funded, balance):
         for addr in self.wallet.get_addresses():
             if frozen and not self.wallet.is_frozen_address(addr):
                 continue
@@ -560,8 +594,7 @@ class Commands:
                 item += (format_satoshis(sum(self.wallet.get_addr_balance(addr))),)
             if labels:
                 item += (repr(self.wallet.labels.get(addr, '')),)
-            out.append(item)
-        return out
+            yield item
 
     @command('n')
     def gettransaction(self, txid):
@@ -754,7 +787,7 @@ class Commands:
         """
         if not is_hash256_str(txid):
             raise Exception(f"{repr(txid)} is not a txid")
-        if not self.wallet.db.get_transaction(txid):
+        if not self.wallet.db.has_transaction(txid):
             raise Exception("Transaction not in wallet.")
         return {
             "confirmations": self.wallet.get_tx_height(txid).conf,
@@ -798,6 +831,7 @@ command_options = {
     'password':    ("-W", "Password"),
     'new_password':(None, "New Password"),
     'encrypt_file':(None, "Whether the file on disk should be encrypted with the provided password"),
+    'db_type':     (None, "Wallet file backend: 'json' (default) or 'sqlite'. sqlite files cannot be encrypted"),
     'receiving':   (None, "Show only receiving addresses"),
     'change':      (None, "Show only change addresses"),
     'frozen':      (None, "Show only frozen addresses"),
@@ -834,6 +868,9 @@ command_options = {
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
     'from_height': (None, "Only show transactions that confirmed after given block height"),
     'to_height':   (None, "Only show transactions that confirmed before given block height"),
+    'limit':       (None, "Maximum number of transactions to show"),
+    'ndjson':      (None, "Stream the results as newline-delimited JSON, one item per line"),
+    'cursor':      (None, "Only show transactions after this cursor, as returned in next_cursor"),
 }
 
 
@@ -847,6 +884,7 @@ arg_types = {
     'year': int,
     'from_height': int,
     'to_height': int,
+    'limit': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
     'jsontx': json_loads,
@@ -51,6 +51,9 @@ class Contacts(dict, Logger):
     def save(self):
         self.storage.put('contacts', dict(self))
 
+    def _save_item(self, key):
+        self.storage.put_item('contacts', key, self.get(key))
+
     def import_file(self, path):
         import_meta(path, self._validate, self.load_meta)
 
@@ -63,12 +66,12 @@ class Contacts(dict, Logger):
 
     def __setitem__(self, key, value):
         dict.__setitem__(self, key, value)
-        self.save()
+        self._save_item(key)
 
     def pop(self, key):
         if key in self.keys():
             res = dict.pop(self, key)
-            self.save()
+            self._save_item(key)
             return res
 
     def resolve(self, k):
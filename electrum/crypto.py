@@ -91,6 +91,76 @@ def aes_decrypt_with_iv(key: bytes, iv: bytes, data: bytes) -> bytes:
         raise InvalidPassword()
 
 
+class AESCBCStreamEncrypter:
+    """Incremental version of aes_encrypt_with_iv.
+    feed() returns the ciphertext available so far; finish() pads and
+    returns the rest."""
+
+    def __init__(self, key: bytes, iv: bytes):
+        assert_bytes(key, iv)
+        self._buf = b''
+        if AES:
+            self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        else:
+            self._aes = pyaes.Encrypter(pyaes.AESModeOfOperationCBC(key, iv=iv), padding=pyaes.PADDING_NONE)
+
+    def _encrypt(self, data: bytes) -> bytes:
+        if AES:
+            return self._cipher.encrypt(data)
+        return self._aes.feed(data)
+
+    def feed(self, data: bytes) -> bytes:
+        assert_bytes(data)
+        data = self._buf + data
+        n = len(data) - len(data) % 16
+        self._buf = data[n:]
+        return self._encrypt(data[:n])
+
+    def finish(self) -> bytes:
+        e = self._encrypt(append_PKCS7_padding(self._buf))
+        if not AES:
+            e += self._aes.feed()  # empty aes.feed() flushes buffer
+        self._buf = b''
+        return e
+
+
+class AESCBCStreamDecrypter:
+    """Incremental version of aes_decrypt_with_iv.
+    The last block is held back until finish(), which strips the padding."""
+
+    def __init__(self, key: bytes, iv: bytes):
+        assert_bytes(key, iv)
+        self._buf = b''
+        if AES:
+            self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        else:
+            self._aes = pyaes.Decrypter(pyaes.AESModeOfOperationCBC(key, iv=iv), padding=pyaes.PADDING_NONE)
+
+    def _decrypt(self, data: bytes) -> bytes:
+        if AES:
+            return self._cipher.decrypt(data)
+        return self._aes.feed(data)
+
+    def feed(self, data: bytes) -> bytes:
+        assert_bytes(data)
+        data = self._buf + data
+        n = max(0, len(data) - len(data) % 16 - 16)
+        self._buf = data[n:]
+        return self._decrypt(data[:n])
+
+    def finish(self) -> bytes:
+        if len(self._buf) != 16:
+            raise InvalidPassword()
+        data = self._decrypt(self._buf)
+        if not AES:
+            data += self._aes.feed()  # empty aes.feed() flushes buffer
+        self._buf = b''
+        try:
+            return strip_PKCS7_padding(data)
+        except InvalidPadding:
+            raise InvalidPassword()
+
+
 def EncodeAES_base64(secret: bytes, msg: bytes) -> bytes:
     """Returns base64 encoded ciphertext."""
     e = EncodeAES_bytes(secret, msg)
@@ -24,22 +24,28 @@
 # SOFTWARE.
 import asyncio
 import ast
+import itertools
 import os
 import time
 import traceback
 import sys
 import threading
+import types
+from functools import wraps
 from typing import Dict, Optional, Tuple
+from collections import OrderedDict
 
 import jsonrpclib
 
 from .jsonrpc import VerifyingJSONRPCServer
 from .version import ELECTRUM_VERSION
 from .network import Network
-from .util import (json_decode, DaemonThread, to_string,
+from .util import (json_decode, DaemonThread, to_string, bh2u,
                    create_and_start_event_loop, profiler, standardize_path)
 from .wallet import Wallet, Abstract_Wallet
-from .storage import WalletStorage
+from .storage import WalletStorage, JOURNAL_SUFFIX, DEFAULT_WRITE_DELAY
+from .json_db import DEFAULT_TX_CACHE_SIZE
+from .spv_cache import SPVProofCache, wallet_key
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
@@ -54,6 +60,70 @@ def get_lockfile(config: SimpleConfig):
     return os.path.join(config.path, 'daemon')
 
 
+# number of lines of a streamed result sent in one JSON-RPC response
+STREAM_CHUNK_LINES = 1000
+# streams that the client did not read to the end are dropped, oldest first
+MAX_OPEN_STREAMS = 16
+
+
+class StreamedResults:
+    """Streamed (ndjson) command results over JSON-RPC.
+
+    JSON-RPC is request/response, so a streamed result is sent in chunks:
+    the response to the command holds the first chunk of lines and a
+    stream_id, and the client calls stream_next(stream_id) until 'done'
+    is set. Only one chunk is held in memory at a time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = OrderedDict()  # stream_id -> generator
+
+    def start(self, result):
+        if not isinstance(result, types.GeneratorType):
+            return result
+        stream_id = bh2u(os.urandom(16))
+        with self.lock:
+            self.streams[stream_id] = result
+            while len(self.streams) > MAX_OPEN_STREAMS:
+                _, gen = self.streams.popitem(last=False)
+                gen.close()
+        return self.next(stream_id)
+
+    def next(self, stream_id: str) -> dict:
+        with self.lock:
+            gen = self.streams.get(stream_id)
+        if gen is None:
+            return {'error': f'unknown stream: {stream_id}'}
+        try:
+            lines = list(itertools.islice(gen, STREAM_CHUNK_LINES))
+        except BaseException:
+            with self.lock:
+                self.streams.pop(stream_id, None)
+            raise
+        done = len(lines) < STREAM_CHUNK_LINES
+        if done:
+            with self.lock:
+                self.streams.pop(stream_id, None)
+        return {'stream_id': stream_id, 'lines': lines, 'done': done}
+
+
+def iter_streamed_result(server: jsonrpclib.Server, result):
+    """Client side of StreamedResults: yields the lines of a streamed
+    result, fetching the chunks as they are consumed."""
+    while True:
+        if result.get('error'):
+            raise Exception(result['error'])
+        yield from result['lines']
+        if result['done']:
+            return
+        result = server.stream_next(result['stream_id'])
+
+
+def is_streamed_result(result) -> bool:
+    return isinstance(result, dict) and 'stream_id' in result
+
+
 def remove_lockfile(lockfile):
     os.unlink(lockfile)
 
@@ -143,6 +213,7 @@ class Daemon(DaemonThread):
         self.gui = None
         # path -> wallet;   make sure path is standardized.
         self.wallets = {}  # type: Dict[str, Abstract_Wallet]
+        self.streamed_results = StreamedResults()
         # Setup JSONRPC server
         self.server = None
         if listen_jsonrpc:
@@ -170,8 +241,15 @@ class Daemon(DaemonThread):
         server.register_function(self.run_daemon, 'daemon')
         self.cmd_runner = Commands(self.config, None, self.network)
         for cmdname in known_commands:
-            server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+            server.register_function(self._rpc_command(getattr(self.cmd_runner, cmdname)), cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
+        server.register_function(self.streamed_results.next, 'stream_next')
+
+    def _rpc_command(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.streamed_results.start(func(*args, **kwargs))
+        return wrapper
 
     def ping(self):
         return True
@@ -258,6 +336,8 @@ class Daemon(DaemonThread):
             return
         if storage.get_action():
             return
+        storage.db.set_tx_cache_size(self.config.get('wallet_tx_cache_size', DEFAULT_TX_CACHE_SIZE))
+        storage.write_delay = self.config.get('wallet_write_delay', DEFAULT_WRITE_DELAY)
         wallet = Wallet(storage)
         wallet.start_network(self.network)
         self.wallets[path] = wallet
@@ -276,9 +356,21 @@ class Daemon(DaemonThread):
         self.stop_wallet(path)
         if os.path.exists(path):
             os.unlink(path)
+            if os.path.exists(path + JOURNAL_SUFFIX):
+                os.unlink(path + JOURNAL_SUFFIX)
+            self._remove_spv_proofs(path)
             return True
         return False
 
+    def _remove_spv_proofs(self, path):
+        if self.network:
+            cache = self.network.spv_proof_cache
+        else:
+            cache_path = os.path.join(self.config.path, 'spv_proofs')
+            cache = SPVProofCache(cache_path) if os.path.exists(cache_path) else None
+        if cache:
+            cache.remove_wallet(wallet_key(standardize_path(path)))
+
     def stop_wallet(self, path):
         path = standardize_path(path)
         wallet = self.wallets.pop(path, None)
@@ -317,7 +409,7 @@ class Daemon(DaemonThread):
             result = func(*args, **kwargs)
         except TypeError as e:
             raise Exception("Wrapping TypeError to prevent JSONRPC-Pelix from hiding traceback") from e
-        return result
+        return self.streamed_results.start(result)
 
     def run(self):
         while self.is_running():
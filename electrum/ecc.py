@@ -25,7 +25,8 @@
 
 import base64
 import hashlib
-from typing import Union, Tuple
+import hmac
+from typing import Union, Tuple, Iterable, Iterator
 
 import ecdsa
 from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
@@ -34,7 +35,8 @@ from ecdsa.ellipticcurve import Point
 from ecdsa.util import string_to_number, number_to_string
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler
-from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
+from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot,
+                     AESCBCStreamEncrypter, AESCBCStreamDecrypter)
 from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
 from . import msqr
 from . import constants
@@ -280,18 +282,42 @@ class ECPubkey(object):
         """
         assert_bytes(message)
 
+        ephemeral_pubkey, iv, key_e, key_m = self._ecies_encryption_keys()
+        ciphertext = aes_encrypt_with_iv(key_e, iv, message)
+        encrypted = magic + ephemeral_pubkey + ciphertext
+        mac = hmac_oneshot(key_m, encrypted, hashlib.sha256)
+
+        return base64.b64encode(encrypted + mac)
+
+    def encrypt_message_stream(self, chunks: Iterable[bytes], magic: bytes = b'BIE1') -> Iterator[bytes]:
+        """Same as encrypt_message, but consumes the message in chunks and
+        yields the base64 encoded output in pieces, so that neither has to
+        be held in memory at once."""
+        ephemeral_pubkey, iv, key_e, key_m = self._ecies_encryption_keys()
+        header = magic + ephemeral_pubkey
+        mac = hmac.new(key_m, header, hashlib.sha256)
+        b64 = _Base64StreamEncoder()
+        yield b64.feed(header)
+        aes = AESCBCStreamEncrypter(key_e, iv)
+        for chunk in chunks:
+            c = aes.feed(chunk)
+            mac.update(c)
+            yield b64.feed(c)
+        c = aes.finish()
+        mac.update(c)
+        yield b64.feed(c)
+        yield b64.feed(mac.digest())
+        yield b64.finish()
+
+    def _ecies_encryption_keys(self):
         randint = ecdsa.util.randrange(CURVE_ORDER)
         ephemeral_exponent = number_to_string(randint, CURVE_ORDER)
         ephemeral = ECPrivkey(ephemeral_exponent)
         ecdh_key = (self * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
-        ciphertext = aes_encrypt_with_iv(key_e, iv, message)
         ephemeral_pubkey = ephemeral.get_public_key_bytes(compressed=True)
-        encrypted = magic + ephemeral_pubkey + ciphertext
-        mac = hmac_oneshot(key_m, encrypted, hashlib.sha256)
-
-        return base64.b64encode(encrypted + mac)
+        return ephemeral_pubkey, iv, key_e, key_m
 
     @classmethod
     def order(cls):
@@ -309,6 +335,24 @@ class ECPubkey(object):
             return False
 
 
+class _Base64StreamEncoder:
+    """Incremental base64.b64encode"""
+
+    def __init__(self):
+        self._buf = b''
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._buf + data
+        n = len(data) - len(data) % 3
+        self._buf = data[n:]
+        return base64.b64encode(data[:n])
+
+    def finish(self) -> bytes:
+        e = base64.b64encode(self._buf)
+        self._buf = b''
+        return e
+
+
 def msg_magic(message: bytes) -> bytes:
     from .bitcoin import var_int
     length = bfh(var_int(len(message)))
@@ -433,6 +477,50 @@ class ECPrivkey(ECPubkey):
         mac = encrypted[-32:]
         if magic_found != magic:
             raise Exception('invalid ciphertext: invalid magic bytes')
+        iv, key_e, key_m = self._ecies_decryption_keys(ephemeral_pubkey_bytes)
+        if mac != hmac_oneshot(key_m, encrypted[:-32], hashlib.sha256):
+            raise InvalidPassword()
+        return aes_decrypt_with_iv(key_e, iv, ciphertext)
+
+    def decrypt_message_stream(self, encrypted: Union[str, bytes], magic: bytes = b'BIE1',
+                               *, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+        """Same as decrypt_message, but yields the plaintext in chunks,
+        decoding the base64 input piece by piece. The mac is checked over
+        the whole input before any plaintext is returned."""
+        encrypted = encrypted.strip()
+        if len(encrypted) % 4 != 0:
+            raise Exception('invalid ciphertext: base64 length')
+        chunk_size = max(4, chunk_size - chunk_size % 4)
+        padding = len(encrypted) - len(encrypted.rstrip(b'=' if isinstance(encrypted, bytes) else '='))
+        size = len(encrypted) // 4 * 3 - padding
+        if size < 85:
+            raise Exception('invalid ciphertext: length')
+
+        def decoded_range(start, end):
+            # yields the decoded bytes in [start, end)
+            decoded_chunk_size = chunk_size // 4 * 3
+            for i in range(start // decoded_chunk_size * chunk_size, len(encrypted), chunk_size):
+                offset = i // 4 * 3
+                if offset >= end:
+                    break
+                data = base64.b64decode(encrypted[i:i+chunk_size])
+                yield data[max(0, start - offset):end - offset]
+
+        header = b''.join(decoded_range(0, 37))
+        if header[:4] != magic:
+            raise Exception('invalid ciphertext: invalid magic bytes')
+        iv, key_e, key_m = self._ecies_decryption_keys(header[4:37])
+        mac = hmac.new(key_m, digestmod=hashlib.sha256)
+        for data in decoded_range(0, size - 32):
+            mac.update(data)
+        if b''.join(decoded_range(size - 32, size)) != mac.digest():
+            raise InvalidPassword()
+        aes = AESCBCStreamDecrypter(key_e, iv)
+        for data in decoded_range(37, size - 32):
+            yield aes.feed(data)
+        yield aes.finish()
+
+    def _ecies_decryption_keys(self, ephemeral_pubkey_bytes: bytes):
         try:
             ecdsa_point = _ser_to_python_ecdsa_point(ephemeral_pubkey_bytes)
         except AssertionError as e:
@@ -443,9 +531,7 @@ class ECPrivkey(ECPubkey):
         ecdh_key = (ephemeral_pubkey * self.secret_scalar).get_public_key_bytes(compressed=True)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
-        if mac != hmac_oneshot(key_m, encrypted[:-32], hashlib.sha256):
-            raise InvalidPassword()
-        return aes_decrypt_with_iv(key_e, iv, ciphertext)
+        return iv, key_e, key_m
 
 
 def construct_sig65(sig_string: bytes, recid: int, is_compressed: bool) -> bytes:
@@ -1055,7 +1055,7 @@ class ElectrumWindow(App):
                 self.show_error("Invalid PIN")
                 return
         self.stop_wallet()
-        os.unlink(wallet_path)
+        self.daemon.delete_wallet(wallet_path)
         self.show_error(_("Wallet removed: {}").format(basename))
         new_path = self.electrum_config.get_wallet_path()
         self.load_wallet_by_name(new_path)
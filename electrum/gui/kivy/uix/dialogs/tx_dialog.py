@@ -257,7 +257,7 @@ class TxDialog(Factory.Popup):
             if b:
                 for tx in to_delete:
                     self.wallet.remove_transaction(tx)
-                self.wallet.storage.write()
+                self.wallet.storage.schedule_write()
                 self.app._trigger_update_wallet()  # FIXME private...
                 self.dismiss()
         d = Question(question, on_prompt)
@@ -623,7 +623,7 @@ class HistoryList(MyTreeView, AcceptFileDragDrop):
             return
         for tx in to_delete:
             self.wallet.remove_transaction(tx)
-        self.wallet.storage.write()
+        self.wallet.storage.schedule_write()
         # need to update at least: history_list, utxo_list, address_list
         self.parent.need_update.set()
 
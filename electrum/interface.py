@@ -29,7 +29,7 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Sequence
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address
 import itertools
@@ -61,6 +61,9 @@ ca_path = certifi.where()
 
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
+# during catch-up, this many header chunks are downloaded ahead of the one being verified
+CHUNK_PREFETCH_DEPTH = 4
+
 
 class NetworkTimeout:
     # seconds
@@ -119,6 +122,27 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_request_batch(self, requests: Sequence[Tuple[str, list]], *, timeout=None) -> list:
+        """Sends (method, params) requests as a single JSON-RPC batch.
+        Returns the results in the same order. If the server answered a
+        request with an error, its result is the exception (not raised)."""
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(requests)} requests (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch(raise_errors=False) as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+            return batch.results
+
+        try:
+            results = await asyncio.wait_for(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'request timed out: batch of {len(requests)} requests (id: {msg_id})') from e
+        else:
+            self.maybe_log(f"--> {results} (id: {msg_id})")
+            return list(results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -135,6 +159,27 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Same as subscribe, for several params at once. The ones that
+        are not cached yet are requested from the server in a single batch."""
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        to_request = [(params, key) for params, key in zip(params_list, keys) if key not in self.cache]
+        error = None
+        if to_request:
+            results = await self.send_request_batch([(method, params) for params, key in to_request])
+            for (params, key), result in zip(to_request, results):
+                if isinstance(result, Exception):
+                    error = error or result
+                else:
+                    self.cache[key] = result
+        for params, key in zip(params_list, keys):
+            if key in self.cache:
+                await queue.put(params + [self.cache[key]])
+        if error is not None:
+            raise error
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -412,18 +457,63 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
+        res = await self._fetch_chunk(index, tip)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def _fetch_chunk(self, index, tip=None) -> dict:
         size = 2016
         if tip is not None:
             size = min(size, tip - index * 2016 + 1)
             size = max(size, 0)
         try:
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+            return await self.session.send_request('blockchain.block.headers', [index * 2016, size])
         finally:
             try: self._requested_chunks.remove(index)
             except KeyError: pass
+
+    async def _fetch_chunk_from_any_interface(self, index, tip) -> Tuple['Interface', dict]:
+        """Fetches a chunk, if possible from one of the other interfaces,
+        so that the download is spread among servers."""
+        interfaces = [self]
+        if self.network.config.get('header_sync_multi_interface', True):
+            interfaces += [i for i in self.network.interfaces.values()
+                           if i is not self and i.session is not None
+                           and i.ready.done() and not i.ready.cancelled() and i.tip >= tip]
+        interface = interfaces[index % len(interfaces)]
+        if interface is not self:
+            try:
+                return interface, await interface._fetch_chunk(index, tip)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.info(f"failed to get chunk {index} from {interface.server}: {repr(e)}")
+        return self, await self._fetch_chunk(index, tip)
+
+    async def _request_chunk_pipelined(self, height, tip, prefetched: dict):
+        """Like request_chunk, but also starts downloading the next few chunks
+        up to tip, so that they arrive while this one is being verified.
+        prefetched maps chunk index -> download task; the caller cancels
+        whatever is left in it."""
+        index = height // 2016
+        for i in range(index, min(index + CHUNK_PREFETCH_DEPTH, tip // 2016 + 1)):
+            if i not in prefetched:
+                prefetched[i] = asyncio.ensure_future(self._fetch_chunk_from_any_interface(i, tip))
+        self.logger.info(f"requesting chunk from height {height}")
+        interface, res = await prefetched.pop(index)
         conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn and interface is not self:
+            # the other server might be on another chain; ask ours
+            res = await self._fetch_chunk(index, tip)
+            conn = self.blockchain.connect_chunk(index, res['hex'])
         if not conn:
+            # chunks after this one are of no use now
+            for task in prefetched.values():
+                task.cancel()
+            prefetched.clear()
             return conn, 0
         return conn, res['count']
 
@@ -509,22 +599,27 @@ class Interface(Logger):
         if next_height is None:
             next_height = self.tip
         last = None
-        while last is None or height <= next_height:
-            prev_last, prev_height = last, height
-            if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
-                if not could_connect:
-                    if height <= constants.net.max_checkpoint():
-                        raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+        prefetched = {}  # chunk index -> download task
+        try:
+            while last is None or height <= next_height:
+                prev_last, prev_height = last, height
+                if next_height > height + 10:
+                    could_connect, num_headers = await self._request_chunk_pipelined(height, next_height, prefetched)
+                    if not could_connect:
+                        if height <= constants.net.max_checkpoint():
+                            raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+                        last, height = await self.step(height)
+                        continue
+                    self.network.trigger_callback('network_updated')
+                    height = (height // 2016 * 2016) + num_headers
+                    assert height <= next_height+1, (height, self.tip)
+                    last = 'catchup'
+                else:
                     last, height = await self.step(height)
-                    continue
-                self.network.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
-                assert height <= next_height+1, (height, self.tip)
-                last = 'catchup'
-            else:
-                last, height = await self.step(height)
-            assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+                assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+        finally:
+            for task in prefetched.values():
+                task.cancel()
         return last, height
 
     async def step(self, height, header=None):
@@ -28,10 +28,11 @@ import json
 import copy
 import threading
 from collections import defaultdict
-from typing import Dict, Optional
+from collections.abc import Mapping, Sequence as SequenceABC
+from typing import Dict, Optional, List, Sequence
 
 from . import util, bitcoin
-from .util import profiler, WalletFileException, multisig_type, TxMinedInfo
+from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, LRUCache, bfh, bh2u
 from .keystore import bip44_derivation
 from .transaction import Transaction
 from .logging import Logger
@@ -43,25 +44,103 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+# number of deserialized Transaction objects kept in memory per wallet
+DEFAULT_TX_CACHE_SIZE = 1000
+
+
+def _readonly_view(v):
+    if isinstance(v, dict):
+        return ReadOnlyDict(v)
+    if isinstance(v, list):
+        return ReadOnlyList(v)
+    return v
+
+
+class ReadOnlyDict(Mapping):
+    """Read-only view of a dict stored in the db, without copying it.
+    Nested dicts and lists are returned as views too.
+    Use copy() to get a private, mutable deep copy."""
+
+    def __init__(self, d: dict):
+        self._d = d
+
+    def __getitem__(self, key):
+        return _readonly_view(self._d[key])
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __eq__(self, other):
+        if isinstance(other, ReadOnlyDict):
+            other = other._d
+        return self._d == other
+
+    def __repr__(self):
+        return f"ReadOnlyDict({self._d!r})"
+
+    def copy(self) -> dict:
+        return copy.deepcopy(self._d)
+
+
+class ReadOnlyList(SequenceABC):
+    """Read-only view of a list stored in the db, see ReadOnlyDict."""
+
+    def __init__(self, l: list):
+        self._l = l
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ReadOnlyList(self._l[i])
+        return _readonly_view(self._l[i])
+
+    def __len__(self):
+        return len(self._l)
+
+    def __eq__(self, other):
+        if isinstance(other, ReadOnlyList):
+            other = other._l
+        return self._l == other
+
+    def __repr__(self):
+        return f"ReadOnlyList({self._l!r})"
+
+    def copy(self) -> list:
+        return copy.deepcopy(self._l)
+
 
 class JsonDBJsonEncoder(util.MyEncoder):
     def default(self, obj):
         if isinstance(obj, Transaction):
             return str(obj)
+        if isinstance(obj, bytes):
+            return bh2u(obj)
+        if isinstance(obj, (ReadOnlyDict, ReadOnlyList)):
+            return obj.copy()
         return super().default(obj)
 
 
 class JsonDB(Logger):
 
-    def __init__(self, raw, *, manual_upgrades):
+    def __init__(self, raw, *, manual_upgrades, journal: Sequence[str] = ()):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = {}
         self._modified = False
+        # Changes made since the last write, as journal entries.
+        # Each entry is a json list [op, path] or [op, path, value], see _journal.
+        self._pending_changes = []  # type: List[str]
+        self._full_write_needed = False
+        self._tx_cache = LRUCache(DEFAULT_TX_CACHE_SIZE)  # txid -> Transaction
         self.manual_upgrades = manual_upgrades
         self._called_load_transactions = False
         if raw:  # loading existing db
-            self.load_data(raw)
+            self.load_data(raw, journal=journal)
         else:  # creating new db
             self.put('seed_version', FINAL_SEED_VERSION)
             self.load_transactions()
@@ -69,10 +148,77 @@ class JsonDB(Logger):
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            # changes we were not told about cannot be journaled
+            self._full_write_needed = b
+            if not b:
+                self._pending_changes = []
 
     def modified(self):
         return self._modified
 
+    def needs_full_write(self):
+        return self._full_write_needed
+
+    def pop_pending_changes(self) -> str:
+        """Returns the changes since the last write as a single journal
+        line, and marks the db as not modified."""
+        with self.lock:
+            s = '[' + ','.join(self._pending_changes) + ']'
+            self.set_modified(False)
+            return s
+
+    def _journal(self, *path):
+        """Records the current value at 'path' in self.data (or its
+        absence) so that the change can be appended to the journal.
+        Entries are idempotent: replaying them more than once is harmless.
+        """
+        if self._full_write_needed:
+            return  # whole file will be rewritten anyway
+        d = self.data
+        try:
+            for k in path:
+                d = d[k]
+        except (KeyError, IndexError):
+            entry = ['del', path]
+        else:
+            entry = ['set', path, d]
+        self._pending_changes.append(json.dumps(entry, cls=JsonDBJsonEncoder))
+
+    def _apply_journal(self, journal: Sequence[str]):
+        """Replays journal lines onto self.data (raw json, before load_transactions)."""
+        for i, line in enumerate(journal):
+            try:
+                entries = json.loads(line)
+            except Exception:
+                # partially written trailing line; anything after it is unusable
+                self.logger.warning(f'cannot parse wallet journal line {i}, discarding rest')
+                self._full_write_needed = True
+                self._modified = True
+                return
+            for entry in entries:
+                op, path = entry[0], entry[1]
+                d = self.data
+                try:
+                    for k in path[:-1]:
+                        if op == 'set' and isinstance(d, dict) and k not in d:
+                            d[k] = {}
+                        d = d[k]
+                except (KeyError, IndexError):
+                    continue
+                key = path[-1]
+                if op == 'set':
+                    if isinstance(d, list) and key == len(d):
+                        d.append(entry[2])
+                    else:
+                        d[key] = entry[2]
+                elif op == 'del':
+                    if isinstance(d, dict):
+                        d.pop(key, None)
+                    elif key < len(d):
+                        d.pop(key)
+                else:
+                    raise WalletFileException(f'unexpected wallet journal op: {op}')
+
     def modifier(func):
         def wrapper(self, *args, **kwargs):
             with self.lock:
@@ -87,16 +233,24 @@ class JsonDB(Logger):
         return wrapper
 
     @locked
-    def get(self, key, default=None):
+    def get(self, key, default=None, *, readonly=False):
+        """Returns a private copy of the value stored at key.
+        If readonly is set, dicts and lists are returned as read-only
+        views instead, which avoids copying large values.
+        """
         v = self.data.get(key)
         if v is None:
             v = default
+        elif readonly:
+            v = _readonly_view(v)
         else:
             v = copy.deepcopy(v)
         return v
 
     @modifier
     def put(self, key, value):
+        if isinstance(value, (ReadOnlyDict, ReadOnlyList)):
+            value = value.copy()
         try:
             json.dumps(key, cls=JsonDBJsonEncoder)
             json.dumps(value, cls=JsonDBJsonEncoder)
@@ -106,6 +260,7 @@ class JsonDB(Logger):
         if value is not None:
             if self.data.get(key) != value:
                 self.data[key] = copy.deepcopy(value)
+                self._journal(key)
                 return True
         elif key in self.data:
             # clear current contents in case of references
@@ -115,9 +270,29 @@ class JsonDB(Logger):
                 clear_method()
             # pop from dict to delete key
             self.data.pop(key)
+            self._journal(key)
             return True
         return False
 
+    @modifier
+    def put_item(self, key, item_key, value):
+        """Sets the entry item_key of the dict stored at key, or removes it
+        if value is None. Unlike put, this does not compare, copy or
+        journal the whole dict."""
+        try:
+            json.dumps(value, cls=JsonDBJsonEncoder)
+        except:
+            self.logger.info(f"json error: cannot save {repr(key)}/{repr(item_key)} ({repr(value)})")
+            return False
+        d = self.data.setdefault(key, {})
+        if value is None:
+            if d.pop(item_key, None) is None:
+                return False
+        else:
+            d[item_key] = copy.deepcopy(value)
+        self._journal(key, item_key)
+        return True
+
     def commit(self):
         pass
 
@@ -125,7 +300,7 @@ class JsonDB(Logger):
     def dump(self):
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
 
-    def load_data(self, s):
+    def load_data(self, s, *, journal: Sequence[str] = ()):
         try:
             self.data = json.loads(s)
         except:
@@ -146,6 +321,8 @@ class JsonDB(Logger):
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
 
+        self._apply_journal(journal)
+
         if not self.manual_upgrades and self.requires_split():
             raise WalletFileException("This wallet has multiple accounts and must be split")
 
@@ -155,7 +332,7 @@ class JsonDB(Logger):
             self.upgrade()
 
     def requires_split(self):
-        d = self.get('accounts', {})
+        d = self.get('accounts', {}, readonly=True)
         return len(d) > 1
 
     def split_accounts(self):
@@ -204,6 +381,8 @@ class JsonDB(Logger):
     @profiler
     def upgrade(self):
         self.logger.info('upgrading wallet format')
+        # upgrades rewrite large parts of the file; do not journal them
+        self.set_modified(True)
         if not self._called_load_transactions:
             # note: not sure if this is how we should go about this...
             # alternatively, we could make sure load_transactions is always called after upgrade
@@ -415,9 +594,9 @@ class JsonDB(Logger):
 
         self.put('pruned_txo', None)
 
-        transactions = self.get('transactions', {})  # txid -> Transaction
         spent_outpoints = defaultdict(dict)
-        for txid, tx in transactions.items():
+        for txid in self.list_transactions():
+            tx = self.get_transaction(txid)
             for txin in tx.inputs():
                 if txin['type'] == 'coinbase':
                     continue
@@ -489,7 +668,7 @@ class JsonDB(Logger):
     def get_seed_version(self):
         seed_version = self.get('seed_version')
         if not seed_version:
-            seed_version = OLD_SEED_VERSION if len(self.get('master_public_key','')) == 128 else NEW_SEED_VERSION
+            seed_version = OLD_SEED_VERSION if len(self.get('master_public_key', '', readonly=True)) == 128 else NEW_SEED_VERSION
         if seed_version > FINAL_SEED_VERSION:
             raise WalletFileException('This version of Electrum is too old to open this wallet.\n'
                                       '(highest supported storage version: {}, version of this file: {})'
@@ -533,7 +712,7 @@ class JsonDB(Logger):
     def get_txo_addr(self, tx_hash, address):
         return self.txo.get(tx_hash, {}).get(address, [])
 
-    @modifier
+    @locked
     def add_txi_addr(self, tx_hash, addr, ser, v):
         if tx_hash not in self.txi:
             self.txi[tx_hash] = {}
@@ -541,9 +720,13 @@ class JsonDB(Logger):
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
+        if (ser, v) in d[addr]:
+            return  # known txs are added again on every history update
         d[addr].add((ser, v))
+        self._modified = True
+        self._journal('txi', tx_hash, addr)
 
-    @modifier
+    @locked
     def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
         if tx_hash not in self.txo:
             self.txo[tx_hash] = {}
@@ -551,7 +734,11 @@ class JsonDB(Logger):
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
+        if (n, v, is_coinbase) in d[addr]:
+            return
         d[addr].add((n, v, is_coinbase))
+        self._modified = True
+        self._journal('txo', tx_hash, addr)
 
     @locked
     def list_txi(self):
@@ -564,10 +751,12 @@ class JsonDB(Logger):
     @modifier
     def remove_txi(self, tx_hash):
         self.txi.pop(tx_hash, None)
+        self._journal('txi', tx_hash)
 
     @modifier
     def remove_txo(self, tx_hash):
         self.txo.pop(tx_hash, None)
+        self._journal('txo', tx_hash)
 
     @locked
     def list_spent_outpoints(self):
@@ -589,25 +778,58 @@ class JsonDB(Logger):
         self.spent_outpoints[prevout_hash].pop(prevout_n, None)  # FIXME
         if not self.spent_outpoints[prevout_hash]:
             self.spent_outpoints.pop(prevout_hash)
+        self._journal('spent_outpoints', prevout_hash)
 
-    @modifier
+    @locked
     def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
         if prevout_hash not in self.spent_outpoints:
             self.spent_outpoints[prevout_hash] = {}
-        self.spent_outpoints[prevout_hash][str(prevout_n)] = tx_hash
+        d = self.spent_outpoints[prevout_hash]
+        if d.get(str(prevout_n)) == tx_hash:
+            return
+        d[str(prevout_n)] = tx_hash
+        self._modified = True
+        self._journal('spent_outpoints', prevout_hash, str(prevout_n))
 
-    @modifier
+    @locked
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx, Transaction)
-        self.transactions[tx_hash] = tx
+        self._tx_cache[tx_hash] = tx
+        raw = tx.raw_bytes()
+        # AddressSynchronizer adds known txs again on every history update;
+        # don't write them to the journal each time
+        if self.transactions.get(tx_hash) == raw:
+            return
+        self.transactions[tx_hash] = raw
+        self._modified = True
+        self._journal('transactions', tx_hash)
 
     @modifier
     def remove_transaction(self, tx_hash) -> Optional[Transaction]:
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self.transactions.pop(tx_hash, None)
+        self._tx_cache.pop(tx_hash)
+        self._journal('transactions', tx_hash)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
-        return self.transactions.get(tx_hash)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is None:
+            raw = self.transactions.get(tx_hash)
+            if raw is None:
+                return None
+            tx = Transaction(raw)
+            self._tx_cache[tx_hash] = tx
+        return tx
+
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        return tx_hash in self.transactions
+
+    @locked
+    def set_tx_cache_size(self, size: int):
+        self._tx_cache.set_maxsize(size)
 
     @locked
     def list_transactions(self):
@@ -628,10 +850,12 @@ class JsonDB(Logger):
     @modifier
     def set_addr_history(self, addr, hist):
         self.history[addr] = hist
+        self._journal('addr_history', addr)
 
     @modifier
     def remove_addr_history(self, addr):
         self.history.pop(addr, None)
+        self._journal('addr_history', addr)
 
     @locked
     def list_verified_tx(self):
@@ -651,17 +875,21 @@ class JsonDB(Logger):
     @modifier
     def add_verified_tx(self, txid, info):
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        self._journal('verified_tx3', txid)
 
     @modifier
     def remove_verified_tx(self, txid):
         self.verified_tx.pop(txid, None)
+        self._journal('verified_tx3', txid)
 
     def is_in_verified_tx(self, txid):
         return txid in self.verified_tx
 
     @modifier
     def update_tx_fees(self, d):
-        return self.tx_fees.update(d)
+        self.tx_fees.update(d)
+        for txid in d:
+            self._journal('tx_fees', txid)
 
     @locked
     def get_tx_fee(self, txid):
@@ -670,11 +898,13 @@ class JsonDB(Logger):
     @modifier
     def remove_tx_fee(self, txid):
         self.tx_fees.pop(txid, None)
+        self._journal('tx_fees', txid)
 
     @locked
     def get_data_ref(self, name):
         if name not in self.data:
             self.data[name] = {}
+            self._journal(name)
         return self.data[name]
 
     @locked
@@ -697,11 +927,13 @@ class JsonDB(Logger):
     def add_change_address(self, addr):
         self._addr_to_addr_index[addr] = (True, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self._journal('addresses', 'change', len(self.change_addresses) - 1)
 
     @modifier
     def add_receiving_address(self, addr):
         self._addr_to_addr_index[addr] = (False, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self._journal('addresses', 'receiving', len(self.receiving_addresses) - 1)
 
     @locked
     def get_address_index(self, address):
@@ -710,10 +942,12 @@ class JsonDB(Logger):
     @modifier
     def add_imported_address(self, addr, d):
         self.imported_addresses[addr] = d
+        self._journal('addresses', addr)
 
     @modifier
     def remove_imported_address(self, addr):
         self.imported_addresses.pop(addr)
+        self._journal('addresses', addr)
 
     @locked
     def has_imported_address(self, addr):
@@ -736,6 +970,7 @@ class JsonDB(Logger):
             for name in ['receiving', 'change']:
                 if name not in self.data['addresses']:
                     self.data['addresses'][name] = []
+                    self._journal('addresses', name)
             self.change_addresses = self.data['addresses']['change']
             self.receiving_addresses = self.data['addresses']['receiving']
             self._addr_to_addr_index = {}  # key: address, value: (is_change, index)
@@ -750,14 +985,15 @@ class JsonDB(Logger):
         # references in self.data
         self.txi = self.get_data_ref('txi')  # txid -> address -> list of (prev_outpoint, value)
         self.txo = self.get_data_ref('txo')  # txid -> address -> list of (output_index, value, is_coinbase)
-        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, Transaction]
+        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, bytes]
         self.spent_outpoints = self.get_data_ref('spent_outpoints')
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
         self.tx_fees = self.get_data_ref('tx_fees')
-        # convert raw hex transactions to Transaction objects
+        # keep raw transactions as bytes; Transaction objects are
+        # created on demand by get_transaction
         for tx_hash, raw_tx in self.transactions.items():
-            self.transactions[tx_hash] = Transaction(raw_tx)
+            self.transactions[tx_hash] = bfh(raw_tx)
         # convert list to set
         for t in self.txi, self.txo:
             for d in t.values():
@@ -782,6 +1018,10 @@ class JsonDB(Logger):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
         self.history.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
+        for name in ('txi', 'txo', 'spent_outpoints', 'transactions',
+                     'addr_history', 'verified_tx3', 'tx_fees'):
+            self._journal(name)
@@ -32,7 +32,7 @@ import json
 import sys
 import ipaddress
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, Union
 import traceback
 
 import dns
@@ -55,6 +55,7 @@ from .interface import (Interface, serialize_server, deserialize_server,
                         RequestTimedOut, NetworkTimeout, BUCKET_NAME_OF_ONION_SERVERS)
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
+from .spv_cache import SPVProofCache, DEFAULT_MAX_PROOFS
 from .i18n import _
 from .logging import get_logger, Logger
 
@@ -276,6 +277,12 @@ class Network(Logger):
         dir_path = os.path.join(self.config.path, 'certs')
         util.make_dir(dir_path)
 
+        # merkle proofs of verified txs, shared by the wallets
+        self.spv_proof_cache = None  # type: Optional[SPVProofCache]
+        if self.config.get('spv_proof_cache', True):
+            self.spv_proof_cache = SPVProofCache(os.path.join(self.config.path, 'spv_proofs'),
+                                                 max_proofs=self.config.get('spv_proof_cache_size', DEFAULT_MAX_PROOFS))
+
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -851,6 +858,23 @@ class Network(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_merkles_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, Exception]]:
+        """Fetches the merkle branches of several (tx_hash, tx_height) pairs
+        with a single JSON-RPC batch request. Returns them in the same order.
+        A proof the server answered with an error for is replaced by an
+        UntrustedServerReturnedError."""
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.interface.session.send_request_batch(
+            [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in txs])
+        return [UntrustedServerReturnedError(original_exception=r) if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
@@ -1025,6 +1049,20 @@ class Network(Logger):
         return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
                                                          timeout=timeout)
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_transactions(self, tx_hashes: Sequence[str], *, timeout=None) -> List[Union[str, Exception]]:
+        """Fetches several transactions with a single JSON-RPC batch request.
+        Returns the raw txs in the same order. A tx the server answered with
+        an error for is replaced by an UntrustedServerReturnedError."""
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await self.interface.session.send_request_batch(
+            [('blockchain.transaction.get', [tx_hash]) for tx_hash in tx_hashes], timeout=timeout)
+        return [UntrustedServerReturnedError(original_exception=r) if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in results]
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
@@ -1163,6 +1201,12 @@ class Network(Logger):
         try:
             fut.result(timeout=2)
         except (asyncio.TimeoutError, asyncio.CancelledError): pass
+        # headers are fsync'ed in groups, see Blockchain.write.
+        # done here, not in _stop, so as not to block the event loop
+        with blockchain.blockchains_lock:
+            chains = list(blockchain.blockchains.values())
+        for b in chains:
+            b.sync()
 
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
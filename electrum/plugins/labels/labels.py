@@ -147,10 +147,10 @@ class LabelsPlugin(BasePlugin):
         for key, value in result.items():
             if force or not wallet.labels.get(key):
                 wallet.labels[key] = value
+                # do not write to disk because we're in a daemon thread
+                wallet.storage.put_item('labels', key, value)
 
         self.logger.info(f"received {len(response)} labels")
-        # do not write to disk because we're in a daemon thread
-        wallet.storage.put('labels', wallet.labels)
         self.set_nonce(wallet, response["nonce"] + 1)
         self.on_pulled(wallet)
 
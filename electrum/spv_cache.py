@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Optional, Sequence, Tuple, Dict
+
+from .logging import Logger
+
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS proofs (txid TEXT, block_hash TEXT, wallet TEXT, height INTEGER, pos INTEGER, merkle TEXT NOT NULL,
+                                   PRIMARY KEY (txid, block_hash, wallet));
+CREATE INDEX IF NOT EXISTS proofs_height ON proofs (height);
+CREATE INDEX IF NOT EXISTS proofs_wallet ON proofs (wallet);
+"""
+
+# max number of proofs kept; the oldest ones are evicted first
+DEFAULT_MAX_PROOFS = 20000
+# max number of txids looked up in one query (sqlite limits the number of parameters)
+GET_MANY_CHUNK_SIZE = 500
+
+
+def wallet_key(wallet_path: str) -> str:
+    """Identifies a wallet in the cache without storing its path."""
+    return hashlib.sha256(wallet_path.encode('utf8')).hexdigest()
+
+
+class SPVProofCache(Logger):
+    """Merkle branches of verified transactions, keyed by (txid, block hash).
+
+    Shared by all wallets of a Network, and stored in a file so that proofs
+    do not have to be downloaded again, e.g. after clear_history.
+    Only proofs that passed verification against the header of that
+    block are stored. Each proof is recorded under the wallet that
+    verified it, so that it can be forgotten when the wallet is deleted.
+    Proofs of encrypted wallets must not be added, as the file is not
+    encrypted.
+    """
+
+    def __init__(self, path: Optional[str], max_proofs: int = DEFAULT_MAX_PROOFS):
+        Logger.__init__(self)
+        self.lock = threading.Lock()
+        self.max_proofs = max_proofs
+        try:
+            self.conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+            self._init_schema()
+        except sqlite3.DatabaseError as e:
+            # the cache is optional, don't let a broken file stop us
+            self.logger.info(f"cannot open spv proof cache: {repr(e)}")
+            self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._init_schema()
+
+    def _init_schema(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # it is only a cache; start over
+            self.conn.execute('DROP TABLE IF EXISTS proofs')
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def get(self, txid: str, block_hash: str) -> Optional[dict]:
+        """Returns the proof in the format of blockchain.transaction.get_merkle."""
+        return self.get_many([(txid, block_hash)]).get((txid, block_hash))
+
+    def get_many(self, keys: Sequence[Tuple[str, str]]) -> Dict[Tuple[str, str], dict]:
+        """Looks up several (txid, block_hash) at once.
+        Returns the proofs found, keyed by (txid, block_hash)."""
+        wanted = set(keys)
+        txids = list({txid for txid, block_hash in wanted})
+        rows = []
+        with self.lock:
+            for i in range(0, len(txids), GET_MANY_CHUNK_SIZE):
+                chunk = txids[i:i+GET_MANY_CHUNK_SIZE]
+                rows += self.conn.execute('SELECT txid, block_hash, height, pos, merkle FROM proofs WHERE txid IN ({})'
+                                          .format(','.join('?' * len(chunk))), chunk).fetchall()
+        proofs = {}
+        for txid, block_hash, height, pos, merkle in rows:
+            if (txid, block_hash) in wanted:
+                proofs[(txid, block_hash)] = {'block_height': height, 'pos': pos, 'merkle': json.loads(merkle)}
+        return proofs
+
+    def add_proofs(self, wallet: str, proofs: Sequence[Tuple[str, str, dict]]) -> None:
+        """Stores (txid, block_hash, merkle) items of a wallet, in a single transaction."""
+        if not proofs:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO proofs VALUES (?,?,?,?,?,?)',
+                                  [(txid, block_hash, wallet, merkle['block_height'], merkle['pos'], json.dumps(merkle['merkle']))
+                                   for txid, block_hash, merkle in proofs])
+            count = self.conn.execute('SELECT COUNT(*) FROM proofs').fetchone()[0]
+            if count > self.max_proofs:
+                # rowids grow with insertion, so these are the oldest
+                self.conn.execute('DELETE FROM proofs WHERE rowid IN (SELECT rowid FROM proofs ORDER BY rowid LIMIT ?)',
+                                  (count - self.max_proofs,))
+
+    def remove_proofs(self, keys: Sequence[Tuple[str, str]]) -> None:
+        """Forgets the proofs of some (txid, block_hash), e.g. because they failed verification."""
+        if not keys:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM proofs WHERE txid=? AND block_hash=?', keys)
+
+    def remove_above_height(self, height: int) -> None:
+        """Called on reorg; the blocks above height are not in the best chain anymore."""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM proofs WHERE height > ?', (height,))
+
+    def remove_wallet(self, wallet: str) -> None:
+        """Forgets the proofs added by a wallet, e.g. when it is deleted."""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM proofs WHERE wallet=?', (wallet,))
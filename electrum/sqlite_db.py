@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import Optional
+
+from .util import WalletFileException, TxMinedInfo, LRUCache
+from .transaction import Transaction
+from .json_db import JsonDB, JsonDBJsonEncoder, FINAL_SEED_VERSION, DEFAULT_TX_CACHE_SIZE
+from .logging import Logger
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# keys of JsonDB.data that are stored in their own tables
+TABLE_KEYS = ('txi', 'txo', 'transactions', 'spent_outpoints', 'addr_history',
+              'verified_tx3', 'tx_fees', 'addresses')
+
+SCHEMA = """
+CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE txi (tx_hash TEXT, addr TEXT, prevout TEXT, value INTEGER,
+                  PRIMARY KEY (tx_hash, addr, prevout, value)) WITHOUT ROWID;
+CREATE TABLE txo (tx_hash TEXT, addr TEXT, n INTEGER, value INTEGER, is_coinbase INTEGER,
+                  PRIMARY KEY (tx_hash, addr, n, value, is_coinbase)) WITHOUT ROWID;
+CREATE TABLE spent_outpoints (prevout_hash TEXT, prevout_n TEXT, tx_hash TEXT,
+                              PRIMARY KEY (prevout_hash, prevout_n)) WITHOUT ROWID;
+CREATE TABLE transactions (tx_hash TEXT PRIMARY KEY, raw BLOB NOT NULL);
+CREATE TABLE addr_history (addr TEXT PRIMARY KEY, history TEXT NOT NULL);
+CREATE TABLE verified_tx (txid TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER,
+                          txpos INTEGER, header_hash TEXT);
+CREATE INDEX verified_tx_height ON verified_tx (height);
+CREATE TABLE tx_fees (txid TEXT PRIMARY KEY, fee INTEGER);
+CREATE TABLE addresses (is_change INTEGER, idx INTEGER, addr TEXT,
+                        PRIMARY KEY (is_change, idx));
+CREATE UNIQUE INDEX addresses_addr ON addresses (addr);
+CREATE TABLE imported_addresses (addr TEXT PRIMARY KEY, details TEXT NOT NULL);
+"""
+
+
+def is_sqlite_file(path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class ImportedAddresses(Mapping):
+    """Read-only dict-like view of the imported addresses table,
+    as expected by Imported_KeyStore.addresses"""
+
+    def __init__(self, db: 'SqliteDB'):
+        self.db = db
+
+    def __getitem__(self, addr):
+        d = self.db.get_imported_address(addr)
+        if d is None:
+            raise KeyError(addr)
+        return d
+
+    def __contains__(self, addr):
+        return self.db.has_imported_address(addr)
+
+    def __iter__(self):
+        return iter(self.db.get_imported_addresses())
+
+    def __len__(self):
+        return len(self.db.get_imported_addresses())
+
+
+class SqliteDB(JsonDB):
+    """Wallet database stored in an SQLite file.
+
+    Implements the accessors of JsonDB, but keeps transactions and
+    history related data in indexed tables on disk instead of in memory.
+    Other keys are stored as json values in the 'kv' table.
+    Changes are committed by storage.write().
+
+    Only wallets at FINAL_SEED_VERSION can be stored this way;
+    older wallets are upgraded as json first, see WalletStorage.convert_to_sqlite.
+    """
+
+    def __init__(self, path: Optional[str], *, manual_upgrades):
+        Logger.__init__(self)
+        self.lock = threading.RLock()
+        self._modified = False
+        self._full_write_needed = False
+        self._tx_cache = LRUCache(DEFAULT_TX_CACHE_SIZE)  # txid -> Transaction
+        self.manual_upgrades = manual_upgrades
+        self._called_load_transactions = False
+        if path is None:
+            # new wallet; kept in memory until it is saved to a file
+            self.conn = self._connect(':memory:')
+            self.conn.executescript(SCHEMA)
+            self.put('seed_version', FINAL_SEED_VERSION)
+        else:
+            self.conn = self._connect(path)
+        self.load_transactions()
+
+    @staticmethod
+    def _connect(path):
+        # all access is serialized by self.lock
+        return sqlite3.connect(path, check_same_thread=False)
+
+    @property
+    def data(self):
+        with self.lock:
+            return {k: json.loads(v) for k, v in self.conn.execute('SELECT key, value FROM kv')}
+
+    def _journal(self, *path):
+        pass
+
+    def needs_full_write(self):
+        return False
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def dump(self):
+        raise WalletFileException('sqlite wallet cannot be dumped as json')
+
+    def save_to_file(self, path):
+        """Writes an in-memory db to a new file, and continues from there."""
+        with self.lock:
+            self.conn.commit()
+            temp_path = "%s.tmp.%s" % (path, os.getpid())
+            disk = self._connect(temp_path)
+            with disk:
+                for line in self.conn.iterdump():
+                    disk.execute(line)
+            disk.close()
+            os.replace(temp_path, path)
+            self.conn.close()
+            self.conn = self._connect(path)
+
+    @classmethod
+    def from_json_db(cls, json_db: JsonDB) -> 'SqliteDB':
+        """Returns an in-memory SqliteDB with the contents of json_db."""
+        if json_db.requires_upgrade():
+            raise WalletFileException('wallet must be upgraded before conversion')
+        db = cls(None, manual_upgrades=False)
+        with json_db.lock:
+            for key, value in json_db.data.items():
+                if key not in TABLE_KEYS:
+                    db.put(key, value)
+            c = db.conn
+            c.executemany('INSERT INTO txi VALUES (?,?,?,?)',
+                          [(h, addr, ser, v)
+                           for h, d in json_db.txi.items()
+                           for addr, s in d.items()
+                           for ser, v in s])
+            c.executemany('INSERT INTO txo VALUES (?,?,?,?,?)',
+                          [(h, addr, n, v, is_cb)
+                           for h, d in json_db.txo.items()
+                           for addr, s in d.items()
+                           for n, v, is_cb in s])
+            c.executemany('INSERT INTO spent_outpoints VALUES (?,?,?)',
+                          [(h, n, txid)
+                           for h, d in json_db.spent_outpoints.items()
+                           for n, txid in d.items()])
+            c.executemany('INSERT INTO transactions VALUES (?,?)',
+                          list(json_db.transactions.items()))
+            c.executemany('INSERT INTO addr_history VALUES (?,?)',
+                          [(addr, json.dumps(hist)) for addr, hist in json_db.history.items()])
+            c.executemany('INSERT INTO verified_tx VALUES (?,?,?,?,?)',
+                          [(txid,) + tuple(v) for txid, v in json_db.verified_tx.items()])
+            c.executemany('INSERT INTO tx_fees VALUES (?,?)', list(json_db.tx_fees.items()))
+            addresses = json_db.data.get('addresses', {})
+            if json_db.get('wallet_type') == 'imported':
+                c.executemany('INSERT INTO imported_addresses VALUES (?,?)',
+                              [(addr, json.dumps(d)) for addr, d in addresses.items()])
+            else:
+                for is_change, name in ((0, 'receiving'), (1, 'change')):
+                    c.executemany('INSERT INTO addresses VALUES (?,?,?)',
+                                  [(is_change, i, addr) for i, addr in enumerate(addresses.get(name, []))])
+        return db
+
+    modifier = JsonDB.modifier
+    locked = JsonDB.locked
+
+    @locked
+    def get(self, key, default=None, *, readonly=False):
+        # values are decoded from json on every call, so they are always private copies
+        r = self.conn.execute('SELECT value FROM kv WHERE key=?', (key,)).fetchone()
+        return default if r is None else json.loads(r[0])
+
+    @modifier
+    def put(self, key, value):
+        if key in TABLE_KEYS:
+            raise WalletFileException(f'cannot put {key} into sqlite wallet')
+        try:
+            s = json.dumps(value, cls=JsonDBJsonEncoder)
+        except:
+            self.logger.info(f"json error: cannot save {repr(key)} ({repr(value)})")
+            return False
+        if value is not None:
+            if self.get(key) != value:
+                self.conn.execute('INSERT OR REPLACE INTO kv VALUES (?,?)', (key, s))
+                return True
+        elif self.conn.execute('DELETE FROM kv WHERE key=?', (key,)).rowcount:
+            return True
+        return False
+
+    @modifier
+    def put_item(self, key, item_key, value):
+        d = self.get(key, {})
+        if value is None:
+            if d.pop(item_key, None) is None:
+                return False
+        else:
+            d[item_key] = value
+        return self.put(key, d)
+
+    def requires_split(self):
+        return False
+
+    def upgrade(self):
+        raise WalletFileException('sqlite wallets cannot be upgraded')
+
+    @locked
+    def get_txi(self, tx_hash):
+        return [r[0] for r in self.conn.execute('SELECT DISTINCT addr FROM txi WHERE tx_hash=?', (tx_hash,))]
+
+    @locked
+    def get_txo(self, tx_hash):
+        return [r[0] for r in self.conn.execute('SELECT DISTINCT addr FROM txo WHERE tx_hash=?', (tx_hash,))]
+
+    @locked
+    def get_txi_addr(self, tx_hash, address):
+        return set(self.conn.execute('SELECT prevout, value FROM txi WHERE tx_hash=? AND addr=?',
+                                     (tx_hash, address)))
+
+    @locked
+    def get_txo_addr(self, tx_hash, address):
+        return set((n, v, bool(is_cb)) for n, v, is_cb in self.conn.execute(
+            'SELECT n, value, is_coinbase FROM txo WHERE tx_hash=? AND addr=?', (tx_hash, address)))
+
+    @modifier
+    def add_txi_addr(self, tx_hash, addr, ser, v):
+        self.conn.execute('INSERT OR IGNORE INTO txi VALUES (?,?,?,?)', (tx_hash, addr, ser, v))
+
+    @modifier
+    def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        self.conn.execute('INSERT OR IGNORE INTO txo VALUES (?,?,?,?,?)', (tx_hash, addr, n, v, is_coinbase))
+
+    @locked
+    def list_txi(self):
+        return [r[0] for r in self.conn.execute('SELECT DISTINCT tx_hash FROM txi')]
+
+    @locked
+    def list_txo(self):
+        return [r[0] for r in self.conn.execute('SELECT DISTINCT tx_hash FROM txo')]
+
+    @modifier
+    def remove_txi(self, tx_hash):
+        self.conn.execute('DELETE FROM txi WHERE tx_hash=?', (tx_hash,))
+
+    @modifier
+    def remove_txo(self, tx_hash):
+        self.conn.execute('DELETE FROM txo WHERE tx_hash=?', (tx_hash,))
+
+    @locked
+    def list_spent_outpoints(self):
+        return list(self.conn.execute('SELECT prevout_hash, prevout_n FROM spent_outpoints'))
+
+    @locked
+    def get_spent_outpoints(self, prevout_hash):
+        return [r[0] for r in self.conn.execute(
+            'SELECT prevout_n FROM spent_outpoints WHERE prevout_hash=?', (prevout_hash,))]
+
+    @locked
+    def get_spent_outpoint(self, prevout_hash, prevout_n):
+        r = self.conn.execute('SELECT tx_hash FROM spent_outpoints WHERE prevout_hash=? AND prevout_n=?',
+                              (prevout_hash, str(prevout_n))).fetchone()
+        return r[0] if r else None
+
+    @modifier
+    def remove_spent_outpoint(self, prevout_hash, prevout_n):
+        self.conn.execute('DELETE FROM spent_outpoints WHERE prevout_hash=? AND prevout_n=?',
+                          (prevout_hash, str(prevout_n)))
+
+    @modifier
+    def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        self.conn.execute('INSERT OR REPLACE INTO spent_outpoints VALUES (?,?,?)',
+                          (prevout_hash, str(prevout_n), tx_hash))
+
+    @modifier
+    def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        assert isinstance(tx, Transaction)
+        self.conn.execute('INSERT OR REPLACE INTO transactions VALUES (?,?)', (tx_hash, tx.raw_bytes()))
+        self._tx_cache[tx_hash] = tx
+
+    @modifier
+    def remove_transaction(self, tx_hash) -> Optional[Transaction]:
+        tx = self.get_transaction(tx_hash)
+        self.conn.execute('DELETE FROM transactions WHERE tx_hash=?', (tx_hash,))
+        self._tx_cache.pop(tx_hash)
+        return tx
+
+    @locked
+    def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
+        tx = self._tx_cache.get(tx_hash)
+        if tx is None:
+            r = self.conn.execute('SELECT raw FROM transactions WHERE tx_hash=?', (tx_hash,)).fetchone()
+            if r is None:
+                return None
+            tx = Transaction(r[0])
+            self._tx_cache[tx_hash] = tx
+        return tx
+
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM transactions WHERE tx_hash=?', (tx_hash,)).fetchone() is not None
+
+    @locked
+    def list_transactions(self):
+        return [r[0] for r in self.conn.execute('SELECT tx_hash FROM transactions')]
+
+    @locked
+    def get_history(self):
+        return [r[0] for r in self.conn.execute('SELECT addr FROM addr_history')]
+
+    @locked
+    def is_addr_in_history(self, addr):
+        return self.conn.execute('SELECT 1 FROM addr_history WHERE addr=?', (addr,)).fetchone() is not None
+
+    @locked
+    def get_addr_history(self, addr):
+        r = self.conn.execute('SELECT history FROM addr_history WHERE addr=?', (addr,)).fetchone()
+        return json.loads(r[0]) if r else []
+
+    @modifier
+    def set_addr_history(self, addr, hist):
+        self.conn.execute('INSERT OR REPLACE INTO addr_history VALUES (?,?)', (addr, json.dumps(hist)))
+
+    @modifier
+    def remove_addr_history(self, addr):
+        self.conn.execute('DELETE FROM addr_history WHERE addr=?', (addr,))
+
+    @locked
+    def list_verified_tx(self):
+        return [r[0] for r in self.conn.execute('SELECT txid FROM verified_tx')]
+
+    @locked
+    def get_verified_tx(self, txid):
+        r = self.conn.execute('SELECT height, timestamp, txpos, header_hash FROM verified_tx WHERE txid=?',
+                              (txid,)).fetchone()
+        if r is None:
+            return None
+        height, timestamp, txpos, header_hash = r
+        return TxMinedInfo(height=height,
+                           conf=None,
+                           timestamp=timestamp,
+                           txpos=txpos,
+                           header_hash=header_hash)
+
+    @modifier
+    def add_verified_tx(self, txid, info):
+        self.conn.execute('INSERT OR REPLACE INTO verified_tx VALUES (?,?,?,?,?)',
+                          (txid, info.height, info.timestamp, info.txpos, info.header_hash))
+
+    @modifier
+    def remove_verified_tx(self, txid):
+        self.conn.execute('DELETE FROM verified_tx WHERE txid=?', (txid,))
+
+    @locked
+    def is_in_verified_tx(self, txid):
+        return self.conn.execute('SELECT 1 FROM verified_tx WHERE txid=?', (txid,)).fetchone() is not None
+
+    @modifier
+    def update_tx_fees(self, d):
+        self.conn.executemany('INSERT OR REPLACE INTO tx_fees VALUES (?,?)', list(d.items()))
+
+    @locked
+    def get_tx_fee(self, txid):
+        r = self.conn.execute('SELECT fee FROM tx_fees WHERE txid=?', (txid,)).fetchone()
+        return r[0] if r else None
+
+    @modifier
+    def remove_tx_fee(self, txid):
+        self.conn.execute('DELETE FROM tx_fees WHERE txid=?', (txid,))
+
+    def get_data_ref(self, name):
+        raise WalletFileException('sqlite wallet has no data references')
+
+    @modifier
+    def add_change_address(self, addr):
+        super().add_change_address(addr)
+        self.conn.execute('INSERT INTO addresses VALUES (1,?,?)', (len(self.change_addresses) - 1, addr))
+
+    @modifier
+    def add_receiving_address(self, addr):
+        super().add_receiving_address(addr)
+        self.conn.execute('INSERT INTO addresses VALUES (0,?,?)', (len(self.receiving_addresses) - 1, addr))
+
+    @modifier
+    def add_imported_address(self, addr, d):
+        self.conn.execute('INSERT OR REPLACE INTO imported_addresses VALUES (?,?)', (addr, json.dumps(d)))
+
+    @modifier
+    def remove_imported_address(self, addr):
+        if not self.conn.execute('DELETE FROM imported_addresses WHERE addr=?', (addr,)).rowcount:
+            raise KeyError(addr)
+
+    @locked
+    def has_imported_address(self, addr):
+        return self.conn.execute('SELECT 1 FROM imported_addresses WHERE addr=?', (addr,)).fetchone() is not None
+
+    @locked
+    def get_imported_addresses(self):
+        return [r[0] for r in self.conn.execute('SELECT addr FROM imported_addresses ORDER BY addr')]
+
+    @locked
+    def get_imported_address(self, addr):
+        r = self.conn.execute('SELECT details FROM imported_addresses WHERE addr=?', (addr,)).fetchone()
+        return json.loads(r[0]) if r else None
+
+    @locked
+    def load_addresses(self, wallet_type):
+        """ called from Abstract_Wallet.__init__ """
+        if wallet_type == 'imported':
+            self.imported_addresses = ImportedAddresses(self)
+        else:
+            # deterministic addresses are few enough to be kept in memory
+            self.receiving_addresses = []
+            self.change_addresses = []
+            self._addr_to_addr_index = {}
+            for is_change, idx, addr in self.conn.execute(
+                    'SELECT is_change, idx, addr FROM addresses ORDER BY is_change, idx'):
+                lst = self.change_addresses if is_change else self.receiving_addresses
+                assert idx == len(lst)
+                lst.append(addr)
+                self._addr_to_addr_index[addr] = (bool(is_change), idx)
+
+    @locked
+    def load_transactions(self):
+        self._called_load_transactions = True
+        # remove unreferenced tx
+        self.conn.execute('DELETE FROM transactions WHERE tx_hash NOT IN (SELECT tx_hash FROM txi) '
+                          'AND tx_hash NOT IN (SELECT tx_hash FROM txo)')
+        # remove unreferenced outpoints
+        self.conn.execute('DELETE FROM spent_outpoints WHERE tx_hash NOT IN (SELECT tx_hash FROM transactions)')
+
+    @modifier
+    def clear_history(self):
+        for table in ('txi', 'txo', 'spent_outpoints', 'transactions',
+                      'addr_history', 'verified_tx', 'tx_fees'):
+            self.conn.execute(f'DELETE FROM {table}')
+        self._tx_cache.clear()
@@ -28,12 +28,15 @@ import stat
 import hashlib
 import base64
 import zlib
+import codecs
+from typing import Optional, Iterator
 
 from . import ecc
 from .util import profiler, InvalidPassword, WalletFileException, bfh, standardize_path
 from .plugin import run_hook, plugin_loaders
 
 from .json_db import JsonDB
+from .sqlite_db import SqliteDB, is_sqlite_file
 from .logging import Logger
 
 
@@ -45,49 +48,119 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# Changes are appended to a journal next to the wallet file, instead of
+# rewriting the whole file on every write. The journal is compacted into
+# the wallet file once it grows larger than the wallet file itself.
+JOURNAL_SUFFIX = '.journal'
+
+# seconds during which schedule_write() requests are coalesced into one write
+DEFAULT_WRITE_DELAY = 2
+
+# size of the pieces encrypted wallet files are processed in
+CHUNK_SIZE = 1 << 16
+
 
 
 class WalletStorage(Logger):
 
-    def __init__(self, path, *, manual_upgrades=False):
+    def __init__(self, path, *, manual_upgrades=False, db_type='json'):
+        """db_type is only used when creating a new wallet file:
+        'json' or 'sqlite'. Existing files are opened with the backend
+        matching their format."""
         Logger.__init__(self)
         self.lock = threading.RLock()
+        self.write_delay = DEFAULT_WRITE_DELAY
+        self._write_timer = None  # type: Optional[threading.Timer]
+        self._write_timer_lock = threading.Lock()
         self.path = standardize_path(path)
         self._file_exists = self.path and os.path.exists(self.path)
+        self.journal_path = self.path + JOURNAL_SUFFIX if self.path else None
+        self._journal_lines = []
 
         DB_Class = JsonDB
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         # TODO we should test r/w permissions here (whether file exists or not)
-        if self.file_exists():
+        if self.file_exists() and is_sqlite_file(self.path):
+            self.db_type = 'sqlite'
+            self._encryption_version = STO_EV_PLAINTEXT
+            self.db = SqliteDB(self.path, manual_upgrades=manual_upgrades)
+            self.load_plugins()
+        elif self.file_exists():
+            self.db_type = 'json'
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
+            self._file_hash = self._hash_file_contents(self.raw)
+            self._journal_lines = self._read_journal()
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
-                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
+                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades, journal=self._journal_lines)
+                self.raw = None  # no longer needed, don't keep a second copy in memory
                 self.load_plugins()
-        else:
+        elif db_type == 'sqlite':
+            self.db_type = 'sqlite'
+            self._encryption_version = STO_EV_PLAINTEXT
+            self.db = SqliteDB(None, manual_upgrades=False)
+        elif db_type == 'json':
+            self.db_type = 'json'
             self._encryption_version = STO_EV_PLAINTEXT
             # avoid new wallets getting 'upgraded'
             self.db = DB_Class('', manual_upgrades=False)
+        else:
+            raise WalletFileException(f'unknown db_type: {db_type}')
 
 
     def load_plugins(self):
-        wallet_type = self.db.get('wallet_type')
+        wallet_type = self.db.get('wallet_type', readonly=True)
         if wallet_type in plugin_loaders:
             plugin_loaders[wallet_type]()
 
     def put(self, key,value):
         self.db.put(key, value)
 
-    def get(self, key, default=None):
-        return self.db.get(key, default)
+    def get(self, key, default=None, *, readonly=False):
+        return self.db.get(key, default, readonly=readonly)
+
+    def put_item(self, key, item_key, value):
+        return self.db.put_item(key, item_key, value)
 
     @profiler
     def write(self):
         with self.lock:
             self._write()
 
+    def schedule_write(self):
+        """Requests a write in a background thread. Requests made within
+        self.write_delay seconds are coalesced into a single write.
+        Use this instead of write() on the asyncio loop and in GUI callbacks.
+        """
+        with self._write_timer_lock:
+            if self._write_timer is not None:
+                return
+            t = threading.Timer(self.write_delay, self._scheduled_write)
+            t.name = 'WalletStorageWriter'
+            # _write refuses to run in daemon threads, which can be killed mid-write
+            t.daemon = False
+            self._write_timer = t
+            t.start()
+
+    def _scheduled_write(self):
+        with self._write_timer_lock:
+            self._write_timer = None
+        try:
+            self.write()
+        except Exception:
+            self.logger.exception('scheduled write failed')
+
+    def flush(self):
+        """Writes pending changes now, instead of waiting for a scheduled
+        write. Returns after any background write in progress has finished."""
+        with self._write_timer_lock:
+            t, self._write_timer = self._write_timer, None
+        if t is not None:
+            t.cancel()
+        self.write()
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
@@ -95,12 +168,31 @@ class WalletStorage(Logger):
         if not self.db.modified():
             return
         self.db.commit()
-        s = self.encrypt_before_writing(self.db.dump())
-        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
-            f.flush()
-            os.fsync(f.fileno())
+        if self.db_type == 'sqlite':
+            self._write_sqlite()
+        elif (self.file_exists()
+                and not self.db.needs_full_write()
+                and self._get_journal_size() <= os.path.getsize(self.path)):
+            self._append_to_journal()
+        else:
+            self._write_full()
+
+    def _write_full(self):
+        with self.db.lock:
+            plaintext = self.db.dump()
+            self.db.set_modified(False)
+        try:
+            temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+            file_hash = hashlib.sha256()
+            with open(temp_path, "w", encoding='utf-8') as f:
+                for s in self._encrypt_stream(plaintext):
+                    f.write(s)
+                    file_hash.update(s.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            self.db.set_modified(True)
+            raise
 
         mode = os.stat(self.path).st_mode if self.file_exists() else stat.S_IREAD | stat.S_IWRITE
         if not self.file_exists():
@@ -108,9 +200,69 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._file_hash = file_hash.hexdigest()
+        # the wallet file now contains everything in the journal
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+        self.logger.info(f"saved {self.path}")
+
+    def _write_sqlite(self):
+        if not self.file_exists():
+            self.db.save_to_file(self.path)
+            os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+            self._file_exists = True
         self.logger.info(f"saved {self.path}")
         self.db.set_modified(False)
 
+    def _append_to_journal(self):
+        s = self.encrypt_before_writing(self.db.pop_pending_changes())
+        try:
+            is_new = not os.path.exists(self.journal_path)
+            with open(self.journal_path, "a", encoding='utf-8') as f:
+                if is_new:
+                    # ties the journal to the wallet file it applies to
+                    f.write(self._file_hash + '\n')
+                    os.chmod(self.journal_path, os.stat(self.path).st_mode)
+                f.write(s + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            # the pending changes are gone; rewrite everything next time
+            self.db.set_modified(True)
+            raise
+        self.logger.info(f"saved {self.path} (journal)")
+
+    def _get_journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _hash_file_contents(s: str) -> str:
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def _read_journal(self):
+        """Returns the journal lines that apply to the current wallet file.
+        A torn trailing line, left by a crash during append, is truncated.
+        """
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, "r", encoding='utf-8') as f:
+            s = f.read()
+        lines = s.split('\n')
+        if lines[-1]:
+            self.logger.warning(f'truncating incomplete journal entry in {self.journal_path}')
+            with open(self.journal_path, "r+", encoding='utf-8') as f:
+                f.truncate(len(s) - len(lines[-1]))
+        lines = lines[:-1]
+        if not lines or lines[0] != self._file_hash:
+            # left over from a different wallet file
+            self.logger.warning(f'ignoring stale journal {self.journal_path}')
+            os.unlink(self.journal_path)
+            return []
+        return lines[1:]
+
     def file_exists(self):
         return self._file_exists
 
@@ -149,7 +301,8 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            # 8 base64 chars decode to 6 bytes; enough for the magic
+            magic = base64.b64decode(self.raw[0:8])[0:4]
             if magic == b'BIE1':
                 return STO_EV_USER_PW
             elif magic == b'BIE2':
@@ -176,16 +329,49 @@ class WalletStorage(Logger):
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
+        enc_magic = self._get_encryption_magic()
         if self.raw:
-            enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+            s = self._decrypt_stream(ec_key, enc_magic)
         else:
             s = None
         self.pubkey = ec_key.get_public_key_hex()
-        s = s.decode('utf8')
-        self.db = JsonDB(s, manual_upgrades=True)
+        journal = []
+        for line in self._journal_lines:
+            try:
+                journal.append(zlib.decompress(ec_key.decrypt_message(line, enc_magic)).decode('utf8'))
+            except Exception:
+                # JsonDB discards everything from an unreadable line onwards
+                journal.append('')
+                break
+        self.db = JsonDB(s, manual_upgrades=True, journal=journal)
         self.load_plugins()
 
+    def _decrypt_stream(self, ec_key, enc_magic) -> str:
+        """Decrypts and decompresses self.raw piece by piece, so that only
+        the resulting plaintext is held in memory in full."""
+        d = zlib.decompressobj()
+        decoder = codecs.getincrementaldecoder('utf8')()
+        parts = []
+        for c in ec_key.decrypt_message_stream(self.raw, enc_magic, chunk_size=CHUNK_SIZE):
+            parts.append(decoder.decode(d.decompress(c)))
+        parts.append(decoder.decode(d.flush(), final=True))
+        return ''.join(parts)
+
+    def _encrypt_stream(self, plaintext: str) -> Iterator[str]:
+        """Same as encrypt_before_writing, but yields the output in pieces."""
+        if not self.pubkey:
+            yield plaintext
+            return
+        def compressed_chunks():
+            c = zlib.compressobj()
+            for i in range(0, len(plaintext), CHUNK_SIZE):
+                yield c.compress(plaintext[i:i+CHUNK_SIZE].encode('utf8'))
+            yield c.flush()
+        enc_magic = self._get_encryption_magic()
+        public_key = ecc.ECPubkey(bfh(self.pubkey))
+        for s in public_key.encrypt_message_stream(compressed_chunks(), enc_magic):
+            yield s.decode('utf8')
+
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
         if self.pubkey:
@@ -212,6 +398,8 @@ class WalletStorage(Logger):
         if enc_version is None:
             enc_version = self._encryption_version
         if password and enc_version != STO_EV_PLAINTEXT:
+            if self.db_type == 'sqlite':
+                raise WalletFileException('sqlite wallet files cannot be encrypted')
             ec_key = self.get_eckey_from_password(password)
             self.pubkey = ec_key.get_public_key_hex()
             self._encryption_version = enc_version
@@ -245,6 +433,34 @@ class WalletStorage(Logger):
             out.append(path)
         return out
 
+    def convert_to_sqlite(self):
+        """Converts this json wallet file to the sqlite backend.
+        The json file is kept, with a '.json' suffix added to its name.
+        The storage must not be in use by a wallet.
+        """
+        if self.db_type == 'sqlite':
+            raise WalletFileException('wallet file is already an sqlite database')
+        if self.is_encrypted():
+            raise WalletFileException('sqlite wallet files cannot be encrypted. '
+                                      'Disable storage encryption first.')
+        if self.requires_split():
+            raise WalletFileException('wallet with multiple accounts must be split first')
+        if self.db.requires_upgrade():
+            self.db.upgrade()
+        db = SqliteDB.from_json_db(self.db)
+        backup_path = self.path + '.json'
+        if os.path.exists(backup_path):
+            raise WalletFileException(f'file already exists: {backup_path}')
+        self.write()
+        os.replace(self.path, backup_path)
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, backup_path + JOURNAL_SUFFIX)
+        self.db = db
+        self.db_type = 'sqlite'
+        self._file_exists = False
+        self.write()
+        return backup_path
+
     def get_action(self):
         action = run_hook('get_action', self)
         return action
@@ -24,6 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
+import time
 from typing import Dict, List, TYPE_CHECKING, Tuple
 from collections import defaultdict
 import logging
@@ -45,6 +46,20 @@ if TYPE_CHECKING:
 class SynchronizerFailure(Exception): pass
 
 
+# max number of transactions requested from the server in one batch
+TX_BATCH_SIZE = 50
+# max number of such batches waiting for an answer at the same time
+TX_BATCHES_IN_FLIGHT = 4
+
+# scripthash subscriptions are sent in batches of at most this size
+SUBSCRIPTION_BATCH_SIZE = 100
+# the number of subscriptions in flight is adapted to how fast the server
+# answers, between these bounds (the upper one is configurable)
+SUBSCRIPTION_WINDOW_MIN = 10
+SUBSCRIPTION_WINDOW_MAX = 1000
+SUBSCRIPTION_TARGET_LATENCY = 2  # seconds
+
+
 def history_status(h):
     if not h:
         return None
@@ -60,6 +75,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     """
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
+        self._subscription_window_max = network.config.get('subscription_window_max', SUBSCRIPTION_WINDOW_MAX)
         NetworkJobOnDefaultServer.__init__(self, network)
         self._reset_request_counters()
 
@@ -69,6 +85,12 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self.scripthash_to_address = {}
         self._processed_some_notifications = False  # so that we don't miss them
         self._reset_request_counters()
+        # subscriptions sent but not answered yet, and how many we allow
+        self._subscriptions_in_flight = 0
+        self._subscription_window = SUBSCRIPTION_WINDOW_MIN
+        self._subscription_window_freed = asyncio.Event()
+        # set whenever something happened that main() might need to act on
+        self._wakeup_event = asyncio.Event()
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
@@ -87,11 +109,16 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self._requests_sent = 0
         self._requests_answered = 0
 
+    def wakeup(self):
+        """Make main() run another iteration. Thread-safe."""
+        self.asyncio_loop.call_soon_threadsafe(self._wakeup_event.set)
+
     def add(self, addr):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
     async def _add_address(self, addr: str):
         if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
+        self._wakeup_event.set()
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
         await self.add_queue.put(addr)
@@ -101,22 +128,50 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
+        while True:
+            addrs = [await self.add_queue.get()]
+            batch_size = min(SUBSCRIPTION_BATCH_SIZE, self._subscription_window)
+            while len(addrs) < batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            # backpressure: wait until the server has answered enough of
+            # the previous subscriptions
+            while (self._subscriptions_in_flight
+                   and self._subscriptions_in_flight + len(addrs) > self._subscription_window):
+                self._subscription_window_freed.clear()
+                await self._subscription_window_freed.wait()
+            self._subscriptions_in_flight += len(addrs)
+            await self.group.spawn(self._subscribe_to_addresses, addrs)
+
+    async def _subscribe_to_addresses(self, addrs):
+        hashes = []
+        for addr in addrs:
             h = address_to_scripthash(addr)
             self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
-            try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
-            self._requests_answered += 1
+            hashes.append(h)
+        self._requests_sent += len(addrs)
+        start = time.monotonic()
+        try:
+            await self.session.subscribe_batch('blockchain.scripthash.subscribe', [[h] for h in hashes], self.status_queue)
+        except RPCError as e:
+            if e.message == 'history too large':  # no unique error code
+                raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+            raise
+        finally:
+            self._subscriptions_in_flight -= len(addrs)
+            self._adapt_subscription_window(time.monotonic() - start, len(addrs))
+            self._subscription_window_freed.set()
+        self._requests_answered += len(addrs)
+        for addr in addrs:
             self.requested_addrs.remove(addr)
+        self._wakeup_event.set()
 
-        while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+    def _adapt_subscription_window(self, latency, num_answered):
+        # grow while the server keeps up (doubling per round trip), halve when it does not
+        if latency < SUBSCRIPTION_TARGET_LATENCY:
+            self._subscription_window = min(self._subscription_window + num_answered,
+                                            self._subscription_window_max)
+        else:
+            self._subscription_window = max(self._subscription_window // 2, SUBSCRIPTION_WINDOW_MIN)
 
     async def handle_status(self):
         while True:
@@ -124,6 +179,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             addr = self.scripthash_to_address[h]
             await self.group.spawn(self._on_address_status, addr, status)
             self._processed_some_notifications = True
+            self._wakeup_event.set()
 
     def num_requests_sent_and_answered(self) -> Tuple[int, int]:
         return self._requests_sent, self._requests_answered
@@ -143,11 +199,21 @@ class Synchronizer(SynchronizerBase):
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         SynchronizerBase.__init__(self, wallet.network)
+        # new blocks can make addresses old, see wallet.synchronize
+        self.network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
+
+    async def stop(self):
+        self.network.unregister_callback(self._on_blockchain_updated)
+        await super().stop()
+
+    def _on_blockchain_updated(self, event, *args):
+        self._wakeup_event.set()
 
     def _reset(self):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = {}
+        self._tx_batch_semaphore = asyncio.Semaphore(TX_BATCHES_IN_FLIGHT)
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
@@ -189,6 +255,7 @@ class Synchronizer(SynchronizerBase):
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self._wakeup_event.set()
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -196,62 +263,83 @@ class Synchronizer(SynchronizerBase):
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
-            if self.wallet.db.get_transaction(tx_hash):
+            if self.wallet.db.has_transaction(tx_hash):
                 continue
             transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
 
         if not transaction_hashes: return
         async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
+            for i in range(0, len(transaction_hashes), TX_BATCH_SIZE):
+                batch = transaction_hashes[i:i+TX_BATCH_SIZE]
+                await group.spawn(self._get_transactions(batch, allow_server_not_finding_tx=allow_server_not_finding_tx))
 
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
-        try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
-        finally:
-            self._requests_answered += 1
-        tx = Transaction(result)
-        try:
-            tx.deserialize()  # see if raises
-        except Exception as e:
-            # possible scenarios:
-            # 1: server is sending garbage
-            # 2: there is a bug in the deserialization code
-            # 3: there was a segwit-like upgrade that changed the tx structure
-            #    that we don't know about
-            raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
-        if tx_hash != tx.txid():
-            raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
-        tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
-        # callbacks
-        self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+    async def _get_transactions(self, tx_hashes, *, allow_server_not_finding_tx=False):
+        async with self._tx_batch_semaphore:
+            self._requests_sent += len(tx_hashes)
+            try:
+                results = await self.network.get_transactions(tx_hashes)
+            finally:
+                self._requests_answered += len(tx_hashes)
+        raw_txs = []
+        for tx_hash, result in zip(tx_hashes, results):
+            if isinstance(result, UntrustedServerReturnedError):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    continue
+                raise result
+            raw_txs.append((tx_hash, result))
+        # deserializing and hashing is CPU-bound, don't block the event loop with it
+        txs = await run_in_thread(self._deserialize_transactions, raw_txs)
+        for tx_hash, tx in txs:
+            tx_height = self.requested_tx.pop(tx_hash)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
+            # callbacks
+            self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+        self._wakeup_event.set()
+
+    @classmethod
+    def _deserialize_transactions(cls, raw_txs: List[Tuple[str, str]]) -> List[Tuple[str, Transaction]]:
+        txs = []
+        for tx_hash, raw_tx in raw_txs:
+            tx = Transaction(raw_tx)
+            try:
+                tx.deserialize()  # see if raises
+            except Exception as e:
+                # possible scenarios:
+                # 1: server is sending garbage
+                # 2: there is a bug in the deserialization code
+                # 3: there was a segwit-like upgrade that changed the tx structure
+                #    that we don't know about
+                raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
+            if tx_hash != tx.txid():
+                raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+            txs.append((tx_hash, tx))
+        return txs
 
     async def main(self):
         self.wallet.set_up_to_date(False)
-        # request missing txns, if any
+        # request missing txns, if any, all at once so that they can be batched
+        missing = []
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
             # Old electrum servers returned ['*'] when all history for the address
             # was pruned. This no longer happens but may remain in old wallets.
             if history == ['*']: continue
-            await self._request_missing_txs(history, allow_server_not_finding_tx=True)
+            missing.extend(history)
+        await self._request_missing_txs(missing, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             await self._add_address(addr)
-        # main loop
+        # main loop: sleep until something changed, then coalesce
+        # the burst of events that usually follows
+        self._wakeup_event.set()
         while True:
+            await self._wakeup_event.wait()
             await asyncio.sleep(0.1)
+            self._wakeup_event.clear()
             await run_in_thread(self.wallet.synchronize)
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
@@ -3,7 +3,7 @@ import sys
 
 from electrum.bitcoin import (public_key_to_p2pkh, address_from_private_key,
                               is_address, is_private_key,
-                              var_int, _op_push, address_to_script,
+                              var_int, var_int_bytes, _op_push, address_to_script,
                               deserialize_privkey, serialize_privkey, is_segwit_address,
                               is_b58_address, address_to_scripthash, is_minikey,
                               is_compressed_privkey, EncodeBase58Check, DecodeBase58Check,
@@ -205,6 +205,23 @@ class Test_bitcoin(SequentialTestCase):
             self.assertEqual(plaintext, key.decrypt_message(ciphertext2))
             self.assertNotEqual(ciphertext1, ciphertext2)
 
+    @needs_test_with_all_aes_implementations
+    @needs_test_with_all_ecc_implementations
+    def test_encrypt_message_stream(self):
+        key = WalletStorage.get_eckey_from_password('secret_password77')
+        plaintext = b'cannot think of anything funny' * 1000
+        chunks = [plaintext[i:i+777] for i in range(0, len(plaintext), 777)]
+        ciphertext = b''.join(key.encrypt_message_stream(chunks))
+        self.assertEqual(plaintext, key.decrypt_message(ciphertext))
+        ciphertext = key.encrypt_message(plaintext, magic=b'BIE2')
+        for chunk_size in (3, 16, 100, 1 << 16):
+            decrypted = b''.join(key.decrypt_message_stream(ciphertext, b'BIE2', chunk_size=chunk_size))
+            self.assertEqual(plaintext, decrypted)
+        self.assertEqual(b'', b''.join(key.decrypt_message_stream(key.encrypt_message(b''))))
+        wrong_key = WalletStorage.get_eckey_from_password('wrong_password')
+        with self.assertRaises(InvalidPassword):
+            b''.join(wrong_key.decrypt_message_stream(ciphertext, b'BIE2'))
+
     @needs_test_with_all_ecc_implementations
     def test_sign_transaction(self):
         eckey1 = ecc.ECPrivkey(bfh('7e1255fddb52db1729fc3ceb21a46f95b8d9fe94cc83425e936a6c5223bb679d'))
@@ -291,6 +308,11 @@ class Test_bitcoin(SequentialTestCase):
         self.assertEqual(var_int(0x100000000), "ff0000000001000000")
         self.assertEqual(var_int(0x0123456789abcdef), "ffefcdab8967452301")
 
+        self.assertEqual(var_int_bytes(0xfc), b"\xfc")
+        self.assertEqual(var_int_bytes(0x1234), bfh("fd3412"))
+        self.assertEqual(var_int_bytes(0x12345678), bfh("fe78563412"))
+        self.assertEqual(var_int_bytes(0x0123456789abcdef), bfh("ffefcdab8967452301"))
+
     def test_op_push(self):
         self.assertEqual(_op_push(0x00), '00')
         self.assertEqual(_op_push(0x12), '12')
@@ -1,10 +1,14 @@
 import shutil
 import tempfile
 import os
+import json
+import threading
+import time
+from unittest import mock
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_header, hash_header
+from electrum.blockchain import Blockchain, deserialize_header, hash_header, serialize_header
 from electrum.util import bh2u, bfh, make_dir
 
 from . import SequentialTestCase
@@ -339,3 +343,207 @@ class TestBlockchain(SequentialTestCase):
 
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
+
+    def test_verify_chunk(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        names = 'ABCDEFOPQRSTU'
+        chunk = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in names)
+        chain_u.verify_chunk(0, chunk)
+        # headers must link up
+        with self.assertRaises(Exception):
+            chain_u.verify_chunk(0, chunk[:5*80] + chunk[6*80:])
+        # and must not replace the ones we already have
+        for name in 'ABCDEFO':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(chunk[:7*80], chain_u.read_raw_headers(0, 100))
+        chain_u.verify_chunk(0, chunk)
+        fork = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEFG')
+        with self.assertRaises(Exception):
+            chain_u.verify_chunk(0, fork)
+
+    def test_hash_index_follows_writes(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        for height, name in enumerate('ABCDEFOP'):
+            self.assertEqual(hash_header(self.HEADERS[name]), chain_u.get_hash(height))
+        # overwrite the tail with another branch
+        chunk = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEFG')
+        chain_u.save_chunk(0, chunk)
+        self.assertEqual(6, chain_u.height())
+        for height, name in enumerate('ABCDEFG'):
+            self.assertEqual(hash_header(self.HEADERS[name]), chain_u.get_hash(height))
+        self.assertEqual(self.HEADERS['G'], chain_u.read_header(6))
+        with self.assertRaises(blockchain.MissingHeader):
+            chain_u.get_hash(7)
+
+    def test_appends_keep_the_mapping(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDE':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(self.HEADERS['E'], chain_u.read_header(4))
+        mapping = chain_u._mmap
+        self._append_header(chain_u, self.HEADERS['F'])
+        # headers that were mapped already are read without mapping the file again
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+        self.assertIs(mapping, chain_u._mmap)
+        # the new header is past the mapped part
+        self.assertEqual(self.HEADERS['F'], chain_u.read_header(5))
+        self.assertIsNot(mapping, chain_u._mmap)
+        # overwriting existing headers unmaps the file
+        chain_u.save_chunk(0, b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEFG'))
+        self.assertIsNone(chain_u._mmap)
+        self.assertEqual(self.HEADERS['G'], chain_u.read_header(6))
+
+    def test_chainwork_cache_persistence(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        hash_e, hash_o = hash_header(self.HEADERS['E']), hash_header(self.HEADERS['O'])
+        try:
+            blockchain._CHAINWORK_CACHE[hash_e] = 1234
+            blockchain._CHAINWORK_CACHE_HEIGHTS[hash_e] = 4
+            # not in any of our chains
+            blockchain._CHAINWORK_CACHE[hash_o] = 5678
+            blockchain._CHAINWORK_CACHE_HEIGHTS[hash_o] = 6
+            blockchain.write_chainwork_cache(self.config)
+            for h in (hash_e, hash_o):
+                del blockchain._CHAINWORK_CACHE[h]
+                del blockchain._CHAINWORK_CACHE_HEIGHTS[h]
+            blockchain.read_chainwork_cache(self.config)
+            self.assertEqual(1234, blockchain._CHAINWORK_CACHE.get(hash_e))
+            self.assertNotIn(hash_o, blockchain._CHAINWORK_CACHE)
+        finally:
+            for h in (hash_e, hash_o):
+                blockchain._CHAINWORK_CACHE.pop(h, None)
+                blockchain._CHAINWORK_CACHE_HEIGHTS.pop(h, None)
+
+    def _make_mainnet_like_chain(self, name):
+        """A chain whose chainwork is computed as on mainnet, with made-up
+        block hashes and a work of 1 per header."""
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        chain.get_hash = lambda height: "00" * 32 if height == -1 else "%s%060d" % (name, height)
+        chain.chainwork_of_header_at_height = lambda height: 1
+        return chain
+
+    def test_chainwork_cache_is_written_outside_chain_lock(self):
+        chain = self._make_mainnet_like_chain("aaaa")
+        lock_was_free = []
+        real_write = blockchain.write_chainwork_cache
+        def try_lock():
+            acquired = chain.lock.acquire(blocking=False)
+            if acquired:
+                chain.lock.release()
+            lock_was_free.append(acquired)
+        def write_chainwork_cache(config):
+            # try from another thread, as the lock is reentrant
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            real_write(config)
+        try:
+            with mock.patch.object(constants.net, 'TESTNET', False), \
+                    mock.patch.object(blockchain, 'write_chainwork_cache', write_chainwork_cache):
+                self.assertEqual(3 * 2016 + 6, chain.get_chainwork(3 * 2016 + 5))
+                # already cached, nothing to write
+                self.assertEqual(3 * 2016 + 6, chain.get_chainwork(3 * 2016 + 5))
+            self.assertEqual([True], lock_was_free)
+            with open(blockchain._chainwork_cache_path(self.config)) as f:
+                data = json.load(f)
+            self.assertEqual({chain.get_hash(h): [h, h + 1] for h in (2015, 4031, 6047)}, data)
+        finally:
+            for h in (2015, 4031, 6047):
+                blockchain._CHAINWORK_CACHE.pop(chain.get_hash(h), None)
+                blockchain._CHAINWORK_CACHE_HEIGHTS.pop(chain.get_hash(h), None)
+
+    def test_chainwork_cache_concurrent_chains(self):
+        chains = [self._make_mainnet_like_chain("%04d" % i) for i in range(4)]
+        errors = []
+        def run(chain):
+            try:
+                for height in range(0, 20 * 2016, 2016):
+                    self.assertEqual(height + 1, chain.get_chainwork(height))
+            except BaseException as e:
+                errors.append(e)
+        try:
+            with mock.patch.object(constants.net, 'TESTNET', False):
+                threads = [threading.Thread(target=run, args=(chain,)) for chain in chains]
+                for t in threads: t.start()
+                for t in threads: t.join()
+            self.assertEqual([], errors)
+            with open(blockchain._chainwork_cache_path(self.config)) as f:
+                data = json.load(f)
+            self.assertEqual(4 * 19, len(data))
+        finally:
+            for chain in chains:
+                for h in range(2015, 20 * 2016, 2016):
+                    blockchain._CHAINWORK_CACHE.pop(chain.get_hash(h), None)
+                    blockchain._CHAINWORK_CACHE_HEIGHTS.pop(chain.get_hash(h), None)
+
+    def test_torn_headers_are_truncated_on_startup(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_u.sync()
+        good_data = chain_u.read_raw_headers(0, 6)
+        for tail in (bfh(serialize_header(self.HEADERS['O']))[:50],  # partial header
+                     bytes(2 * 80),  # data never written
+                     bfh(serialize_header(self.HEADERS['P']))):  # does not link
+            with open(chain_u.path(), 'wb') as f:
+                f.write(good_data + tail)
+            chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                               forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            self.assertEqual(5, chain.height())
+            self.assertEqual(6 * 80, os.stat(chain.path()).st_size)
+            chain.close_file()
+
+    def test_header_appends_are_fsynced_in_groups(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        with mock.patch('os.fsync') as mock_fsync:
+            for name in 'ABCDEF':
+                self._append_header(chain_u, self.HEADERS[name])
+            self.assertEqual(0, mock_fsync.call_count)
+            chain_u.sync()
+            self.assertEqual(1, mock_fsync.call_count)
+            chain_u.sync()
+            self.assertEqual(1, mock_fsync.call_count)
+
+    def test_pending_header_appends_are_fsynced_later(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        with mock.patch('os.fsync') as mock_fsync, \
+                mock.patch.object(blockchain, 'HEADER_FSYNC_INTERVAL', 0.1):
+            chain_u._last_fsync = time.monotonic()
+            for name in 'ABC':
+                self._append_header(chain_u, self.HEADERS[name])
+            self.assertEqual(0, mock_fsync.call_count)
+            timer = chain_u._sync_timer
+            self.assertIsNotNone(timer)
+            # a single timer for all pending appends
+            self._append_header(chain_u, self.HEADERS['D'])
+            self.assertIs(timer, chain_u._sync_timer)
+            timer.join()
+            self.assertEqual(1, mock_fsync.call_count)
+            self.assertEqual(0, chain_u._unsynced_headers)
+            self.assertIsNone(chain_u._sync_timer)
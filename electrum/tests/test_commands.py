@@ -1,8 +1,10 @@
 import unittest
+import json
 from unittest import mock
 from decimal import Decimal
 
 from electrum.commands import Commands, eval_bool
+from electrum import daemon
 from electrum import storage
 from electrum.wallet import restore_wallet_from_text
 
@@ -75,6 +77,53 @@ class TestCommands(unittest.TestCase):
         ciphertext = cmds.encrypt(pubkey, cleartext)
         self.assertEqual(cleartext, cmds.decrypt(pubkey, ciphertext))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_listaddresses_ndjson(self, mock_write):
+        wallet = restore_wallet_from_text('p2wpkh:L4rYY5QpfN6wJEF4SEKDpcGhTPnCe9zcGs6hiSnhpprZqVywFifN',
+                                          path='if_this_exists_mocking_failed_648151893')['wallet']
+        cmds = Commands(config=None, wallet=wallet, network=None)
+        addresses = cmds.listaddresses(balance=True)
+        lines = list(cmds.listaddresses(balance=True, ndjson=True))
+        self.assertEqual(len(addresses), len(lines))
+        self.assertEqual([list(item) for item in addresses], [json.loads(line) for line in lines])
+        self.assertEqual([], list(cmds.history(ndjson=True)))
+
+
+class TestStreamedResults(unittest.TestCase):
+
+    def test_lines_are_sent_in_chunks(self):
+        streams = daemon.StreamedResults()
+        consumed = []
+        def lines():
+            for i in range(5):
+                consumed.append(i)
+                yield str(i)
+        with mock.patch.object(daemon, 'STREAM_CHUNK_LINES', 2):
+            first = streams.start(lines())
+            self.assertEqual(['0', '1'], first['lines'])
+            self.assertFalse(first['done'])
+            # only what was sent has been produced
+            self.assertEqual(2, len(consumed))
+            server = mock.Mock()
+            server.stream_next.side_effect = streams.next
+            self.assertEqual(['0', '1', '2', '3', '4'], list(daemon.iter_streamed_result(server, first)))
+        self.assertEqual(2, server.stream_next.call_count)
+        self.assertEqual({}, dict(streams.streams))
+        self.assertIn('error', streams.next(first['stream_id']))
+
+    def test_other_results_are_returned_as_is(self):
+        streams = daemon.StreamedResults()
+        self.assertEqual({'a': 1}, streams.start({'a': 1}))
+        self.assertFalse(daemon.is_streamed_result({'a': 1}))
+
+    def test_abandoned_streams_are_dropped(self):
+        streams = daemon.StreamedResults()
+        with mock.patch.object(daemon, 'STREAM_CHUNK_LINES', 1):
+            ids = [streams.start(str(i) for i in range(3))['stream_id']
+                   for j in range(daemon.MAX_OPEN_STREAMS + 1)]
+        self.assertNotIn(ids[0], streams.streams)
+        self.assertIn(ids[-1], streams.streams)
+
 
 class TestCommandsTestnet(TestCaseForTestnet):
 
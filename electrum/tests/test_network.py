@@ -1,11 +1,16 @@
 import asyncio
+import json
 import tempfile
 import unittest
+from unittest import mock
+
+from aiorpcx.jsonrpc import RPCError, JSONRPC
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface
+from electrum.interface import Interface, NotificationSession
+from electrum.network import Network, UntrustedServerReturnedError
 from electrum.crypto import sha256
 from electrum.util import bh2u
 
@@ -16,6 +21,8 @@ class MockTaskGroup:
 class MockNetwork:
     main_taskgroup = MockTaskGroup()
     asyncio_loop = asyncio.get_event_loop()
+    interfaces = {}
+    def trigger_callback(self, event, *args): return
 
 class MockInterface(Interface):
     def __init__(self, config):
@@ -113,6 +120,210 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_catchup_prefetches_chunks(self):
+        blockchain.blockchains = {}
+        ifa = self.interface
+        ifa.tip = 5 * 2016 + 100
+        in_flight = []
+        max_in_flight = 0
+        async def fetch_chunk(index, tip=None):
+            nonlocal max_in_flight
+            in_flight.append(index)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(index)
+            count = min(2016, tip - index * 2016 + 1)
+            return {'hex': str(index), 'count': count}
+        ifa._fetch_chunk = fetch_chunk
+        connected = []
+        def connect_chunk(index, hexdata):
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return True
+        ifa.blockchain.connect_chunk = connect_chunk
+        self.assertEqual(('catchup', ifa.tip + 1),
+                         asyncio.get_event_loop().run_until_complete(ifa.sync_until(0, next_height=ifa.tip)))
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        self.assertGreater(max_in_flight, 1)
+
+    def _sync_with_other_interface(self, other_fetch_chunk, connect_chunk):
+        """Catch up on 6 chunks, with another server that can serve them too.
+        Returns the chunks fetched from ours and from the other one."""
+        blockchain.blockchains = {}
+        ifa = self.interface
+        ifa.tip = 5 * 2016 + 100
+        fetched = {'ours': [], 'other': []}
+        async def fetch_chunk(index, tip=None):
+            fetched['ours'].append(index)
+            await asyncio.sleep(0.01)
+            return {'hex': str(index), 'count': min(2016, tip - index * 2016 + 1)}
+        async def fetch_chunk_other(index, tip=None):
+            fetched['other'].append(index)
+            await asyncio.sleep(0.01)
+            return other_fetch_chunk(index, tip)
+        ifa._fetch_chunk = fetch_chunk
+        other = mock.Mock()
+        other.server = 'other-server:50000:t'
+        other.tip = ifa.tip
+        other.ready = asyncio.get_event_loop().create_future()
+        other.ready.set_result(1)
+        other._fetch_chunk = fetch_chunk_other
+        ifa.network.interfaces = {ifa.server: ifa, other.server: other}
+        ifa.blockchain.connect_chunk = connect_chunk
+        self.assertEqual(('catchup', ifa.tip + 1),
+                         asyncio.get_event_loop().run_until_complete(ifa.sync_until(0, next_height=ifa.tip)))
+        return fetched
+
+    def test_catchup_spreads_chunks_among_interfaces(self):
+        connected = []
+        def connect_chunk(index, hexdata):
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return True
+        fetched = self._sync_with_other_interface(
+            lambda index, tip: {'hex': str(index), 'count': min(2016, tip - index * 2016 + 1)},
+            connect_chunk)
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        self.assertEqual([0, 2, 4], sorted(fetched['ours']))
+        self.assertEqual([1, 3, 5], sorted(fetched['other']))
+
+    def test_catchup_refetches_chunks_that_other_interface_failed(self):
+        def other_fetch_chunk(index, tip):
+            if index == 3:
+                raise ConnectionError('connection reset')
+            # on another chain
+            return {'hex': 'other', 'count': 2016}
+        connected = []
+        def connect_chunk(index, hexdata):
+            if hexdata == 'other':
+                return False
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return True
+        fetched = self._sync_with_other_interface(other_fetch_chunk, connect_chunk)
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        self.assertEqual([1, 3, 5], sorted(fetched['other']))
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(fetched['ours']))
+
+
+
+class TestBatchRequests(unittest.TestCase):
+
+    TXID_1 = "11" * 32
+    TXID_2 = "22" * 32
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _make_session(self, respond):
+        """respond(requests) returns the server's answer to a batch,
+        as a list of (result or error) dicts, or raises."""
+        session = NotificationSession(mock.Mock())
+        async def send_concurrent(message, future, count):
+            requests = json.loads(message)
+            responses = [dict(r, jsonrpc="2.0", id=req['id']) for req, r in zip(requests, respond(requests))]
+            session.connection.receive_message(json.dumps(responses).encode())
+            return await future
+        session._send_concurrent = send_concurrent
+        return session
+
+    def test_send_request_batch_per_item_errors(self):
+        def respond(requests):
+            self.assertEqual([['blockchain.transaction.get', [self.TXID_1]], ['blockchain.transaction.get', [self.TXID_2]]],
+                             [[r['method'], r['params']] for r in requests])
+            return [{'result': 'aa'}, {'error': {'code': 2, 'message': 'not found'}}]
+        async def f():
+            session = self._make_session(respond)
+            return await session.send_request_batch([('blockchain.transaction.get', [self.TXID_1]),
+                                                     ('blockchain.transaction.get', [self.TXID_2])])
+        results = self.loop.run_until_complete(f())
+        self.assertEqual('aa', results[0])
+        self.assertIsInstance(results[1], RPCError)
+        self.assertEqual(2, results[1].code)
+
+    def test_send_request_batch_batch_error(self):
+        def respond(requests):
+            raise RPCError(JSONRPC.EXCESSIVE_RESOURCE_USAGE, 'excessive resource usage')
+        async def f():
+            session = self._make_session(respond)
+            await session.send_request_batch([('blockchain.transaction.get', [self.TXID_1])])
+        with self.assertRaises(RPCError):
+            self.loop.run_until_complete(f())
+
+    def _make_network(self, session):
+        network = Network.__new__(Network)
+        network.interface = mock.Mock()
+        network.interface.session = session
+        return network
+
+    def _run_on_network(self, respond, coro_func):
+        async def f():
+            network = self._make_network(self._make_session(respond))
+            network.interface.ready = self.loop.create_future()
+            network.interface.ready.set_result(True)
+            network.interface.got_disconnected = self.loop.create_future()
+            return await coro_func(network)
+        return self.loop.run_until_complete(f())
+
+    def test_get_transactions(self):
+        def respond(requests):
+            return [{'result': 'aa'}, {'error': {'code': 2, 'message': 'not found'}}]
+        results = self._run_on_network(respond, lambda network: network.get_transactions([self.TXID_1, self.TXID_2]))
+        self.assertEqual('aa', results[0])
+        self.assertIsInstance(results[1], UntrustedServerReturnedError)
+        self.assertIsInstance(results[1].original_exception, RPCError)
+
+    def test_get_transactions_batch_error(self):
+        def respond(requests):
+            raise RPCError(JSONRPC.EXCESSIVE_RESOURCE_USAGE, 'excessive resource usage')
+        with self.assertRaises(UntrustedServerReturnedError):
+            self._run_on_network(respond, lambda network: network.get_transactions([self.TXID_1]))
+
+    def test_get_transactions_checks_txids(self):
+        with self.assertRaises(Exception):
+            self._run_on_network(lambda requests: [], lambda network: network.get_transactions(["not a txid"]))
+
+    def test_subscribe_batch(self):
+        method = 'blockchain.scripthash.subscribe'
+        def respond(requests):
+            self.assertEqual([[self.TXID_1], [self.TXID_2]], [r['params'] for r in requests])
+            return [{'result': 'status1'}, {'result': None}]
+        async def f():
+            session = self._make_session(respond)
+            queue = asyncio.Queue()
+            await session.subscribe_batch(method, [[self.TXID_1], [self.TXID_2]], queue)
+            # cached statuses are not requested again
+            await session.subscribe_batch(method, [[self.TXID_1]], queue)
+            return [queue.get_nowait() for i in range(queue.qsize())]
+        results = self.loop.run_until_complete(f())
+        self.assertEqual([[self.TXID_1, 'status1'], [self.TXID_2, None], [self.TXID_1, 'status1']], results)
+
+    def test_subscribe_batch_failed_item_stays_subscribed(self):
+        method = 'blockchain.scripthash.subscribe'
+        answers = [[{'result': 'status1'}, {'error': {'code': 1, 'message': 'server busy'}}],
+                   [{'result': 'status2'}]]
+        def respond(requests):
+            return answers.pop(0)
+        async def f():
+            session = self._make_session(respond)
+            queue = asyncio.Queue()
+            with self.assertRaises(RPCError):
+                await session.subscribe_batch(method, [[self.TXID_1], [self.TXID_2]], queue)
+            # the answered item is delivered even though the batch failed
+            self.assertEqual([self.TXID_1, 'status1'], queue.get_nowait())
+            self.assertTrue(queue.empty())
+            key2 = session.get_hashable_key_for_rpc_call(method, [self.TXID_2])
+            self.assertNotIn(key2, session.cache)
+            self.assertIn(queue, session.subscriptions[key2])
+            # only the failed one is requested again
+            await session.subscribe_batch(method, [[self.TXID_1], [self.TXID_2]], queue)
+            return [queue.get_nowait() for i in range(queue.qsize())]
+        results = self.loop.run_until_complete(f())
+        self.assertEqual([[self.TXID_1, 'status1'], [self.TXID_2, 'status2']], results)
+        self.assertEqual([], answers)
 
 if __name__=="__main__":
     constants.set_regtest()
@@ -0,0 +1,288 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from unittest import mock
+
+from electrum import synchronizer
+from electrum.synchronizer import Synchronizer, SynchronizerFailure
+from electrum.network import Network, UntrustedServerReturnedError
+from electrum.storage import WalletStorage
+from electrum.address_synchronizer import AddressSynchronizer
+from electrum.util import NetworkJobOnDefaultServer
+from electrum.transaction import Transaction
+from electrum.bitcoin import hash160_to_p2pkh
+from aiorpcx import TaskGroup
+from aiorpcx.jsonrpc import RPCError
+
+from . import SequentialTestCase
+
+
+RAW_TX_1 = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+RAW_TX_2 = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff25033ca0030400001256124d696e656420627920425443204775696c640800000d41000007daffffffff01c00d1298000000001976a91427a1f12771de5cc3b73941664b2537c15316be4388ac00000000'
+TXID_1 = Transaction(RAW_TX_1).txid()
+TXID_2 = Transaction(RAW_TX_2).txid()
+
+
+ADDRESSES = [hash160_to_p2pkh(i.to_bytes(20, 'big')) for i in range(1000)]
+
+
+def not_found():
+    return UntrustedServerReturnedError(original_exception=RPCError(2, "No such mempool or blockchain transaction"))
+
+
+class TestSynchronizer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def _make_synchronizer(self):
+        sync = Synchronizer.__new__(Synchronizer)
+        sync.wallet = mock.Mock()
+        sync.wallet.diagnostic_name.return_value = 'test'
+        sync.wallet.db.has_transaction.return_value = False
+        sync.network = mock.Mock()
+        sync.interface = mock.Mock()
+        sync.logger = mock.Mock()
+        sync.asyncio_loop = self.loop
+        sync._reset()
+        return sync
+
+    def _run(self, coro_func):
+        async def f():
+            return await coro_func(self._make_synchronizer())
+        return self.loop.run_until_complete(f())
+
+    def test_get_transactions(self):
+        async def f(sync):
+            sync.network.get_transactions = mock.AsyncMock(return_value=[RAW_TX_1, RAW_TX_2])
+            sync.requested_tx = {TXID_1: 100, TXID_2: 101}
+            await sync._get_transactions([TXID_1, TXID_2])
+            return sync
+        sync = self._run(f)
+        self.assertEqual({}, sync.requested_tx)
+        calls = sync.wallet.receive_tx_callback.call_args_list
+        self.assertEqual([(TXID_1, 100), (TXID_2, 101)], [(c[0][0], c[0][2]) for c in calls])
+        self.assertEqual(TXID_1, calls[0][0][1].txid())
+        self.assertEqual((2, 2), sync.num_requests_sent_and_answered())
+
+    def test_get_transactions_txid_mismatch(self):
+        async def f(sync):
+            sync.network.get_transactions = mock.AsyncMock(return_value=[RAW_TX_2])
+            sync.requested_tx = {TXID_1: 100}
+            await sync._get_transactions([TXID_1])
+        with self.assertRaises(SynchronizerFailure):
+            self._run(f)
+
+    def test_get_transactions_not_found(self):
+        async def f(sync):
+            sync.network.get_transactions = mock.AsyncMock(return_value=[not_found(), RAW_TX_2])
+            sync.requested_tx = {TXID_1: 100, TXID_2: 101}
+            await sync._get_transactions([TXID_1, TXID_2], allow_server_not_finding_tx=True)
+            return sync
+        sync = self._run(f)
+        self.assertEqual({}, sync.requested_tx)
+        calls = sync.wallet.receive_tx_callback.call_args_list
+        self.assertEqual([TXID_2], [c[0][0] for c in calls])
+
+    def test_get_transactions_not_found_not_allowed(self):
+        async def f(sync):
+            sync.network.get_transactions = mock.AsyncMock(return_value=[not_found(), RAW_TX_2])
+            sync.requested_tx = {TXID_1: 100, TXID_2: 101}
+            await sync._get_transactions([TXID_1, TXID_2])
+        with self.assertRaises(UntrustedServerReturnedError):
+            self._run(f)
+
+    def test_tx_batches_in_flight_are_bounded(self):
+        in_flight = 0
+        max_in_flight = 0
+        async def get_transactions(tx_hashes):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+            return [not_found() for tx_hash in tx_hashes]
+        async def f(sync):
+            sync.network.get_transactions = get_transactions
+            hist = [("%064x" % i, 100) for i in range(20 * synchronizer.TX_BATCH_SIZE)]
+            await sync._request_missing_txs(hist, allow_server_not_finding_tx=True)
+            return sync
+        sync = self._run(f)
+        self.assertEqual({}, sync.requested_tx)
+        self.assertEqual(synchronizer.TX_BATCHES_IN_FLIGHT, max_in_flight)
+
+    def _subscribe_with_latency(self, sync, latency, rounds):
+        """Subscribe to batches of addresses one after the other, the
+        server taking 'latency' seconds to answer each batch."""
+        clock = 0
+        def monotonic():
+            return clock
+        async def subscribe_batch(method, params_list, queue):
+            nonlocal clock
+            clock += latency
+        sync.session.subscribe_batch = subscribe_batch
+        async def f():
+            with mock.patch.object(synchronizer.time, 'monotonic', monotonic):
+                for i in range(rounds):
+                    addrs = ADDRESSES[:synchronizer.SUBSCRIPTION_BATCH_SIZE]
+                    sync.requested_addrs |= set(addrs)
+                    sync._subscriptions_in_flight += len(addrs)
+                    await sync._subscribe_to_addresses(addrs)
+        return f()
+
+    def test_subscription_window_grows_and_shrinks(self):
+        async def f(sync):
+            sync._subscription_window_max = synchronizer.SUBSCRIPTION_WINDOW_MAX
+            self.assertEqual(synchronizer.SUBSCRIPTION_WINDOW_MIN, sync._subscription_window)
+            await self._subscribe_with_latency(sync, 0.1, rounds=1)
+            self.assertEqual(synchronizer.SUBSCRIPTION_WINDOW_MIN + synchronizer.SUBSCRIPTION_BATCH_SIZE,
+                             sync._subscription_window)
+            await self._subscribe_with_latency(sync, 0.1, rounds=20)
+            self.assertEqual(synchronizer.SUBSCRIPTION_WINDOW_MAX, sync._subscription_window)
+            await self._subscribe_with_latency(sync, 5, rounds=1)
+            self.assertEqual(synchronizer.SUBSCRIPTION_WINDOW_MAX // 2, sync._subscription_window)
+            await self._subscribe_with_latency(sync, 5, rounds=20)
+            self.assertEqual(synchronizer.SUBSCRIPTION_WINDOW_MIN, sync._subscription_window)
+            self.assertEqual(0, sync._subscriptions_in_flight)
+            self.assertEqual(set(), sync.requested_addrs)
+        self._run(f)
+
+    def test_subscription_window_respects_configured_max(self):
+        async def f(sync):
+            sync._subscription_window_max = 300
+            await self._subscribe_with_latency(sync, 0.1, rounds=20)
+            self.assertEqual(300, sync._subscription_window)
+        self._run(f)
+
+    def test_send_subscriptions_keeps_in_flight_within_window(self):
+        in_flight = 0
+        max_in_flight = 0
+        async def subscribe_batch(method, params_list, queue):
+            nonlocal in_flight, max_in_flight
+            in_flight += len(params_list)
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= len(params_list)
+        async def f(sync):
+            sync._subscription_window_max = synchronizer.SUBSCRIPTION_WINDOW_MAX
+            sync.session.subscribe_batch = subscribe_batch
+            sync.group = TaskGroup()
+            for addr in ADDRESSES:
+                await sync._add_address(addr)
+            await sync.group.spawn(sync.send_subscriptions())
+            while sync.requested_addrs:
+                self.assertLessEqual(sync._subscriptions_in_flight, sync._subscription_window)
+                await asyncio.sleep(0.001)
+            await sync.group.cancel_remaining()
+            return sync
+        sync = self._run(f)
+        self.assertLessEqual(max_in_flight, synchronizer.SUBSCRIPTION_WINDOW_MAX)
+        self.assertGreater(sync._subscription_window, synchronizer.SUBSCRIPTION_WINDOW_MIN)
+        self.assertEqual((len(ADDRESSES), len(ADDRESSES)), sync.num_requests_sent_and_answered())
+
+    def test_failed_subscription_keeps_addresses(self):
+        async def subscribe_batch(method, params_list, queue):
+            raise RPCError(1, 'server busy')
+        async def f(sync):
+            sync._subscription_window_max = synchronizer.SUBSCRIPTION_WINDOW_MAX
+            sync.session.subscribe_batch = subscribe_batch
+            addrs = ADDRESSES[:10]
+            sync.requested_addrs |= set(addrs)
+            sync._subscriptions_in_flight += len(addrs)
+            with self.assertRaises(RPCError):
+                await sync._subscribe_to_addresses(addrs)
+            return sync
+        sync = self._run(f)
+        # the addresses are still pending, so the wallet is not considered up to date
+        self.assertEqual(set(ADDRESSES[:10]), sync.requested_addrs)
+        self.assertEqual(0, sync._subscriptions_in_flight)
+        self.assertEqual((10, 0), sync.num_requests_sent_and_answered())
+
+
+class TestSynchronizerWakeup(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.user_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+        self.loop.close()
+        super().tearDown()
+
+    def _make_network(self):
+        network = Network.__new__(Network)
+        network.asyncio_loop = self.loop
+        network.config = {}
+        network.callbacks = defaultdict(list)
+        network.callback_lock = threading.Lock()
+        return network
+
+    def _make_synchronizer(self):
+        """Synchronizer for a wallet with no addresses, not connected to any server"""
+        wallet = mock.Mock()
+        wallet.network = self._make_network()
+        wallet.db.get_history.return_value = []
+        wallet.get_addresses.return_value = []
+        wallet.is_up_to_date.return_value = False
+        def job_init(job, network):
+            job.network = network
+            job._reset()
+        with mock.patch.object(NetworkJobOnDefaultServer, '__init__', job_init):
+            sync = Synchronizer(wallet)
+        sync.logger = mock.Mock()
+        return sync
+
+    def _run(self, coro_func):
+        async def f():
+            return await coro_func(self._make_synchronizer())
+        return self.loop.run_until_complete(f())
+
+    def test_add_address_wakes_up(self):
+        async def f(sync):
+            wallet = AddressSynchronizer(WalletStorage(os.path.join(self.user_dir, "somewallet")))
+            wallet.synchronizer = sync
+            self.assertFalse(sync._wakeup_event.is_set())
+            wallet.add_address(ADDRESSES[0])
+            await asyncio.sleep(0.01)
+            self.assertTrue(sync._wakeup_event.is_set())
+            self.assertEqual({ADDRESSES[0]}, sync.requested_addrs)
+        self._run(f)
+
+    def test_new_header_wakes_up(self):
+        async def f(sync):
+            self.assertFalse(sync._wakeup_event.is_set())
+            sync.network.trigger_callback('blockchain_updated')
+            await asyncio.sleep(0.01)
+            self.assertTrue(sync._wakeup_event.is_set())
+            await sync.stop()
+            sync._wakeup_event.clear()
+            sync.network.trigger_callback('blockchain_updated')
+            await asyncio.sleep(0.01)
+            self.assertFalse(sync._wakeup_event.is_set())
+        with mock.patch.object(NetworkJobOnDefaultServer, 'stop', mock.AsyncMock()):
+            self._run(f)
+
+    def test_idle_main_loop_does_not_synchronize(self):
+        async def f(sync):
+            task = asyncio.ensure_future(sync.main())
+            await asyncio.sleep(0.3)
+            self.assertEqual(1, sync.wallet.synchronize.call_count)
+            # nothing happened
+            await asyncio.sleep(0.3)
+            self.assertEqual(1, sync.wallet.synchronize.call_count)
+            sync.wakeup()
+            await asyncio.sleep(0.3)
+            self.assertEqual(2, sync.wallet.synchronize.call_count)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._run(f)
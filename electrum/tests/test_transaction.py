@@ -1,3 +1,5 @@
+from unittest import mock
+
 from electrum import transaction
 from electrum.transaction import TxOutputForUI, tx_from_str
 from electrum.bitcoin import TYPE_ADDRESS
@@ -55,6 +57,55 @@ class TestBCDataStream(SequentialTestCase):
         self.assertEqual(s.read_bytes(4), b'r')
         self.assertEqual(s.read_bytes(1), b'')
 
+    def test_read_from_buffer(self):
+        buf = b'\x03foo\x01\x00\x00\x00'
+        s = transaction.BCDataStream(buf)
+        self.assertEqual(s.read_bytes(s.read_compact_size()), b'foo')
+        self.assertEqual(s.read_uint32(), 1)
+        self.assertFalse(s.can_read_more())
+        # writing to a stream initialized with a buffer does not modify the buffer
+        s.write(b'bar')
+        self.assertEqual(s.read_bytes(3), b'bar')
+        self.assertEqual(buf, b'\x03foo\x01\x00\x00\x00')
+
+class TestTxInput(SequentialTestCase):
+
+    def test_dict_interface(self):
+        txin = transaction.TxInput(prevout_hash='11' * 32, prevout_n=1, scriptSig='')
+        self.assertEqual('11' * 32, txin['prevout_hash'])
+        self.assertEqual(b'', txin._scriptSig)
+        self.assertNotIn('witness', txin)
+        self.assertEqual('00', txin.get('witness', '00'))
+        with self.assertRaises(KeyError):
+            txin['witness']
+        txin['witness'] = None
+        self.assertIn('witness', txin)
+        self.assertIsNone(txin['witness'])
+        txin['prev_tx'] = 'tx'
+        self.assertEqual({'prevout_hash': '11' * 32, 'prevout_n': 1, 'scriptSig': '',
+                          'witness': None, 'prev_tx': 'tx'}, dict(txin))
+        del txin['prev_tx']
+        del txin['witness']
+        self.assertEqual(['prevout_hash', 'prevout_n', 'scriptSig'], txin.keys())
+
+    def test_serialize_without_hex(self):
+        tx = transaction.Transaction(signed_blob)
+        txin = tx.inputs()[0]
+        self.assertIsInstance(txin, transaction.TxInput)
+        with mock.patch.object(transaction.TxInput, 'prevout_hash', new_callable=mock.PropertyMock) as prevout_hash, \
+                mock.patch.object(transaction.TxInput, 'scriptSig', new_callable=mock.PropertyMock) as script_sig:
+            self.assertEqual(bfh(signed_blob), tx.serialize_to_network_bytes())
+            tx.estimated_size()
+        # the hex accessors were not used
+        prevout_hash.assert_not_called()
+        script_sig.assert_not_called()
+        # same as for a dict input
+        d = dict(txin)
+        self.assertEqual(tx.serialize_outpoint_bytes(txin), tx.serialize_outpoint_bytes(d))
+        self.assertEqual(tx.input_script_bytes(txin), tx.input_script_bytes(d))
+        self.assertEqual(txin['scriptSig'], tx.input_script(txin))
+
+
 class TestTransaction(SequentialTestCase):
 
     @needs_test_with_all_ecc_implementations
@@ -102,6 +153,24 @@ class TestTransaction(SequentialTestCase):
         tx.raw = None
         blob = str(tx)
         self.assertEqual(transaction.deserialize(blob), expected)
+        self.assertEqual(transaction.deserialize_bytes(bfh(blob)), expected)
+
+    def test_tx_from_bytes(self):
+        tx_hex = transaction.Transaction(signed_blob)
+        tx = transaction.Transaction(bfh(signed_blob))
+        self.assertEqual(tx_hex.txid(), tx.txid())
+        self.assertEqual(tx_hex.outputs(), tx.outputs())
+        self.assertEqual(tx_hex.inputs(), tx.inputs())
+        # the hex is only computed when asked for
+        self.assertIsNone(tx._raw)
+        self.assertEqual(bfh(signed_blob), tx.raw_bytes())
+        self.assertEqual(signed_blob, tx.raw)
+        self.assertEqual(signed_blob, str(tx))
+        self.assertEqual(bfh(signed_blob), tx_hex.raw_bytes())
+        # setting raw drops the bytes
+        tx.raw = None
+        self.assertEqual(signed_blob, str(tx))
+        self.assertIsNone(transaction.Transaction(b'').raw)
 
     @needs_test_with_all_ecc_implementations
     def test_tx_signed(self):
@@ -156,6 +225,35 @@ class TestTransaction(SequentialTestCase):
         self.assertEqual(tx.estimated_weight(), 561)
         self.assertEqual(tx.estimated_size(), 141)
 
+    def test_bip143_hashes_cache_invalidation(self):
+        raw_tx = '45505446ff000100000000010115a847356cbb44be67f345965bb3f2589e2fec1c9a0ada21fd28225dcc602e8f0100000000fdffffff02f6fd1200000000001600149c756aa33f4f89418b33872a973274b5445c727b80969800000000001600140f9de573bc679d040e763d13f0250bd03e625f6ffeffffffff9095ab000000000000000201ff53ff045f1cf6014af5fa07800000002fa3f450ba41799b9b62642979505817783a9b6c656dc11cd0bb4fa362096808026adc616c25a4d0a877d1741eb1db9cef65c15118bd7d5f31bf65f319edda81840100c8000f391400'
+        tx = transaction.Transaction(raw_tx)
+        tx.deserialize()
+        preimage = tx.serialize_preimage(0)
+        self.assertEqual(preimage, tx.serialize_preimage(0))
+        tx.set_rbf(False)
+        preimage_no_rbf = tx.serialize_preimage(0)
+        self.assertNotEqual(preimage, preimage_no_rbf)
+        tx2 = transaction.Transaction(tx.serialize())
+        tx2.deserialize()
+        self.assertEqual(preimage_no_rbf, tx2.serialize_preimage(0))
+        tx.add_outputs([transaction.TxOutput(TYPE_ADDRESS, 'bc1q3g5tmkmlvxryhh843v4dz026avatc0zzr6h3af', 10000)])
+        tx2 = transaction.Transaction(tx.serialize())
+        tx2.deserialize()
+        self.assertEqual(tx2.serialize_preimage(0), tx.serialize_preimage(0))
+
+    def test_txid_cache_invalidation(self):
+        tx = transaction.Transaction(signed_segwit_blob)
+        txid = tx.txid()
+        self.assertEqual(txid, tx.txid())
+        tx.locktime += 1
+        self.assertNotEqual(txid, tx.txid())
+        tx.locktime -= 1
+        self.assertEqual(txid, tx.txid())
+        tx.set_rbf(False)
+        self.assertNotEqual(txid, tx.txid())
+        self.assertEqual(transaction.Transaction(tx.serialize()).txid(), tx.txid())
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
@@ -1,7 +1,7 @@
 from decimal import Decimal
 
 from electrum.util import (format_satoshis, format_fee_satoshis, parse_URI,
-                           is_hash256_str, chunks)
+                           is_hash256_str, chunks, LRUCache)
 
 from . import SequentialTestCase
 
@@ -110,3 +110,17 @@ class TestUtil(SequentialTestCase):
                          list(chunks([1, 2, 3, 4, 5], 2)))
         with self.assertRaises(ValueError):
             list(chunks([1, 2, 3], 0))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        # 'b' was least recently used
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        cache.set_maxsize(1)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(3, cache.get('c'))
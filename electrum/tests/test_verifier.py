@@ -0,0 +1,210 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from unittest import mock
+
+from electrum.verifier import SPV, MerkleRootMismatch, MissingBlockHeader
+from electrum.spv_cache import SPVProofCache
+from electrum.crypto import sha256d
+from electrum.bitcoin import hash_encode
+from electrum.util import bfh, NetworkJobOnDefaultServer
+from electrum.blockchain import hash_header
+from electrum.network import Network
+from electrum.storage import WalletStorage
+from electrum.address_synchronizer import AddressSynchronizer
+
+from . import SequentialTestCase
+
+
+class TestVerifier(SequentialTestCase):
+
+    TXID_1 = "a2fc4af8b3eed8b9b4dba4ea5e1a6e2fa6a1d8bd5c7e6f9f1e85ce23f2d25b11"
+    TXID_2 = "5fd4e1fcf1ea5a6bd7bd2c2a2c2a8b6f1c5a06d3ee72c2c0d3bb1a16a4f3e6a2"
+
+    def _merkle_root(self):
+        # a block with two transactions
+        h1 = bfh(self.TXID_1)[::-1]
+        h2 = bfh(self.TXID_2)[::-1]
+        return hash_encode(sha256d(h1 + h2))
+
+    def test_verify_proofs_for_headers(self):
+        header = {'merkle_root': self._merkle_root()}
+        proofs_by_height = {
+            100: [(self.TXID_1, {'block_height': 100, 'pos': 0, 'merkle': [self.TXID_2]}),
+                  (self.TXID_2, {'block_height': 100, 'pos': 1, 'merkle': [self.TXID_1]}),
+                  # wrong position
+                  (self.TXID_1, {'block_height': 100, 'pos': 1, 'merkle': [self.TXID_2]})],
+            # no header at this height
+            101: [(self.TXID_1, {'block_height': 101, 'pos': 0, 'merkle': [self.TXID_2]})],
+        }
+        results = SPV._verify_proofs_for_headers(proofs_by_height, {100: header, 101: None})
+        self.assertEqual([self.TXID_1, self.TXID_2, self.TXID_1, self.TXID_1],
+                         [tx_hash for tx_hash, merkle, error in results])
+        errors = [error for tx_hash, merkle, error in results]
+        self.assertIsNone(errors[0])
+        self.assertIsNone(errors[1])
+        self.assertIsInstance(errors[2], MerkleRootMismatch)
+        self.assertIsInstance(errors[3], MissingBlockHeader)
+
+
+class TestSPVProofCache(SequentialTestCase):
+
+    def test_get_add_remove(self):
+        cache = SPVProofCache(None)
+        merkle1 = {'block_height': 100, 'pos': 0, 'merkle': ["aa" * 32]}
+        merkle2 = {'block_height': 101, 'pos': 3, 'merkle': ["bb" * 32, "cc" * 32]}
+        cache.add_proofs("w1", [("11" * 32, "00" * 32, merkle1),
+                                ("22" * 32, "01" * 32, merkle2)])
+        self.assertEqual(merkle1, cache.get("11" * 32, "00" * 32))
+        self.assertEqual(merkle2, cache.get("22" * 32, "01" * 32))
+        # the same tx in another block
+        self.assertIsNone(cache.get("11" * 32, "01" * 32))
+        # reorg
+        cache.remove_above_height(100)
+        self.assertEqual(merkle1, cache.get("11" * 32, "00" * 32))
+        self.assertIsNone(cache.get("22" * 32, "01" * 32))
+
+    def test_remove_wallet(self):
+        cache = SPVProofCache(None)
+        merkle1 = {'block_height': 100, 'pos': 0, 'merkle': ["aa" * 32]}
+        merkle2 = {'block_height': 101, 'pos': 3, 'merkle': ["bb" * 32]}
+        cache.add_proofs("w1", [("11" * 32, "00" * 32, merkle1), ("22" * 32, "01" * 32, merkle2)])
+        cache.add_proofs("w2", [("11" * 32, "00" * 32, merkle1)])
+        cache.remove_wallet("w1")
+        # still known to the other wallet
+        self.assertEqual(merkle1, cache.get("11" * 32, "00" * 32))
+        self.assertIsNone(cache.get("22" * 32, "01" * 32))
+        cache.remove_wallet("w2")
+        self.assertIsNone(cache.get("11" * 32, "00" * 32))
+
+    def test_get_many_remove_proofs(self):
+        cache = SPVProofCache(None)
+        merkle1 = {'block_height': 100, 'pos': 0, 'merkle': ["aa" * 32]}
+        merkle2 = {'block_height': 101, 'pos': 3, 'merkle': ["bb" * 32]}
+        cache.add_proofs("w1", [("11" * 32, "00" * 32, merkle1), ("22" * 32, "01" * 32, merkle2)])
+        keys = [("11" * 32, "00" * 32), ("22" * 32, "01" * 32), ("11" * 32, "01" * 32), ("33" * 32, "00" * 32)]
+        self.assertEqual({keys[0]: merkle1, keys[1]: merkle2}, cache.get_many(keys))
+        cache.remove_proofs([keys[1]])
+        self.assertEqual({keys[0]: merkle1}, cache.get_many(keys))
+        self.assertEqual({}, cache.get_many([]))
+
+    def test_evict_oldest(self):
+        cache = SPVProofCache(None, max_proofs=2)
+        merkles = [{'block_height': 100 + i, 'pos': i, 'merkle': ["aa" * 32]} for i in range(3)]
+        for i, merkle in enumerate(merkles):
+            cache.add_proofs("w1", [("%02x" % i * 32, "00" * 32, merkle)])
+        self.assertIsNone(cache.get("00" * 32, "00" * 32))
+        self.assertEqual(merkles[1], cache.get("01" * 32, "00" * 32))
+        self.assertEqual(merkles[2], cache.get("02" * 32, "00" * 32))
+
+
+class TestSPVJob(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.user_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+        self.loop.close()
+        super().tearDown()
+
+    def _make_spv(self):
+        """SPV of an empty wallet, not connected to any server"""
+        network = Network.__new__(Network)
+        network.asyncio_loop = self.loop
+        network.callbacks = defaultdict(list)
+        network.callback_lock = threading.Lock()
+        wallet = AddressSynchronizer(WalletStorage(os.path.join(self.user_dir, "somewallet")))
+        def job_init(job, network):
+            job.network = network
+            job._reset()
+        with mock.patch.object(NetworkJobOnDefaultServer, '__init__', job_init):
+            spv = SPV(network, wallet)
+        spv.logger = mock.Mock()
+        wallet.verifier = spv
+        return spv
+
+    def _run(self, coro_func):
+        async def f():
+            return await coro_func(self._make_spv())
+        return self.loop.run_until_complete(f())
+
+    def test_add_unverified_tx_wakes_up(self):
+        async def f(spv):
+            self.assertFalse(spv._wakeup_event.is_set())
+            spv.wallet.add_unverified_tx(TestVerifier.TXID_1, 100)
+            await asyncio.sleep(0.01)
+            self.assertTrue(spv._wakeup_event.is_set())
+        self._run(f)
+
+    def test_new_header_wakes_up(self):
+        async def f(spv):
+            self.assertFalse(spv._wakeup_event.is_set())
+            spv.network.trigger_callback('blockchain_updated')
+            await asyncio.sleep(0.01)
+            self.assertTrue(spv._wakeup_event.is_set())
+        self._run(f)
+
+    def test_idle_main_loop_does_not_request_proofs(self):
+        async def f(spv):
+            spv.network.blockchain = mock.Mock()
+            spv._maybe_undo_verifications = mock.AsyncMock()
+            spv._request_proofs = mock.AsyncMock()
+            task = asyncio.ensure_future(spv.main())
+            await asyncio.sleep(0.1)
+            self.assertEqual(1, spv._request_proofs.call_count)
+            # nothing happened
+            await asyncio.sleep(0.1)
+            self.assertEqual(1, spv._request_proofs.call_count)
+            spv.wakeup()
+            await asyncio.sleep(0.1)
+            self.assertEqual(2, spv._request_proofs.call_count)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._run(f)
+
+    def test_failed_cached_proof_is_removed(self):
+        header = {'version': 1, 'prev_block_hash': "00" * 32, 'merkle_root': TestVerifier()._merkle_root(),
+                  'timestamp': 1231006505, 'bits': 0x1d00ffff, 'nonce': 0}
+        block_hash = hash_header(header)
+        good = {'block_height': 100, 'pos': 0, 'merkle': [TestVerifier.TXID_2]}
+        bad = {'block_height': 100, 'pos': 0, 'merkle': [TestVerifier.TXID_1]}
+        async def f(spv):
+            blockchain = mock.Mock()
+            blockchain.height.return_value = 200
+            blockchain.read_header.return_value = header
+            spv.blockchain = blockchain
+            spv.network.blockchain = lambda: blockchain
+            spv.network.bhi_lock = asyncio.Lock()
+            spv.network.config = {}
+            spv.network.spv_proof_cache = cache = SPVProofCache(None)
+            cache.add_proofs("w1", [(TestVerifier.TXID_1, block_hash, good), (TestVerifier.TXID_2, block_hash, bad)])
+            spv.wallet.network = spv.network
+            spv.wallet.add_unverified_tx(TestVerifier.TXID_1, 100)
+            spv.wallet.add_unverified_tx(TestVerifier.TXID_2, 100)
+            spv.group = mock.Mock()
+            spv.group.spawn = mock.AsyncMock()
+            with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                await spv._request_proofs()
+            # both were looked up in one go
+            self.assertEqual(1, get_many.call_count)
+            spv.group.spawn.assert_not_called()
+            spv._wakeup_event.clear()
+            task = asyncio.ensure_future(spv._verify_proofs())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.assertEqual({}, spv.proofs_from_cache)
+            self.assertEqual(set(), spv.requested_merkle)
+            self.assertIn(TestVerifier.TXID_1, spv.merkle_roots)
+            # the bad proof is gone, so that the server is asked instead of looping on it
+            self.assertIsNone(cache.get(TestVerifier.TXID_2, block_hash))
+            self.assertTrue(spv._wakeup_event.is_set())
+            await spv._request_proofs()
+            spv.group.spawn.assert_called_once_with(spv._request_proofs_batch, [(TestVerifier.TXID_2, 100)])
+        self._run(f)
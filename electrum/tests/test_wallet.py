@@ -7,14 +7,16 @@ from decimal import Decimal
 import time
 
 from io import StringIO
-from electrum.storage import WalletStorage
+from electrum.storage import WalletStorage, STO_EV_USER_PW
 from electrum.json_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text, Imported_Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
-from electrum.util import TxMinedInfo
+from electrum.util import TxMinedInfo, WalletFileException
+from electrum.transaction import Transaction
 from electrum.bitcoin import COIN
 from electrum.json_db import JsonDB
+from electrum.address_synchronizer import AddressSynchronizer
 
 from . import SequentialTestCase
 
@@ -79,6 +81,243 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_readonly_get(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("d", {"a": [1, {"b": 2}]})
+        v = storage.get("d", readonly=True)
+        self.assertEqual({"a": [1, {"b": 2}]}, v)
+        self.assertEqual(2, v["a"][1]["b"])
+        with self.assertRaises(TypeError):
+            v["a"][1]["b"] = 3
+        # a private copy can be modified, and put back
+        d = v.copy()
+        d["a"].append(3)
+        self.assertEqual([1, {"b": 2}], storage.get("d")["a"])
+        storage.put("d", d)
+        self.assertEqual([1, {"b": 2}, 3], storage.get("d", readonly=True)["a"])
+        self.assertEqual("x", storage.get("missing", "x", readonly=True))
+
+    def test_scheduled_writes_are_coalesced(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write_delay = 60
+        storage.put("a", "b")
+        storage.schedule_write()
+        storage.put("c", "d")
+        storage.schedule_write()
+        self.assertFalse(os.path.exists(self.wallet_path))
+        storage.flush()
+        self.assertIsNone(storage._write_timer)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual("d", storage.get("c"))
+
+    def test_scheduled_write_happens_in_background(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write_delay = 0.5
+        storage.put("a", "b")
+        storage.schedule_write()
+        t = storage._write_timer
+        t.join()
+        self.assertTrue(os.path.exists(self.wallet_path))
+        self.assertFalse(storage.db.modified())
+
+    def test_changes_are_appended_to_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        self.assertFalse(os.path.exists(storage.journal_path))
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+
+        storage.put("a", "c")
+        storage.put("d", {"e": 1})
+        storage.db.add_txi_addr("txid", "addr", "prevout:0", 100)
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(contents, f.read())
+        self.assertTrue(os.path.exists(storage.journal_path))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual({"e": 1}, storage.get("d"))
+        self.assertEqual({("prevout:0", 100)}, storage.db.get_txi_addr("txid", "addr"))
+
+    def test_readding_known_tx_is_not_journaled(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        txid = tx.txid()
+        db = JsonDB('', manual_upgrades=False)
+        db.set_modified(False)
+        db.add_transaction(txid, tx)
+        db.add_txo_addr(txid, "addr", 0, 1000000, False)
+        db.set_spent_outpoint("prevout", 0, txid)
+        self.assertTrue(db.modified())
+        self.assertEqual(3, len(json.loads(db.pop_pending_changes())))
+        # the same data again, as on every history update
+        db.add_transaction(txid, Transaction(raw_tx))
+        db.add_txo_addr(txid, "addr", 0, 1000000, False)
+        db.set_spent_outpoint("prevout", 0, txid)
+        self.assertFalse(db.modified())
+        self.assertEqual([], json.loads(db.pop_pending_changes()))
+        # another output of the tx is journaled, the tx itself is not
+        db.add_txo_addr(txid, "addr2", 1, 5, False)
+        self.assertEqual([["set", ["txo", txid, "addr2"], [[1, 5, False]]]],
+                         json.loads(db.pop_pending_changes()))
+
+    def test_has_transaction_does_not_fill_tx_cache(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        txid = tx.txid()
+        db = JsonDB('', manual_upgrades=False)
+        db.add_transaction(txid, tx)
+        db._tx_cache.clear()
+        self.assertTrue(db.has_transaction(txid))
+        self.assertFalse(db.has_transaction("00" * 32))
+        self.assertEqual(0, len(db._tx_cache))
+
+    def test_get_transaction_parses_bytes(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        txid = Transaction(raw_tx).txid()
+        db = JsonDB('', manual_upgrades=False)
+        db.add_transaction(txid, Transaction(raw_tx))
+        db._tx_cache.clear()
+        tx = db.get_transaction(txid)
+        self.assertEqual(txid, tx.txid())
+        self.assertEqual(1000000, tx.output_value())
+        # loaded from the wallet file without a hex round trip
+        self.assertIsNone(tx._raw)
+        self.assertEqual(raw_tx, str(tx))
+
+    def test_add_address_is_journaled(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write()
+        AddressSynchronizer(storage).add_address("addr")
+        storage.write()
+        self.assertTrue(os.path.exists(storage.journal_path))
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.db.is_addr_in_history("addr"))
+
+    def test_put_item_journals_single_entry(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("labels", {"a": "x" * 1000, "b": "y"})
+        storage.write()
+        storage.put_item("labels", "b", "z")
+        storage.put_item("labels", "a", None)
+        storage.put_item("labels", "c", "w")
+        changes = [json.loads(x) for x in storage.db._pending_changes]
+        self.assertEqual([["set", ["labels", "b"], "z"], ["del", ["labels", "a"]], ["set", ["labels", "c"], "w"]],
+                         changes)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"b": "z", "c": "w"}, storage.get("labels"))
+
+    def test_journal_torn_trailing_entry_is_discarded(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        with open(storage.journal_path, "a") as f:
+            f.write('[["set", ["a"], "d')
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("c", storage.get("a"))
+        storage.put("x", "y")
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual("y", storage.get("x"))
+
+    def test_journal_is_compacted_into_wallet_file(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write()
+        for i in range(50):
+            storage.put("key%d" % i, "x" * 100)
+            storage.write()
+        # the journal never grows much beyond the size of the wallet file
+        self.assertLess(storage._get_journal_size(), 2 * os.path.getsize(self.wallet_path))
+        storage = WalletStorage(self.wallet_path)
+        for i in range(50):
+            self.assertEqual("x" * 100, storage.get("key%d" % i))
+
+    def test_stale_journal_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        os.unlink(self.wallet_path)
+
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("b", storage.get("a"))
+
+    def test_journal_of_encrypted_storage(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.set_password("secret", enc_version=STO_EV_USER_PW)
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        with open(storage.journal_path, "r") as f:
+            self.assertNotIn('"c"', f.read())
+
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+
+    def test_encrypted_storage_roundtrip_large(self):
+        value = {str(i): "é" * (i % 50) for i in range(20000)}
+        storage = WalletStorage(self.wallet_path)
+        storage.put("big", value)
+        storage.set_password("secret", enc_version=STO_EV_USER_PW)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        storage.decrypt("secret")
+        self.assertEqual(value, storage.get("big"))
+
+    def test_convert_to_sqlite(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        txid = tx.txid()
+        storage = WalletStorage(self.wallet_path)
+        storage.put("labels", {txid: "hello"})
+        storage.db.load_addresses('standard')
+        storage.db.add_receiving_address("addr1")
+        storage.db.add_transaction(txid, tx)
+        storage.db.add_txo_addr(txid, "addr1", 0, 1000000, False)
+        storage.db.set_addr_history("addr1", [[txid, 100]])
+        storage.db.add_verified_tx(txid, TxMinedInfo(height=100, timestamp=1234, txpos=1, header_hash='00ff'))
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        backup_path = storage.convert_to_sqlite()
+        self.assertTrue(os.path.exists(backup_path))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('sqlite', storage.db_type)
+        db = storage.db
+        db.load_addresses('standard')
+        self.assertEqual({txid: "hello"}, storage.get("labels"))
+        self.assertEqual(["addr1"], db.get_receiving_addresses())
+        self.assertEqual((False, 0), db.get_address_index("addr1"))
+        self.assertEqual(raw_tx, str(db.get_transaction(txid)))
+        self.assertEqual([txid], db.list_transactions())
+        self.assertEqual(["addr1"], db.get_txo(txid))
+        self.assertEqual({(0, 1000000, False)}, db.get_txo_addr(txid, "addr1"))
+        self.assertEqual([[txid, 100]], db.get_addr_history("addr1"))
+        self.assertEqual(100, db.get_verified_tx(txid).height)
+        self.assertEqual('00ff', db.get_verified_tx(txid).header_hash)
+
+        db.remove_verified_tx(txid)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertIsNone(storage.db.get_verified_tx(txid))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -99,7 +338,8 @@ class FakeWallet:
         super().__init__()
         self.fiat_value = fiat_value
         self.db = JsonDB("{}", manual_upgrades=True)
-        self.db.transactions = self.db.verified_tx = {'abc':'Tx'}
+        self.db.transactions = {'abc': b'Tx'}
+        self.db.verified_tx = {'abc':'Tx'}
 
     def get_tx_height(self, txid):
         # because we use a current timestamp, and history is empty,
@@ -110,6 +350,7 @@ class FakeWallet:
     price_at_timestamp = Abstract_Wallet.price_at_timestamp
     class storage:
         put = lambda self, x: None
+        put_item = lambda self, x, y: None
 
 txid = 'abc'
 ccy = 'TEST'
@@ -163,6 +404,25 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(d['seed'], wallet.keystore.get_seed(password))
         self.assertEqual(encrypt_file, wallet.storage.is_encrypted())
 
+    def test_create_new_wallet_sqlite(self):
+        d = create_new_wallet(path=self.wallet_path,
+                              password='mypassword',
+                              encrypt_file=False,
+                              segwit=True,
+                              db_type='sqlite')
+        wallet = d['wallet']  # type: Standard_Wallet
+        addresses = wallet.get_receiving_addresses()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('sqlite', storage.db_type)
+        wallet = Standard_Wallet(storage)
+        wallet.check_password('mypassword')
+        self.assertEqual(d['seed'], wallet.keystore.get_seed('mypassword'))
+        self.assertEqual(addresses, wallet.get_receiving_addresses())
+
+    def test_sqlite_wallet_cannot_be_encrypted(self):
+        with self.assertRaises(WalletFileException):
+            create_new_wallet(path=self.wallet_path, password='mypassword', encrypt_file=True, db_type='sqlite')
+
     def test_restore_wallet_from_text_mnemonic(self):
         text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
         passphrase = 'mypassphrase'
@@ -204,6 +464,19 @@ class TestCreateRestoreWallet(WalletTestCase):
         wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
+    def test_restore_wallet_from_text_privkeys_sqlite(self):
+        text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL p2wpkh:L24GxnN7NNUAfCXA6hFzB1jt59fYAAiFZMcLaJ2ZSawGpM3uqhb1'
+        d = restore_wallet_from_text(text, path=self.wallet_path, network=None, db_type='sqlite')
+        wallet = d['wallet']  # type: Imported_Wallet
+        addr0 = wallet.get_receiving_addresses()[0]
+        self.assertEqual('bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw', addr0)
+        self.assertEqual('p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL',
+                         wallet.export_private_key(addr0, password=None)[0])
+        wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
+        wallet.storage.write()
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual([addr0], wallet.get_receiving_addresses())
+
     def test_restore_wallet_from_text_privkeys(self):
         text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL p2wpkh:L24GxnN7NNUAfCXA6hFzB1jt59fYAAiFZMcLaJ2ZSawGpM3uqhb1'
         d = restore_wallet_from_text(text, path=self.wallet_path, network=None)
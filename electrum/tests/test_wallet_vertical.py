@@ -7,7 +7,7 @@ import asyncio
 from electrum import storage, bitcoin, keystore, bip32
 from electrum import Transaction
 from electrum import SimpleConfig
-from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_LOCAL
 from electrum.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet
 from electrum.util import bfh, bh2u
 from electrum.transaction import TxOutput
@@ -946,6 +946,87 @@ class TestWalletSending(TestCaseForTestnet):
         wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual((0, funding_output_value - 50000, 0), wallet.get_balance())
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_index_is_kept_up_to_date(self, mock_write):
+        wallet = self.create_standard_wallet_from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean')
+        funding_tx = Transaction('010000000001010f40064d66d766144e17bb3276d96042fd5aee2196bcce7e415f839e55a83de800000000171600147b6d7c7763b9185b95f367cf28e4dc6d09441e73fdffffff02404b4c00000000001976a9141df43441a3a3ee563e560d3ddc7e07cc9f9c3cdb88ac009871000000000017a9143873281796131b1996d2f94ab265327ee5e9d6e28702473044022029c124e5a1e2c6fa12e45ccdbdddb45fec53f33b982389455b110fdb3fe4173102203b3b7656bca07e4eae3554900aa66200f46fec0af10e83daaa51d9e4e62a26f4012103c8f0460c245c954ef563df3b1743ea23b965f98b120497ac53bd6b8e8e9e0f9bbe391400')
+        funding_txid = funding_tx.txid()
+        self.assertEqual([], wallet.get_history())
+        wallet.receive_tx_callback(funding_txid, funding_tx, TX_HEIGHT_UNCONFIRMED)
+        tx = wallet.cpfp(funding_tx, fee=50000)
+        wallet.sign_transaction(tx, password=None)
+        wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual([(funding_txid, 5000000, 5000000), (tx.txid(), -50000, 4950000)],
+                         [(txid, delta, balance) for txid, mined, delta, balance in wallet.get_history()])
+        # confirm the child only: it now sorts before its unconfirmed parent
+        wallet.add_unverified_tx(tx.txid(), 1325503)
+        self.assertEqual([tx.txid(), funding_txid], [h[0] for h in wallet.get_history()])
+        self.assertEqual(1325503, wallet.get_history()[0][1].height)
+        self.assertEqual(wallet.get_history(wallet.get_addresses()), wallet.get_history())
+        wallet.remove_unverified_tx(tx.txid(), 1325503)
+        self.assertEqual([funding_txid, tx.txid()], [h[0] for h in wallet.get_history()])
+        wallet.remove_transaction(tx.txid())
+        self.assertEqual(wallet.get_history(wallet.get_addresses()), wallet.get_history())
+        self.assertEqual([funding_txid], [h[0] for h in wallet.get_history()])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_index_of_unsynchronized_history_is_empty(self, mock_write):
+        wallet = self.create_standard_wallet_from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean')
+        funding_tx = Transaction('010000000001010f40064d66d766144e17bb3276d96042fd5aee2196bcce7e415f839e55a83de800000000171600147b6d7c7763b9185b95f367cf28e4dc6d09441e73fdffffff02404b4c00000000001976a9141df43441a3a3ee563e560d3ddc7e07cc9f9c3cdb88ac009871000000000017a9143873281796131b1996d2f94ab265327ee5e9d6e28702473044022029c124e5a1e2c6fa12e45ccdbdddb45fec53f33b982389455b110fdb3fe4173102203b3b7656bca07e4eae3554900aa66200f46fec0af10e83daaa51d9e4e62a26f4012103c8f0460c245c954ef563df3b1743ea23b965f98b120497ac53bd6b8e8e9e0f9bbe391400')
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual(1, len(wallet.get_history()))
+        self.assertEqual(1, len(list(wallet.iter_history())))
+        # the running balance would not end at the wallet balance
+        with mock.patch.object(wallet, 'get_balance', return_value=(0, 0, 0)):
+            self.assertEqual([], wallet.get_history())
+            self.assertEqual([], list(wallet.iter_history()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_get_full_history_pagination(self, mock_write):
+        wallet = self.create_standard_wallet_from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean')
+        funding_tx = Transaction('010000000001010f40064d66d766144e17bb3276d96042fd5aee2196bcce7e415f839e55a83de800000000171600147b6d7c7763b9185b95f367cf28e4dc6d09441e73fdffffff02404b4c00000000001976a9141df43441a3a3ee563e560d3ddc7e07cc9f9c3cdb88ac009871000000000017a9143873281796131b1996d2f94ab265327ee5e9d6e28702473044022029c124e5a1e2c6fa12e45ccdbdddb45fec53f33b982389455b110fdb3fe4173102203b3b7656bca07e4eae3554900aa66200f46fec0af10e83daaa51d9e4e62a26f4012103c8f0460c245c954ef563df3b1743ea23b965f98b120497ac53bd6b8e8e9e0f9bbe391400')
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, 1325501)
+        tx = wallet.cpfp(funding_tx, fee=50000)
+        wallet.sign_transaction(tx, password=None)
+        wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        full = wallet.get_full_history()['transactions']
+        self.assertEqual([funding_tx.txid(), tx.txid()], [item['txid'] for item in full])
+        for domain in (None, wallet.get_addresses()):
+            page1 = wallet.get_full_history(domain, limit=1)
+            self.assertEqual(full[:1], page1['transactions'])
+            self.assertEqual('1325501:0:' + funding_tx.txid(), page1['next_cursor'])
+            page2 = wallet.get_full_history(domain, limit=1, cursor=page1['next_cursor'])
+            self.assertEqual(full[1:], page2['transactions'])
+            self.assertIsNone(page2['next_cursor'])
+            self.assertEqual(full[1:], wallet.get_full_history(domain, offset=1, limit=5)['transactions'])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_utxo_index_is_kept_up_to_date(self, mock_write):
+        wallet = self.create_standard_wallet_from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean')
+        funding_tx = Transaction('010000000001010f40064d66d766144e17bb3276d96042fd5aee2196bcce7e415f839e55a83de800000000171600147b6d7c7763b9185b95f367cf28e4dc6d09441e73fdffffff02404b4c00000000001976a9141df43441a3a3ee563e560d3ddc7e07cc9f9c3cdb88ac009871000000000017a9143873281796131b1996d2f94ab265327ee5e9d6e28702473044022029c124e5a1e2c6fa12e45ccdbdddb45fec53f33b982389455b110fdb3fe4173102203b3b7656bca07e4eae3554900aa66200f46fec0af10e83daaa51d9e4e62a26f4012103c8f0460c245c954ef563df3b1743ea23b965f98b120497ac53bd6b8e8e9e0f9bbe391400')
+        funding_txid = funding_tx.txid()
+        self.assertEqual([], wallet.get_utxos())
+        wallet.receive_tx_callback(funding_txid, funding_tx, TX_HEIGHT_UNCONFIRMED)
+        funding_coin = funding_txid + ':0'
+        self.assertEqual([funding_coin], [wallet._utxo_str_from_utxo(c) for c in wallet.get_utxos()])
+        self.assertEqual([], wallet.get_utxos(confirmed_only=True))
+        self.assertEqual([], wallet.get_utxos(excluded_coins={funding_coin}))
+        tx = wallet.cpfp(funding_tx, fee=50000)
+        wallet.sign_transaction(tx, password=None)
+        wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_LOCAL)
+        child_coin = tx.txid() + ':0'
+        self.assertEqual([child_coin], [wallet._utxo_str_from_utxo(c) for c in wallet.get_utxos()])
+        self.assertEqual([], wallet.get_utxos(nonlocal_only=True))
+        wallet.add_unverified_tx(tx.txid(), 1325503)
+        coins = wallet.get_utxos(confirmed_only=True)
+        self.assertEqual([(child_coin, 1325503, 4950000)],
+                         [(wallet._utxo_str_from_utxo(c), c['height'], c['value']) for c in coins])
+        self.assertEqual({child_coin}, set(wallet.get_addr_utxo(coins[0]['address'])))
+        self.assertEqual([], wallet.get_utxos(excluded_addresses={coins[0]['address']}))
+        # removing the spending tx gives back the coin it spent
+        wallet.remove_transaction(tx.txid())
+        self.assertEqual([funding_coin], [wallet._utxo_str_from_utxo(c) for c in wallet.get_utxos()])
+
     @needs_test_with_all_ecc_implementations
     @mock.patch.object(storage.WalletStorage, '_write')
     def test_bump_fee_p2wpkh(self, mock_write):
@@ -1745,3 +1826,20 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_unchanged_history_does_not_reparse_txs(self, mock_write):
+        w = self.create_wallet()
+        w.storage.put('stored_height', 1316917 + 100)
+        for txid in self.transactions:
+            tx = Transaction(self.transactions[txid])
+            w.add_transaction(tx.txid(), tx)
+        addr = 'tb1qj4pnq958k89zcem3342lhcgyz0rnmhkzl6x0cl'  # HD index 4
+        txid = 'fde0b68938709c4979827caa576e9455ded148537fdb798fd05680da64dc1b4f'
+        w.receive_history_callback(addr, [(txid, 1316917)], {})
+        with mock.patch.object(w.db, 'get_transaction', wraps=w.db.get_transaction) as mock_get:
+            w.receive_history_callback(addr, [(txid, 1316917)], {})
+            self.assertEqual(0, mock_get.call_count)
+            # a new height is looked at again
+            w.receive_history_callback(addr, [(txid, 1316918)], {})
+            self.assertEqual(1, mock_get.call_count)
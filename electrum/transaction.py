@@ -37,7 +37,7 @@ from . import ecc, bitcoin, constants, segwit_addr
 from .util import profiler, to_bytes, bh2u, bfh
 from .bitcoin import (TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT, hash_160,
                       hash160_to_p2sh, hash160_to_p2pkh, hash_to_segwit_addr,
-                      hash_encode, var_int, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
+                      hash_encode, var_int, var_int_bytes, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC, COIN,
                       push_script, int_to_hex, push_script, b58_address_to_hash160,
                       opcodes, add_number_to_script, base_decode, is_segwit_script_type)
 from .crypto import sha256d
@@ -86,12 +86,135 @@ class TxOutputHwInfo(NamedTuple):
     script_type: str
 
 
+class TxInput(object):
+    """An input of a deserialized transaction.
+
+    Wallets keep many of these in memory, so fields are slots, and the
+    prevout hash and scripts are stored as bytes. For compatibility with
+    the dicts previously used for inputs, it can be accessed like a dict
+    (txin['scriptSig'], txin.get('witness'), 'value' in txin, ...), with
+    hex strings for those fields. Keys that are not fields are kept in
+    a separate dict.
+    """
+
+    __slots__ = ('_prevout_hash', 'prevout_n', '_scriptSig', 'sequence', 'type', 'address',
+                 'num_sig', 'x_pubkeys', 'pubkeys', 'signatures', '_witness', 'value',
+                 'witness_version', 'redeem_script', 'witness_script', '_extra')
+
+    FIELDS = ('prevout_hash', 'prevout_n', 'scriptSig', 'sequence', 'type', 'address',
+              'num_sig', 'x_pubkeys', 'pubkeys', 'signatures', 'witness', 'value',
+              'witness_version', 'redeem_script', 'witness_script')
+    _FIELDS_SET = frozenset(FIELDS)
+
+    def __init__(self, **kwargs):
+        self._extra = None  # type: Optional[dict]
+        for k, v in kwargs.items():
+            self[k] = v
+
+    @property
+    def prevout_hash(self) -> str:
+        return bh2u(self._prevout_hash)
+
+    @prevout_hash.setter
+    def prevout_hash(self, prevout_hash: str):
+        self._prevout_hash = bfh(prevout_hash)
+
+    @property
+    def scriptSig(self) -> Optional[str]:
+        return bh2u(self._scriptSig) if self._scriptSig is not None else None
+
+    @scriptSig.setter
+    def scriptSig(self, script_sig: Optional[str]):
+        self._scriptSig = bfh(script_sig) if script_sig is not None else None
+
+    @property
+    def witness(self) -> Optional[str]:
+        return bh2u(self._witness) if self._witness is not None else None
+
+    @witness.setter
+    def witness(self, witness: Optional[str]):
+        self._witness = bfh(witness) if witness is not None else None
+
+    def __getitem__(self, key):
+        if key in self._FIELDS_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._FIELDS_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELDS_SET:
+            try:
+                delattr(self, '_' + key if key in ('prevout_hash', 'scriptSig', 'witness') else key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        keys = [k for k in self.FIELDS if k in self]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (TxInput, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"TxInput({dict(self.items())!r})"
+
+
 class BCDataStream(object):
-    """Workalike python implementation of Bitcoin's CDataStream class."""
+    """Workalike python implementation of Bitcoin's CDataStream class.
 
-    def __init__(self):
-        self.input = None
+    If initialized with bytes, the stream reads from a memoryview of them
+    without copying; read_bytes then returns memoryviews into that buffer.
+    """
+
+    def __init__(self, _bytes: Optional[bytes] = None):
+        self.input = None  # type: Optional[Union[bytearray, memoryview]]
         self.read_cursor = 0
+        if _bytes is not None:
+            self.input = memoryview(_bytes)
 
     def clear(self):
         self.input = None
@@ -101,6 +224,8 @@ class BCDataStream(object):
         if self.input is None:
             self.input = bytearray(_bytes)
         else:
+            if isinstance(self.input, memoryview):
+                self.input = bytearray(self.input)
             self.input += bytearray(_bytes)
 
     def read_string(self, encoding='ascii'):
@@ -116,7 +241,7 @@ class BCDataStream(object):
 
         length = self.read_compact_size()
 
-        return self.read_bytes(length).decode(encoding)
+        return bytes(self.read_bytes(length)).decode(encoding)
 
     def write_string(self, string, encoding='ascii'):
         string = to_bytes(string, encoding)
@@ -424,25 +549,25 @@ def get_address_from_output_script(_bytes: bytes, *, net=None) -> Tuple[int, str
     return TYPE_SCRIPT, bh2u(_bytes)
 
 
-def parse_input(vds, full_parse: bool):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
+def parse_input(vds, full_parse: bool) -> TxInput:
+    d = TxInput()
+    prevout_hash = bytes(vds.read_bytes(32))[::-1]
     prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
+    scriptSig = bytes(vds.read_bytes(vds.read_compact_size()))
     sequence = vds.read_uint32()
-    d['prevout_hash'] = prevout_hash
-    d['prevout_n'] = prevout_n
-    d['scriptSig'] = bh2u(scriptSig)
-    d['sequence'] = sequence
-    d['type'] = 'unknown' if prevout_hash != '00'*32 else 'coinbase'
-    d['address'] = None
-    d['num_sig'] = 0
+    d._prevout_hash = prevout_hash
+    d.prevout_n = prevout_n
+    d._scriptSig = scriptSig
+    d.sequence = sequence
+    d.type = 'unknown' if any(prevout_hash) else 'coinbase'
+    d.address = None
+    d.num_sig = 0
     if not full_parse:
         return d
-    d['x_pubkeys'] = []
-    d['pubkeys'] = []
-    d['signatures'] = {}
-    if d['type'] != 'coinbase' and scriptSig:
+    d.x_pubkeys = []
+    d.pubkeys = []
+    d.signatures = {}
+    if d.type != 'coinbase' and scriptSig:
         try:
             parse_scriptSig(d, scriptSig)
         except BaseException:
@@ -522,7 +647,7 @@ def parse_output(vds, i):
         raise SerializationError('invalid output amount (too large)')
     if d['value'] < 0:
         raise SerializationError('invalid output amount (negative)')
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    scriptPubKey = bytes(vds.read_bytes(vds.read_compact_size()))
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = bh2u(scriptPubKey)
     d['prevout_n'] = i
@@ -530,7 +655,12 @@ def parse_output(vds, i):
 
 
 def deserialize(raw: str, force_full_parse=False) -> dict:
-    raw_bytes = bfh(raw)
+    return deserialize_bytes(bfh(raw), force_full_parse)
+
+
+def deserialize_bytes(raw_bytes: bytes, force_full_parse=False) -> dict:
+    """Like deserialize, for a raw tx that is already in bytes."""
+    raw_bytes = memoryview(raw_bytes)
     d = {}
     if raw_bytes[:5] == PARTIAL_TXN_HEADER_MAGIC:
         d['partial'] = is_partial = True
@@ -542,8 +672,7 @@ def deserialize(raw: str, force_full_parse=False) -> dict:
     else:
         d['partial'] = is_partial = False
     full_parse = force_full_parse or is_partial
-    vds = BCDataStream()
-    vds.write(raw_bytes)
+    vds = BCDataStream(raw_bytes)
     d['version'] = vds.read_int32()
     n_vin = vds.read_compact_size()
     is_segwit = (n_vin == 0)
@@ -593,10 +722,15 @@ class Transaction:
             self.raw = raw.strip() if raw else None
         elif isinstance(raw, dict):
             self.raw = raw['hex']
+        elif isinstance(raw, (bytes, bytearray)):
+            # e.g. from the wallet file; parsed without going through hex
+            self.raw = None
+            self._raw_bytes = bytes(raw) if raw else None
         else:
             raise Exception("cannot initialize transaction", raw)
         self._inputs = None
         self._outputs = None  # type: List[TxOutput]
+        self._invalidate_caches()
         self.locktime = 0
         self.version = 2
         # by default we assume this is a partial txn;
@@ -605,9 +739,60 @@ class Transaction:
         self._segwit_ser = None  # None means "don't know"
         self.output_info = None  # type: Optional[Dict[str, TxOutputHwInfo]]
 
+    @property
+    def raw(self) -> Optional[str]:
+        """The serialized tx in hex, or None if it has to be serialized again."""
+        if self._raw is None and self._raw_bytes is not None:
+            self._raw = bh2u(self._raw_bytes)
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw: Optional[str]):
+        self._raw = raw
+        self._raw_bytes = None
+
+    def raw_bytes(self) -> bytes:
+        """Like str(tx), in bytes."""
+        if self._raw_bytes is None:
+            raw = str(self)
+            self._raw_bytes = bfh(raw)
+            self._raw = raw
+        return self._raw_bytes
+
+    def _invalidate_caches(self):
+        """Called when inputs or outputs change."""
+        # ((num inputs, num outputs), (hashPrevouts, hashSequence, hashOutputs)), see serialize_preimage
+        self._cached_bip143_hashes = None  # type: Optional[Tuple[Tuple[int, int], Tuple[bytes, bytes, bytes]]]
+        self._invalidate_txid_cache()
+
+    def _invalidate_txid_cache(self):
+        """Called when signatures, locktime or version change.
+        These are not part of the BIP143 hashes, so those stay cached."""
+        self._cached_txid = None  # type: Optional[str]
+        self._cached_wtxid = None  # type: Optional[str]
+
+    @property
+    def locktime(self) -> int:
+        return self._locktime
+
+    @locktime.setter
+    def locktime(self, locktime: int):
+        self._locktime = locktime
+        self._invalidate_txid_cache()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @version.setter
+    def version(self, version: int):
+        self._version = version
+        self._invalidate_txid_cache()
+
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._invalidate_caches()
         self.deserialize()
 
     def inputs(self):
@@ -678,25 +863,32 @@ class Transaction:
         txin['scriptSig'] = None  # force re-serialization
         txin['witness'] = None    # force re-serialization
         self.raw = None
+        self._invalidate_txid_cache()
 
     def add_inputs_info(self, wallet):
         if self.is_complete():
             return
         for txin in self.inputs():
             wallet.add_input_info(txin)
+        self._invalidate_txid_cache()
 
     def remove_signatures(self):
         for txin in self.inputs():
             txin['signatures'] = [None] * len(txin['signatures'])
+        self._invalidate_txid_cache()
         assert not self.is_complete()
 
     def deserialize(self, force_full_parse=False):
-        if self.raw is None:
+        if self._raw is None and self._raw_bytes is None:
             return
             #self.raw = self.serialize()
         if self._inputs is not None:
             return
-        d = deserialize(self.raw, force_full_parse)
+        if self._raw_bytes is not None:
+            d = deserialize_bytes(self._raw_bytes, force_full_parse)
+        else:
+            d = deserialize(self._raw, force_full_parse)
+        self._invalidate_caches()
         self._inputs = d['inputs']
         self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
@@ -882,6 +1074,16 @@ class Transaction:
             return txin['scriptSig']
         return script
 
+    @classmethod
+    def input_script_bytes(cls, txin, estimate_size=False) -> bytes:
+        """Like input_script, in bytes. The scriptSig of a parsed
+        TxInput is used as it is, without going through hex."""
+        if isinstance(txin, TxInput):
+            script_sig = getattr(txin, '_scriptSig', None)
+            if script_sig is not None and (txin['type'] == 'coinbase' or cls.is_txin_complete(txin)):
+                return script_sig
+        return bfh(cls.input_script(txin, estimate_size))
+
     @classmethod
     def is_txin_complete(cls, txin):
         if txin['type'] == 'coinbase':
@@ -916,7 +1118,15 @@ class Transaction:
 
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return bh2u(self.serialize_outpoint_bytes(txin))
+
+    @classmethod
+    def serialize_outpoint_bytes(cls, txin) -> bytes:
+        if isinstance(txin, TxInput):
+            prevout_hash = txin._prevout_hash
+        else:
+            prevout_hash = bfh(txin['prevout_hash'])
+        return prevout_hash[::-1] + struct.pack('<I', txin['prevout_n'])
 
     @classmethod
     def get_outpoint_from_txin(cls, txin):
@@ -928,20 +1138,26 @@ class Transaction:
 
     @classmethod
     def serialize_input(self, txin, script):
+        return bh2u(self.serialize_input_bytes(txin, bfh(script)))
+
+    @classmethod
+    def serialize_input_bytes(cls, txin, script: bytes) -> bytes:
         # Prev hash and index
-        s = self.serialize_outpoint(txin)
+        s = bytearray(cls.serialize_outpoint_bytes(txin))
         # Script length, script, sequence
-        s += var_int(len(script)//2)
+        s += var_int_bytes(len(script))
         s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        return s
+        s += struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+        return bytes(s)
 
     def set_rbf(self, rbf):
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self._invalidate_caches()
 
     def BIP69_sort(self, inputs=True, outputs=True):
+        self._invalidate_caches()
         if inputs:
             self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         if outputs:
@@ -949,35 +1165,58 @@ class Transaction:
 
     @classmethod
     def serialize_output(cls, output: TxOutput) -> str:
-        s = int_to_hex(output.value, 8)
-        script = cls.pay_script(output.type, output.address)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        return bh2u(cls.serialize_output_bytes(output))
+
+    @classmethod
+    def serialize_output_bytes(cls, output: TxOutput) -> bytes:
+        script = bfh(cls.pay_script(output.type, output.address))
+        return struct.pack('<q', output.value) + var_int_bytes(len(script)) + script
 
     def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return bh2u(self.serialize_preimage_bytes(i))
+
+    def serialize_preimage_bytes(self, i) -> bytes:
+        nVersion = bfh(int_to_hex(self.version, 4))
+        nHashType = struct.pack('<I', 1)
+        nLocktime = struct.pack('<I', self.locktime)
         inputs = self.inputs()
         outputs = self.outputs()
         txin = inputs[i]
-        # TODO: py3 hex
+        preimage = bytearray(nVersion)
         if self.is_segwit_input(txin):
-            hashPrevouts = bh2u(sha256d(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-            hashSequence = bh2u(sha256d(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-            hashOutputs = bh2u(sha256d(bfh(''.join(self.serialize_output(o) for o in outputs))))
-            outpoint = self.serialize_outpoint(txin)
-            preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
+            hashPrevouts, hashSequence, hashOutputs = self._get_bip143_shared_hashes()
+            preimage_script = bfh(self.get_preimage_script(txin))
+            preimage += hashPrevouts + hashSequence
+            preimage += self.serialize_outpoint_bytes(txin)
+            preimage += var_int_bytes(len(preimage_script)) + preimage_script
+            preimage += struct.pack('<q', txin['value'])
+            preimage += struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+            preimage += hashOutputs
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-        return preimage
+            preimage += var_int_bytes(len(inputs))
+            for k, txin in enumerate(inputs):
+                script = bfh(self.get_preimage_script(txin)) if i == k else b''
+                preimage += self.serialize_input_bytes(txin, script)
+            preimage += var_int_bytes(len(outputs))
+            for o in outputs:
+                preimage += self.serialize_output_bytes(o)
+        preimage += nLocktime + nHashType
+        return bytes(preimage)
+
+    def _get_bip143_shared_hashes(self) -> Tuple[bytes, bytes, bytes]:
+        """Returns hashPrevouts, hashSequence and hashOutputs (BIP-143).
+        They are the same for all inputs, so they are cached; otherwise
+        signing would be quadratic in the number of inputs."""
+        inputs = self.inputs()
+        outputs = self.outputs()
+        # the lengths guard against the lists being modified in place
+        key = (len(inputs), len(outputs))
+        if self._cached_bip143_hashes is None or self._cached_bip143_hashes[0] != key:
+            hashPrevouts = sha256d(b''.join(self.serialize_outpoint_bytes(txin) for txin in inputs))
+            hashSequence = sha256d(b''.join(struct.pack('<I', txin.get('sequence', 0xffffffff - 1)) for txin in inputs))
+            hashOutputs = sha256d(b''.join(self.serialize_output_bytes(o) for o in outputs))
+            self._cached_bip143_hashes = key, (hashPrevouts, hashSequence, hashOutputs)
+        return self._cached_bip143_hashes[1]
 
     def is_segwit(self, guess_for_address=False):
         if not self.is_partial_originally:
@@ -995,48 +1234,60 @@ class Transaction:
             return network_ser
 
     def serialize_to_network(self, estimate_size=False, witness=True):
+        return bh2u(self.serialize_to_network_bytes(estimate_size, witness))
+
+    def serialize_to_network_bytes(self, estimate_size=False, witness=True) -> bytes:
         self.deserialize()
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
         use_segwit_ser_for_estimate_size = estimate_size and self.is_segwit(guess_for_address=True)
         use_segwit_ser_for_actual_use = not estimate_size and \
                                         (self.is_segwit() or any(txin['type'] == 'address' for txin in inputs))
         use_segwit_ser = use_segwit_ser_for_estimate_size or use_segwit_ser_for_actual_use
+        s = bytearray(bfh(int_to_hex(self.version, 4)))
         if witness and use_segwit_ser:
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            return nVersion + txins + txouts + nLocktime
+            s += b'\x00\x01'  # marker, flag
+        s += var_int_bytes(len(inputs))
+        for txin in inputs:
+            s += self.serialize_input_bytes(txin, self.input_script_bytes(txin, estimate_size))
+        s += var_int_bytes(len(outputs))
+        for o in outputs:
+            s += self.serialize_output_bytes(o)
+        if witness and use_segwit_ser:
+            for txin in inputs:
+                s += bfh(self.serialize_witness(txin, estimate_size))
+        s += struct.pack('<I', self.locktime)
+        return bytes(s)
 
     def txid(self):
-        self.deserialize()
-        all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
-        if not all_segwit and not self.is_complete():
-            return None
-        ser = self.serialize_to_network(witness=False)
-        return bh2u(sha256d(bfh(ser))[::-1])
+        if self._cached_txid is None:
+            self.deserialize()
+            all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
+            if not all_segwit and not self.is_complete():
+                return None
+            ser = self.serialize_to_network_bytes(witness=False)
+            self._cached_txid = bh2u(sha256d(ser)[::-1])
+        return self._cached_txid
 
     def wtxid(self):
-        self.deserialize()
-        if not self.is_complete():
-            return None
-        ser = self.serialize_to_network(witness=True)
-        return bh2u(sha256d(bfh(ser))[::-1])
+        if self._cached_wtxid is None:
+            self.deserialize()
+            if not self.is_complete():
+                return None
+            ser = self.serialize_to_network_bytes(witness=True)
+            self._cached_wtxid = bh2u(sha256d(ser)[::-1])
+        return self._cached_wtxid
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self._invalidate_caches()
         self.BIP69_sort(outputs=False)
 
     def add_outputs(self, outputs):
         self._outputs.extend(outputs)
         self.raw = None
+        self._invalidate_caches()
         self.BIP69_sort(inputs=False)
 
     def input_value(self):
@@ -1064,8 +1315,8 @@ class Transaction:
     @classmethod
     def estimated_input_weight(cls, txin, is_segwit_tx):
         '''Return an estimate of serialized input weight in weight units.'''
-        script = cls.input_script(txin, True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        script = cls.input_script_bytes(txin, True)
+        input_size = len(cls.serialize_input_bytes(txin, script))
 
         if cls.is_segwit_input(txin, guess_for_address=True):
             witness_size = len(cls.serialize_witness(txin, True)) // 2
@@ -1087,7 +1338,7 @@ class Transaction:
 
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
-        return len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None else len(self.raw) // 2  # ASCII hex string
+        return len(self.serialize_to_network_bytes(True)) if not self.is_complete() or self.raw is None else len(self.raw) // 2  # ASCII hex string
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -1146,7 +1397,7 @@ class Transaction:
         self.raw = self.serialize()
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index)))
+        pre_hash = sha256d(self.serialize_preimage_bytes(txin_index))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'
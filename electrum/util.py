@@ -23,7 +23,7 @@
 import binascii
 import os, sys, re, json
 from collections import defaultdict, OrderedDict
-from typing import NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable, Any
+from typing import NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable, Any, Iterator
 from datetime import datetime
 import decimal
 from decimal import Decimal
@@ -330,6 +330,12 @@ def json_encode(obj):
         s = repr(obj)
     return s
 
+def ndjson_encode(items) -> Iterator[str]:
+    """Encodes items as newline-delimited JSON, one line per item,
+    so that the output can be written as it is produced."""
+    for item in items:
+        yield json.dumps(item, sort_keys=True, cls=MyEncoder)
+
 def json_decode(x):
     try:
         return json.loads(x, parse_float=Decimal)
@@ -1139,6 +1145,48 @@ class OrderedDictWithIndex(OrderedDict):
         return ret
 
 
+class LRUCache:
+    """A mapping that keeps at most 'maxsize' items, evicting the
+    least recently used one when full. Not thread-safe."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._d[key]
+        except KeyError:
+            return default
+        self._d.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._d[key] = value
+        self._d.move_to_end(key)
+        self._trim()
+
+    def pop(self, key, default=None):
+        return self._d.pop(key, default)
+
+    def clear(self):
+        self._d.clear()
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __len__(self):
+        return len(self._d)
+
+    def set_maxsize(self, maxsize: int):
+        self.maxsize = maxsize
+        self._trim()
+
+    def _trim(self):
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
     otherwise return None.'''
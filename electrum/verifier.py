@@ -22,9 +22,11 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from collections import defaultdict
+from typing import Sequence, Optional, TYPE_CHECKING, Dict, List, Tuple
 
 import aiorpcx
+from aiorpcx import run_in_thread
 
 from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
 from .crypto import sha256d
@@ -33,6 +35,7 @@ from .transaction import Transaction
 from .blockchain import hash_header
 from .interface import GracefulDisconnect
 from .network import UntrustedServerReturnedError
+from .spv_cache import wallet_key
 from . import constants
 
 if TYPE_CHECKING:
@@ -46,21 +49,43 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+# max number of merkle branches requested from the server in one batch
+MERKLE_BATCH_SIZE = 50
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        self._proof_cache_key = wallet_key(wallet.storage.path)
         NetworkJobOnDefaultServer.__init__(self, network)
+        self.network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.proofs_queue = asyncio.Queue()  # (txid, merkle) received but not yet verified
+        self.proofs_from_cache = {}  # txid -> block hash, for proofs in proofs_queue that come from spv_proof_cache
+        # set on new headers, chain switches and new unverified txs
+        self._wakeup_event = asyncio.Event()
+
+    async def stop(self):
+        self.network.unregister_callback(self._on_blockchain_updated)
+        await super().stop()
+
+    def _on_blockchain_updated(self, event, *args):
+        self._wakeup_event.set()
+
+    def wakeup(self):
+        """Make main() look at the unverified txs again. Thread-safe."""
+        self.network.asyncio_loop.call_soon_threadsafe(self._wakeup_event.set)
 
     async def _start_tasks(self):
         async with self.group as group:
             await group.spawn(self.main)
+            await group.spawn(self._verify_proofs)
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
@@ -70,12 +95,15 @@ class SPV(NetworkJobOnDefaultServer):
         while True:
             await self._maybe_undo_verifications()
             await self._request_proofs()
-            await asyncio.sleep(0.1)
+            await self._wakeup_event.wait()
+            self._wakeup_event.clear()
 
     async def _request_proofs(self):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
 
+        to_request = []
+        have_header = []  # (tx_hash, tx_height, block_hash)
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -87,50 +115,117 @@ class SPV(NetworkJobOnDefaultServer):
             header = self.blockchain.read_header(tx_height)
             if header is None:
                 if tx_height < constants.net.max_checkpoint():
-                    await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                    await self.group.spawn(self._request_chunk(tx_height))
+                continue
+            self.requested_merkle.add(tx_hash)
+            have_header.append((tx_hash, tx_height, hash_header(header)))
+        # maybe we have verified some before, e.g. in another wallet.
+        # look them up all at once, and not on the event loop: this is disk I/O
+        cache = self.network.spv_proof_cache
+        cached = {}
+        if cache and have_header:
+            cached = await run_in_thread(cache.get_many, [(tx_hash, block_hash)
+                                                          for tx_hash, tx_height, block_hash in have_header])
+        for tx_hash, tx_height, block_hash in have_header:
+            merkle = cached.get((tx_hash, block_hash))
+            if merkle is not None:
+                self.proofs_from_cache[tx_hash] = block_hash
+                await self.proofs_queue.put((tx_hash, merkle))
                 continue
             # request now
             self.logger.info(f'requested merkle {tx_hash}')
-            self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            to_request.append((tx_hash, tx_height))
+        for i in range(0, len(to_request), MERKLE_BATCH_SIZE):
+            await self.group.spawn(self._request_proofs_batch, to_request[i:i+MERKLE_BATCH_SIZE])
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
-        # we need to wait if header sync/reorg is still ongoing, hence lock:
-        async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
-            else:
-                self.logger.info(str(e))
-                raise GracefulDisconnect(e)
+    async def _request_chunk(self, height):
+        await self.network.request_chunk(height, None, can_return_early=True)
+        # the header might be available now
+        self._wakeup_event.set()
+
+    async def _request_proofs_batch(self, txs: Sequence[Tuple[str, int]]):
+        results = await self.network.get_merkles_for_transactions(txs)
+        for (tx_hash, tx_height), merkle in zip(txs, results):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            if tx_height != merkle.get('block_height'):
+                self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, merkle.get('block_height'), tx_hash))
+            await self.proofs_queue.put((tx_hash, merkle))
+
+    async def _verify_proofs(self):
+        """Verify received merkle branches, all those that are waiting at once."""
+        while True:
+            proofs = [await self.proofs_queue.get()]
+            while not self.proofs_queue.empty():
+                proofs.append(self.proofs_queue.get_nowait())
+            proofs_by_height = defaultdict(list)
+            for tx_hash, merkle in proofs:
+                proofs_by_height[merkle.get('block_height')].append((tx_hash, merkle))
+            # we need to wait if header sync/reorg is still ongoing, hence lock:
+            async with self.network.bhi_lock:
+                blockchain = self.network.blockchain()
+                headers = {height: blockchain.read_header(height) for height in proofs_by_height}
+            results = await run_in_thread(self._verify_proofs_for_headers, proofs_by_height, headers)
+            header_hashes = {height: hash_header(header) for height, header in headers.items() if header}
+            verified = []
+            bad_cached_proofs = []
+            for tx_hash, merkle, error in results:
+                tx_height = merkle.get('block_height')
+                if tx_hash in self.proofs_from_cache:
+                    block_hash = self.proofs_from_cache.pop(tx_hash)
+                    if error is not None:
+                        # the block got reorged away meanwhile; not the server's fault.
+                        # forget the proof, so that we ask the server next time
+                        bad_cached_proofs.append((tx_hash, block_hash))
+                        self.requested_merkle.discard(tx_hash)
+                        continue
+                if error is not None:
+                    if self.network.config.get("skipmerklecheck"):
+                        self.logger.info(f"skipping merkle proof check {tx_hash}")
+                    else:
+                        self.logger.info(str(error))
+                        raise GracefulDisconnect(error)
+                else:
+                    verified.append((tx_hash, header_hashes[tx_height], merkle))
+                self._add_verified_tx(tx_hash, merkle, headers[tx_height], header_hashes.get(tx_height))
+            cache = self.network.spv_proof_cache
+            if cache and bad_cached_proofs:
+                await run_in_thread(cache.remove_proofs, bad_cached_proofs)
+            if bad_cached_proofs:
+                self._wakeup_event.set()
+            # the cache file is not encrypted, so it must not learn the txs of encrypted wallets
+            if cache and verified and not self.wallet.storage.is_encrypted():
+                await run_in_thread(cache.add_proofs, self._proof_cache_key, verified)
+
+    @classmethod
+    def _verify_proofs_for_headers(cls, proofs_by_height: Dict[int, List[Tuple[str, dict]]],
+                                   headers: Dict[int, Optional[dict]]) -> List[Tuple[str, dict, Optional[Exception]]]:
+        results = []
+        for tx_height, proofs in proofs_by_height.items():
+            header = headers[tx_height]
+            for tx_hash, merkle in proofs:
+                try:
+                    verify_tx_is_in_block(tx_hash, merkle.get('merkle'), merkle.get('pos'), header, tx_height)
+                except MerkleVerificationFailure as e:
+                    results.append((tx_hash, merkle, e))
+                else:
+                    results.append((tx_hash, merkle, None))
+        return results
+
+    def _add_verified_tx(self, tx_hash: str, merkle: dict, header: Optional[dict], header_hash: Optional[str]):
         # we passed all the tests
         self.merkle_roots[tx_hash] = header.get('merkle_root')
         self.requested_merkle.discard(tx_hash)
         self.logger.info(f"verified {tx_hash}")
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
+        tx_info = TxMinedInfo(height=merkle.get('block_height'),
                               timestamp=header.get('timestamp'),
-                              txpos=pos,
+                              txpos=merkle.get('pos'),
                               header_hash=header_hash)
         self.wallet.add_verified_tx(tx_hash, tx_info)
         #if self.is_up_to_date() and self.wallet.is_up_to_date():
@@ -173,6 +268,8 @@ class SPV(NetworkJobOnDefaultServer):
             above_height = cur_chain.get_height_of_last_common_block_with_chain(old_chain)
             self.logger.info(f"undoing verifications above height {above_height}")
             tx_hashes = self.wallet.undo_verifications(self.blockchain, above_height)
+            if self.network.spv_proof_cache:
+                self.network.spv_proof_cache.remove_above_height(above_height)
             for tx_hash in tx_hashes:
                 self.logger.info(f"redoing {tx_hash}")
                 self.remove_spv_proof_for_tx(tx_hash)
@@ -34,6 +34,7 @@ import time
 import json
 import copy
 import errno
+import itertools
 import traceback
 from functools import partial
 from numbers import Number
@@ -64,6 +65,7 @@ from .contacts import Contacts
 from .interface import RequestTimedOut
 from .ecc_fast import is_using_fast_ecc
 from .mnemonic import Mnemonic
+from .spv_cache import wallet_key
 from .logging import get_logger
 
 if TYPE_CHECKING:
@@ -217,9 +219,9 @@ class Abstract_Wallet(AddressSynchronizer):
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
-        self.labels                = storage.get('labels', {})
-        self.frozen_addresses      = set(storage.get('frozen_addresses', []))
-        self.frozen_coins          = set(storage.get('frozen_coins', []))  # set of txid:vout strings
+        self.labels                = dict(storage.get('labels', {}, readonly=True))  # str -> str, no deep copy needed
+        self.frozen_addresses      = set(storage.get('frozen_addresses', [], readonly=True))
+        self.frozen_coins          = set(storage.get('frozen_coins', [], readonly=True))  # set of txid:vout strings
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
 
@@ -288,11 +290,11 @@ class Abstract_Wallet(AddressSynchronizer):
                 changed = True
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
+            self.storage.put_item('labels', name, self.labels.get(name))
         return changed
 
     def set_fiat_value(self, txid, ccy, text, fx, value_sat):
-        if not self.db.get_transaction(txid):
+        if not self.db.has_transaction(txid):
             return
         # since fx is inserting the thousands separator,
         # and not util, also have fx remove it
@@ -320,7 +322,7 @@ class Abstract_Wallet(AddressSynchronizer):
             if ccy not in self.fiat_value:
                 self.fiat_value[ccy] = {}
             self.fiat_value[ccy][txid] = text
-        self.storage.put('fiat_value', self.fiat_value)
+        self.storage.put_item('fiat_value', ccy, self.fiat_value[ccy])
         return reset
 
     def get_fiat_value(self, txid, ccy):
@@ -370,7 +372,7 @@ class Abstract_Wallet(AddressSynchronizer):
         tx_hash = tx.txid()
         tx_mined_status = self.get_tx_height(tx_hash)
         if tx.is_complete():
-            if self.db.get_transaction(tx_hash):
+            if self.db.has_transaction(tx_hash):
                 label = self.get_label(tx_hash)
                 if tx_mined_status.height > 0:
                     if tx_mined_status.conf:
@@ -423,10 +425,10 @@ class Abstract_Wallet(AddressSynchronizer):
         confirmed_only = config.get('confirmed_only', False)
         utxos = self.get_utxos(domain,
                                excluded_addresses=self.frozen_addresses,
+                               excluded_coins=self.frozen_coins,
                                mature_only=True,
                                confirmed_only=confirmed_only,
                                nonlocal_only=nonlocal_only)
-        utxos = [utxo for utxo in utxos if not self.is_frozen_coin(utxo)]
         return utxos
 
     def dummy_address(self):
@@ -454,19 +456,104 @@ class Abstract_Wallet(AddressSynchronizer):
     @profiler
     def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
                          fx=None, show_addresses=False, show_fees=False,
-                         from_height=None, to_height=None):
+                         from_height=None, to_height=None, cursor=None, offset=0, limit=None):
+        """If limit is set, at most limit transactions are returned, along with
+        a next_cursor to pass as cursor to get the following ones."""
+        items = self.iter_full_history(domain, from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+                                       fx=fx, show_addresses=show_addresses, show_fees=show_fees,
+                                       from_height=from_height, to_height=to_height,
+                                       cursor=cursor, offset=offset)
+        next_cursor = None
+        if limit is not None:
+            out = list(itertools.islice(items, limit + 1))
+            if len(out) > limit:
+                out = out[:limit]
+                last = out[-1] if out else None
+                next_cursor = self.get_history_cursor(last['txid'], last['height'], last['txpos_in_block']) if last else cursor
+        else:
+            out = list(items)
+        show_fiat = fx and fx.is_enabled() and fx.get_history_config()
+        # add summary
+        if out:
+            income = 0
+            expenditures = 0
+            capital_gains = Decimal(0)
+            fiat_income = Decimal(0)
+            fiat_expenditures = Decimal(0)
+            for item in out:
+                value = item['value'].value
+                # fixme: use in and out values
+                if value < 0:
+                    expenditures += -value
+                else:
+                    income += value
+                if show_fiat:
+                    fiat_value = item['fiat_value'].value
+                    if value < 0:
+                        capital_gains += item['capital_gain'].value
+                        fiat_expenditures += -fiat_value
+                    else:
+                        fiat_income += fiat_value
+            b, v = out[0]['balance'].value, out[0]['value'].value
+            start_balance = None if b is None or v is None else b - v
+            end_balance = out[-1]['balance'].value
+            if from_timestamp is not None and to_timestamp is not None:
+                start_date = timestamp_to_datetime(from_timestamp)
+                end_date = timestamp_to_datetime(to_timestamp)
+            else:
+                start_date = None
+                end_date = None
+            summary = {
+                'start_date': start_date,
+                'end_date': end_date,
+                'from_height': from_height,
+                'to_height': to_height,
+                'start_balance': Satoshis(start_balance),
+                'end_balance': Satoshis(end_balance),
+                'incoming': Satoshis(income),
+                'outgoing': Satoshis(expenditures)
+            }
+            if show_fiat:
+                unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
+                summary['fiat_currency'] = fx.ccy
+                summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
+                summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
+                summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
+                summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
+                summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
+                summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
+                summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
+                summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
+        else:
+            summary = {}
+        result = {
+            'transactions': out,
+            'summary': summary
+        }
+        if limit is not None:
+            result['next_cursor'] = next_cursor
+        return result
+
+    def iter_full_history(self, domain=None, *, from_timestamp=None, to_timestamp=None,
+                          fx=None, show_addresses=False, show_fees=False,
+                          from_height=None, to_height=None, cursor=None, offset=0):
+        """Yields the history items of get_full_history one at a time."""
         if (from_timestamp is not None or to_timestamp is not None) \
                 and (from_height is not None or to_height is not None):
             raise Exception('timestamp and block height based filtering cannot be used together')
-        out = []
-        income = 0
-        expenditures = 0
-        capital_gains = Decimal(0)
-        fiat_income = Decimal(0)
-        fiat_expenditures = Decimal(0)
-        h = self.get_history(domain)
+        if domain is None:
+            h = self.iter_history(cursor=cursor)
+        else:
+            h = self.get_history(domain)
+            if cursor is not None:
+                cursor_key = self._history_key_from_cursor(cursor)
+                h = [x for x in h if self._history_key(x[0], x[1].height, x[1].txpos) > cursor_key]
+        show_fiat = fx and fx.is_enabled() and fx.get_history_config()
         now = time.time()
         for tx_hash, tx_mined_status, value, balance in h:
+            # value may be None if wallet is not fully synchronized
+            if value is None:
+                continue
             timestamp = tx_mined_status.timestamp
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
@@ -477,6 +564,9 @@ class Abstract_Wallet(AddressSynchronizer):
                 continue
             if to_height is not None and height >= to_height:
                 continue
+            if offset > 0:
+                offset -= 1
+                continue
             tx = self.db.get_transaction(tx_hash)
             item = {
                 'txid': tx_hash,
@@ -498,63 +588,10 @@ class Abstract_Wallet(AddressSynchronizer):
                 item['inputs'] = list(map(lambda x: dict((k, x[k]) for k in ('prevout_hash', 'prevout_n')), tx.inputs()))
                 item['outputs'] = list(map(lambda x:{'address':x.address, 'value':Satoshis(x.value)},
                                            tx.get_outputs_for_UI()))
-            # value may be None if wallet is not fully synchronized
-            if value is None:
-                continue
-            # fixme: use in and out values
-            if value < 0:
-                expenditures += -value
-            else:
-                income += value
             # fiat computations
-            if fx and fx.is_enabled() and fx.get_history_config():
-                fiat_fields = self.get_tx_item_fiat(tx_hash, value, fx, tx_fee)
-                fiat_value = fiat_fields['fiat_value'].value
-                item.update(fiat_fields)
-                if value < 0:
-                    capital_gains += fiat_fields['capital_gain'].value
-                    fiat_expenditures += -fiat_value
-                else:
-                    fiat_income += fiat_value
-            out.append(item)
-        # add summary
-        if out:
-            b, v = out[0]['balance'].value, out[0]['value'].value
-            start_balance = None if b is None or v is None else b - v
-            end_balance = out[-1]['balance'].value
-            if from_timestamp is not None and to_timestamp is not None:
-                start_date = timestamp_to_datetime(from_timestamp)
-                end_date = timestamp_to_datetime(to_timestamp)
-            else:
-                start_date = None
-                end_date = None
-            summary = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'from_height': from_height,
-                'to_height': to_height,
-                'start_balance': Satoshis(start_balance),
-                'end_balance': Satoshis(end_balance),
-                'incoming': Satoshis(income),
-                'outgoing': Satoshis(expenditures)
-            }
-            if fx and fx.is_enabled() and fx.get_history_config():
-                unrealized = self.unrealized_gains(domain, fx.timestamp_rate, fx.ccy)
-                summary['fiat_currency'] = fx.ccy
-                summary['fiat_capital_gains'] = Fiat(capital_gains, fx.ccy)
-                summary['fiat_incoming'] = Fiat(fiat_income, fx.ccy)
-                summary['fiat_outgoing'] = Fiat(fiat_expenditures, fx.ccy)
-                summary['fiat_unrealized_gains'] = Fiat(unrealized, fx.ccy)
-                summary['fiat_start_balance'] = Fiat(fx.historical_value(start_balance, start_date), fx.ccy)
-                summary['fiat_end_balance'] = Fiat(fx.historical_value(end_balance, end_date), fx.ccy)
-                summary['fiat_start_value'] = Fiat(fx.historical_value(COIN, start_date), fx.ccy)
-                summary['fiat_end_value'] = Fiat(fx.historical_value(COIN, end_date), fx.ccy)
-        else:
-            summary = {}
-        return {
-            'transactions': out,
-            'summary': summary
-        }
+            if show_fiat:
+                item.update(self.get_tx_item_fiat(tx_hash, value, fx, tx_fee))
+            yield item
 
     def default_fiat_value(self, tx_hash, fx, value_sat):
         return value_sat / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
@@ -816,6 +853,8 @@ class Abstract_Wallet(AddressSynchronizer):
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
             self.set_up_to_date(False)
+            if self.synchronizer:
+                self.synchronizer.wakeup()
             while not self.is_up_to_date():
                 if callback:
                     msg = "{}\n{} {}".format(
@@ -1129,7 +1168,7 @@ class Abstract_Wallet(AddressSynchronizer):
         req['name'] = pr.pki_data
         req['sig'] = bh2u(pr.signature)
         self.receive_requests[key] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        self.storage.put_item('payment_requests', key, req)
 
     def add_payment_request(self, req, config):
         addr = req['address']
@@ -1141,7 +1180,7 @@ class Abstract_Wallet(AddressSynchronizer):
         amount = req.get('amount')
         message = req.get('memo')
         self.receive_requests[addr] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        self.storage.put_item('payment_requests', addr, req)
         self.set_label(addr, message) # should be a default label
 
         rdir = config.get('requests_dir')
@@ -1174,7 +1213,7 @@ class Abstract_Wallet(AddressSynchronizer):
                 n = os.path.join(rdir, 'req', key[0], key[1], key, key + s)
                 if os.path.exists(n):
                     os.unlink(n)
-        self.storage.put('payment_requests', self.receive_requests)
+        self.storage.put_item('payment_requests', addr, None)
         return True
 
     def get_sorted_requests(self, config):
@@ -1253,6 +1292,9 @@ class Abstract_Wallet(AddressSynchronizer):
         encrypt_keystore = self.can_have_keystore_encryption()
         self.storage.set_keystore_encryption(bool(new_pw) and encrypt_keystore)
         self.storage.write()
+        if self.storage.is_encrypted() and self.network and self.network.spv_proof_cache:
+            # the proof cache is not encrypted
+            self.network.spv_proof_cache.remove_wallet(wallet_key(self.storage.path))
 
     def sign_message(self, address, message, password):
         index = self.get_address_index(address)
@@ -1372,7 +1414,7 @@ class Imported_Wallet(Simple_Wallet):
         return bool(self.keystore)
 
     def load_keystore(self):
-        self.keystore = load_keystore(self.storage, 'keystore') if self.storage.get('keystore') else None
+        self.keystore = load_keystore(self.storage, 'keystore') if self.storage.get('keystore', readonly=True) else None
         # fixme: a reference to addresses is needed
         if self.keystore:
             self.keystore.addresses = self.db.imported_addresses
@@ -1466,6 +1508,11 @@ class Imported_Wallet(Simple_Wallet):
         self.set_frozen_state_of_addresses([address], False)
         pubkey = self.get_public_key(address)
         self.db.remove_imported_address(address)
+        # the remaining txs of address no longer count towards our history
+        for tx_hash in list(self._history_local.get(address, ())):
+            self._update_history_index(tx_hash)
+        with self.transaction_lock:
+            self._utxo_index.pop(address, None)
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -1875,9 +1922,10 @@ class Wallet(object):
         raise WalletFileException("Unknown wallet type: " + str(wallet_type))
 
 
-def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True, segwit=True):
+def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True, segwit=True,
+                      db_type='json'):
     """Create a new wallet"""
-    storage = WalletStorage(path)
+    storage = WalletStorage(path, db_type=db_type)
     if storage.file_exists():
         raise Exception("Remove the existing wallet first!")
 
@@ -1896,11 +1944,12 @@ def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True
 
 
 def restore_wallet_from_text(text, *, path, network=None,
-                             passphrase=None, password=None, encrypt_file=True):
+                             passphrase=None, password=None, encrypt_file=True,
+                             db_type='json'):
     """Restore a wallet from text. Text can be a seed phrase, a master
     public key, a master private key, a list of bitcoin addresses
     or bitcoin private keys."""
-    storage = WalletStorage(path)
+    storage = WalletStorage(path, db_type=db_type)
     if storage.file_exists():
         raise Exception("Remove the existing wallet first!")
 